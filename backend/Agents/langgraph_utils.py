@@ -1,20 +1,53 @@
+import asyncio
 import os
-from typing import Dict, Any, Optional, List
+import threading
+from typing import Dict, Any, Optional, List, Tuple
 import json
 
-from .utils import ModelConfig
+import httpx
+
+from .offline import ReplayChatModel, SimulatedChatModel
+from .scheduler import get_scheduler
+from .utils import ModelConfig, _get_model_config
+from database.tokens import estimate_tokens
+from monitoring.log import get_logger
+from monitoring.metrics import counter
 
 
 from langchain_openai import ChatOpenAI
 from langchain_community.callbacks import get_openai_callback
-from langchain.messages import HumanMessage, SystemMessage
-from tenacity import retry, stop_after_attempt, wait_exponential
+from langchain.messages import HumanMessage, AIMessage, SystemMessage
+
+
+logger = get_logger(__name__)
+
+MODEL_TOKENS = counter('knode_model_tokens_total', 'Tokens sent to and received from upstream models',
+                       ('model', 'direction'))
+MODEL_RESPONSES = counter('knode_model_responses_total', 'Agent responses by model and source (upstream or cache)',
+                          ('model', 'source'))
+
+_http_lock = threading.Lock()
+_http_clients: Dict[str, Any] = {}
+
+
+def _shared_http_clients() -> Tuple[httpx.Client, httpx.AsyncClient]:
+    """process-wide keep-alive HTTP clients shared by every model client"""
+    with _http_lock:
+        if not _http_clients:
+            limits = httpx.Limits(
+                max_connections=int(os.environ.get('MODEL_HTTP_MAX_CONNECTIONS', 100)),
+                max_keepalive_connections=int(os.environ.get('MODEL_HTTP_MAX_KEEPALIVE', 20)),
+                keepalive_expiry=float(os.environ.get('MODEL_HTTP_KEEPALIVE_EXPIRY', 60)),
+            )
+            _http_clients['sync'] = httpx.Client(limits=limits)
+            _http_clients['async'] = httpx.AsyncClient(limits=limits)
+        return _http_clients['sync'], _http_clients['async']
 
 
 def create_model(config: ModelConfig):
     timeout_settings = {
         'request_timeout': 120,  # 2 minutes for request timeout
-        'max_retries': 2,        # reduce retries at model level since we have tenacity
+        'max_retries': 0,        # retries are done once, by the provider scheduler
     }
 
     if config.provider == 'openai':
@@ -25,7 +58,9 @@ def create_model(config: ModelConfig):
             'api_key': os.environ['OPENAI_API_KEY'],
             'request_timeout': timeout_settings['request_timeout'],
             'max_retries': timeout_settings['max_retries'],
+            'stream_usage': True,
         }
+        openai_kwargs['http_client'], openai_kwargs['http_async_client'] = _shared_http_clients()
         base_url = os.environ['OPENAI_BASE_URL']
         if base_url:
             openai_kwargs['base_url'] = base_url
@@ -39,31 +74,124 @@ def create_model(config: ModelConfig):
             'api_key': os.environ['ZHIPU_API_KEY'],
             'timeout': timeout_settings['request_timeout'],
             'max_retries': timeout_settings['max_retries'],
+            'stream_usage': True,
         }
+        zhipu_kwargs['http_client'], zhipu_kwargs['http_async_client'] = _shared_http_clients()
         base_url = os.environ['ZHIPU_BASE_URL']
         if base_url:
             zhipu_kwargs['base_url'] = base_url
             
         return ChatOpenAI(**zhipu_kwargs)
 
+    elif config.provider == 'simulated':
+        return SimulatedChatModel.from_env(config.model_name)
+    elif config.provider == 'replay':
+        # recording misses needs the real provider for REPLAY_UPSTREAM
+        return ReplayChatModel.from_env(
+            config.model_name, lambda model_id: create_model(_get_model_config(model_id, offline_override=False)))
+
     else:
         raise NotImplementedError(f"Provider {config.provider} is not supported.")
 
 
+_model_lock = threading.Lock()
+_models: Dict[tuple, Any] = {}
+
+
+def _model_key(config: ModelConfig) -> tuple:
+    base_url = os.environ.get(f'{config.provider.upper()}_BASE_URL', '')
+    return (config.provider, config.model_name, config.temperature, config.max_tokens, base_url)
+
+
+def get_model(config: ModelConfig):
+    """return the shared model client for this config, creating it on first use"""
+    key = _model_key(config)
+    with _model_lock:
+        model = _models.get(key)
+        if model is None:
+            model = create_model(config)
+            _models[key] = model
+        return model
+
+
+def pack_context(context: List, budget: int) -> List:
+    """keep the newest ancestor nodes whose cached token counts fit in budget"""
+    packed = []
+    used = 0
+    for node in reversed(context):
+        tokens = node.content_tokens
+        if tokens is None:
+            tokens = estimate_tokens(node.content)
+        if used + tokens > budget:
+            break
+        used += tokens
+        packed.append(node)
+    packed.reverse()
+    return packed
+
+
 class LangGraphAgent:
-    def __init__(self, system_msg: str, config: ModelConfig):
+    def __init__(self, system_msg: str, config: ModelConfig, cache=None):
         self.system_msg = system_msg
         self.config = config
-        self.model = create_model(config)
-        self.history = [SystemMessage(content=system_msg)]
+        self.model = get_model(config)
+        self.scheduler = get_scheduler(config.provider, config.model_name)
+        self.cache = cache  # optional ResponseCache, None disables caching
+        self.system_message = SystemMessage(content=system_msg)
+        self.system_tokens = estimate_tokens(system_msg)
+
+    def context_budget(self, message: str) -> int:
+        """tokens left for ancestor context after system message and question"""
+        return max(0, self.config.context_budget - self.system_tokens - estimate_tokens(message))
+
+    def build_messages(self, message: str, context: Optional[List] = None) -> List:
+        """build prompt from the root-to-parent node path, dropping the oldest nodes over budget"""
+        messages = [self.system_message]
+        for node in pack_context(context or [], self.context_budget(message)):
+            if node.node_type == 'question':
+                messages.append(HumanMessage(content=node.content))
+            elif node.node_type == 'answer':
+                messages.append(AIMessage(content=node.content))
+        messages.append(HumanMessage(content=message))
+        return messages
+
+    def prompt_tokens(self, messages: List) -> int:
+        """estimated prompt size, reserved against the provider's TPM budget before the call"""
+        return sum(estimate_tokens(m.content) for m in messages if isinstance(m.content, str))
+
+    def _invoke(self, messages: List):
+        """one upstream call; returns (response, input_tokens, output_tokens)"""
+        if self.config.provider in ('openai', 'zhipu'):
+            with get_openai_callback() as cb:
+                response = self.model.invoke(messages)
+            return response, cb.prompt_tokens or 0, cb.completion_tokens or 0
+        response = self.model.invoke(messages)
+        return (response, *self._usage(response))
+
+    async def _ainvoke(self, messages: List):
+        if self.config.provider in ('openai', 'zhipu'):
+            with get_openai_callback() as cb:
+                response = await self.model.ainvoke(messages)
+            return response, cb.prompt_tokens or 0, cb.completion_tokens or 0
+        response = await self.model.ainvoke(messages)
+        return (response, *self._usage(response))
+
+    @staticmethod
+    def _usage(response) -> Tuple[Optional[int], Optional[int]]:
+        """token usage reported on the message itself, (None, None) when missing"""
+        usage = getattr(response, 'usage_metadata', None)
+        if not usage:
+            return None, None
+        return usage.get('input_tokens', 0), usage.get('output_tokens', 0)
 
-    def reset(self):
-        """reset conversation"""
-        self.history = [SystemMessage(content=self.system_msg)]
+    def cache_key(self, messages: List) -> Optional[str]:
+        """response cache key for the packed prompt, None when caching is off"""
+        if self.cache is None:
+            return None
+        return self.cache.make_key(_model_key(self.config), [(m.type, m.content) for m in messages])
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-    def step(self, message: str) -> 'AgentResponse':
-        """process message and return response"""
+    def step(self, message: str, context: Optional[List] = None) -> 'AgentResponse':
+        """process message on top of the given ancestor nodes and return response"""
         # check if message is json with image data
         try:
             msg_data = json.loads(message)
@@ -74,51 +202,85 @@ class LangGraphAgent:
             pass
         
         # regular text call
-        self.history.append(HumanMessage(content=message))
+        messages = self.build_messages(message, context)
+        cache_key = self.cache_key(messages)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return self._record(AgentResponse(cached.content, cached.input_tokens, cached.output_tokens, cached=True))
         
-        # keep conversation window
-        if len(self.history) > 10:
-            self.history = [self.history[0]] + self.history[-9:]
-        
-        # get response with token tracking
-        input_tokens, output_tokens = 0, 0
+        # get response with token tracking; rate limiting and retries happen in the scheduler
+        reserved = self.prompt_tokens(messages)
         try:
-            if self.config.provider in ('openai', 'zhipu'):
-                with get_openai_callback() as cb:
-                    response = self.model.invoke(self.history)
-                    input_tokens = cb.prompt_tokens or 0
-                    output_tokens = cb.completion_tokens or 0
-            else:
-                response = self.model.invoke(self.history)
-                # estimate tokens for non-openai
-                input_tokens = len(message.split()) * 1.3
-                output_tokens = len(response.content.split()) * 1.3
+            response, input_tokens, output_tokens = self.scheduler.call(lambda: self._invoke(messages), reserved)
         except Exception as e:
-            error_msg = f"model call failed: {e}"
-            print(error_msg)
-            
-            # provide more specific error information
-            if "timeout" in str(e).lower() or "read operation timed out" in str(e).lower():
-                print(f"⚠️  Timeout error detected for {self.config.provider} {self.config.model_name}")
-                print("💡 Possible solutions:")
-                print("   - Check your internet connection")
-                print("   - Verify API key is valid")
-                print("   - Try using a different model provider")
-                print("   - Consider increasing timeout settings")
-            elif "rate limit" in str(e).lower():
-                print(f"⚠️  Rate limit exceeded for {self.config.provider}")
-                print("💡 Consider adding delays between requests")
-            elif "authentication" in str(e).lower() or "api key" in str(e).lower():
-                print(f"⚠️  Authentication error for {self.config.provider}")
-                print("💡 Check your API key configuration")
-            
+            self._report_failure(e)
+            raise
+        if input_tokens is None:
+            # estimate tokens for non-openai
             input_tokens = len(message.split()) * 1.3
-            output_tokens = 100
+            output_tokens = len(response.content.split()) * 1.3
+        self.scheduler.settle(reserved, input_tokens + output_tokens)
+
+        if cache_key is not None:
+            self.cache.put(cache_key, response.content, input_tokens, output_tokens)
+        return self._record(AgentResponse(response.content, input_tokens, output_tokens))
+
+    async def astep(self, message: str, context: Optional[List] = None) -> 'AgentResponse':
+        """async variant of step; awaits the model's ainvoke instead of holding a thread"""
+        messages = self.build_messages(message, context)
+        cache_key = self.cache_key(messages)
+        if cache_key is not None:
+            cached = await asyncio.to_thread(self.cache.get, cache_key)
+            if cached is not None:
+                return self._record(AgentResponse(cached.content, cached.input_tokens, cached.output_tokens, cached=True))
+
+        reserved = self.prompt_tokens(messages)
+        try:
+            response, input_tokens, output_tokens = await self.scheduler.acall(
+                lambda: self._ainvoke(messages), reserved)
+        except Exception as e:
+            self._report_failure(e)
             raise
-        
-        self.history.append(response)
-        
-        return AgentResponse(response.content, input_tokens, output_tokens)
+        if input_tokens is None:
+            # estimate tokens for non-openai
+            input_tokens = len(message.split()) * 1.3
+            output_tokens = len(response.content.split()) * 1.3
+        self.scheduler.settle(reserved, input_tokens + output_tokens)
+
+        if cache_key is not None:
+            await asyncio.to_thread(self.cache.put, cache_key, response.content, input_tokens, output_tokens)
+        return self._record(AgentResponse(response.content, input_tokens, output_tokens))
+
+    def _record(self, response: 'AgentResponse') -> 'AgentResponse':
+        """count the response and, for upstream calls, its tokens"""
+        model = self.scheduler.name
+        if response.cached:
+            MODEL_RESPONSES.inc(model=model, source='cache')
+        else:
+            MODEL_RESPONSES.inc(model=model, source='upstream')
+            MODEL_TOKENS.inc(response.input_tokens or 0, model=model, direction='input')
+            MODEL_TOKENS.inc(response.output_tokens or 0, model=model, direction='output')
+        return response
+
+    def _report_failure(self, e: Exception):
+        """log model call failure with hints"""
+        logger.error("model call failed for %s: %s", self.scheduler.name, e)
+
+        # provide more specific error information
+        if "timeout" in str(e).lower() or "read operation timed out" in str(e).lower():
+            logger.warning("timeout for %s %s: check the connection and API key, try another provider "
+                           "or increase the timeout", self.config.provider, self.config.model_name)
+        elif "rate limit" in str(e).lower():
+            logger.warning("rate limit exceeded for %s: set %s_RPM / %s_TPM to pace requests",
+                           self.config.provider, self.config.provider.upper(), self.config.provider.upper())
+        elif "authentication" in str(e).lower() or "api key" in str(e).lower():
+            logger.warning("authentication error for %s: check your API key configuration", self.config.provider)
+
+    def stream(self, message: str, context: Optional[List] = None) -> 'AgentStream':
+        """stream the response token by token; retried only until the first chunk arrives"""
+        messages = self.build_messages(message, context)
+        return AgentStream(self, messages, message, self.cache_key(messages))
 
     def _step_vision(self, messages: List[Dict]) -> 'AgentResponse':
         """handle vision model calls"""
@@ -136,40 +298,104 @@ class LangGraphAgent:
         human_msg = HumanMessage(content=content)
         
         # get response
-        input_tokens, output_tokens = 0, 0
         try:
-            if self.config.provider in ('openai', 'zhipu'):
-                with get_openai_callback() as cb:
-                    response = self.model.invoke([self.history[0], human_msg])
-                    input_tokens = cb.prompt_tokens or 0
-                    output_tokens = cb.completion_tokens or 0
-            else:
-                response = self.model.invoke([self.history[0], human_msg])
+            response, input_tokens, output_tokens = self.scheduler.call(
+                lambda: self._invoke([self.system_message, human_msg]), 200)
+            if input_tokens is None:
                 # estimate tokens
                 input_tokens = 200  # rough estimate for image
                 output_tokens = len(response.content.split()) * 1.3
         except Exception as e:
-            error_msg = f"vision model call failed: {e}"
-            print(error_msg)
-            
+            logger.error("vision model call failed for %s: %s", self.scheduler.name, e)
+
             # provide more specific error information for vision calls
             if "timeout" in str(e).lower() or "read operation timed out" in str(e).lower():
-                print(f"⚠️  Vision timeout error detected for {self.config.provider} {self.config.model_name}")
-                print("💡 Vision calls may take longer due to image processing")
-                print("   - Consider using a different vision model")
-                print("   - Check image size and format")
+                logger.warning("vision timeout for %s %s: image processing takes longer, "
+                               "check image size and format or use a different vision model",
+                               self.config.provider, self.config.model_name)
             elif "rate limit" in str(e).lower():
-                print(f"⚠️  Rate limit exceeded for vision calls on {self.config.provider}")
+                logger.warning("rate limit exceeded for vision calls on %s", self.config.provider)
             elif "authentication" in str(e).lower() or "api key" in str(e).lower():
-                print(f"⚠️  Authentication error for vision calls on {self.config.provider}")
-            
+                logger.warning("authentication error for vision calls on %s", self.config.provider)
+
             raise
-        
-        return AgentResponse(response.content, input_tokens, output_tokens)
+
+        return self._record(AgentResponse(response.content, input_tokens, output_tokens))
+
+class AgentStream:
+    """iterate to receive text deltas; `response` is set once the stream completes"""
+    def __init__(self, agent: LangGraphAgent, messages: List, message: str, cache_key: Optional[str] = None):
+        self.agent = agent
+        self.messages = messages
+        self.message = message
+        self.cache_key = cache_key
+        self.content = ''
+        self.response: Optional[AgentResponse] = None
+
+    def _from_cache(self, cached) -> str:
+        self.content = cached.content
+        self.response = self.agent._record(
+            AgentResponse(cached.content, cached.input_tokens, cached.output_tokens, cached=True))
+        return cached.content
+
+    def __iter__(self):
+        if self.cache_key is not None:
+            cached = self.agent.cache.get(self.cache_key)
+            if cached is not None:
+                yield self._from_cache(cached)
+                return
+
+        scheduler = self.agent.scheduler
+        reserved = self.agent.prompt_tokens(self.messages)
+        aggregated = None
+        for chunk in scheduler.stream(lambda: self.agent.model.stream(self.messages), reserved):
+            aggregated = chunk if aggregated is None else aggregated + chunk
+            if chunk.content:
+                self.content += chunk.content
+                yield chunk.content
+        self._finish(aggregated)
+        scheduler.settle(reserved, self.response.input_tokens + self.response.output_tokens)
+        if self.cache_key is not None:
+            self.agent.cache.put(self.cache_key, self.content, self.response.input_tokens,
+                                 self.response.output_tokens)
+
+    async def __aiter__(self):
+        if self.cache_key is not None:
+            cached = await asyncio.to_thread(self.agent.cache.get, self.cache_key)
+            if cached is not None:
+                yield self._from_cache(cached)
+                return
+
+        scheduler = self.agent.scheduler
+        reserved = self.agent.prompt_tokens(self.messages)
+        aggregated = None
+        async for chunk in scheduler.astream(lambda: self.agent.model.astream(self.messages), reserved):
+            aggregated = chunk if aggregated is None else aggregated + chunk
+            if chunk.content:
+                self.content += chunk.content
+                yield chunk.content
+        self._finish(aggregated)
+        scheduler.settle(reserved, self.response.input_tokens + self.response.output_tokens)
+        if self.cache_key is not None:
+            await asyncio.to_thread(self.agent.cache.put, self.cache_key, self.content,
+                                    self.response.input_tokens, self.response.output_tokens)
+
+    def _finish(self, aggregated):
+        usage = getattr(aggregated, 'usage_metadata', None) if aggregated is not None else None
+        if usage:
+            input_tokens = usage.get('input_tokens', 0)
+            output_tokens = usage.get('output_tokens', 0)
+        else:
+            # provider did not report usage for the stream
+            input_tokens = sum(estimate_tokens(m.content) for m in self.messages if isinstance(m.content, str))
+            output_tokens = estimate_tokens(self.content)
+        self.response = self.agent._record(AgentResponse(self.content, input_tokens, output_tokens))
+
 
 class AgentResponse:
     """agent response with token tracking"""
-    def __init__(self, content: str, input_tokens: int, output_tokens: int):
+    def __init__(self, content: str, input_tokens: int, output_tokens: int, cached: bool = False):
         self.content = content
         self.input_tokens = input_tokens
-        self.output_tokens = output_tokens
\ No newline at end of file
+        self.output_tokens = output_tokens
+        self.cached = cached  # served from the response cache, no model call
@@ -0,0 +1,464 @@
+"""offline model providers for load testing without a live upstream
+
+- `simulated`: generates deterministic filler answers with configurable
+  time-to-first-token distribution, chunk timing, output length and
+  injected 429 / timeout errors (optionally a provider-side RPM limit).
+- `replay`: serves recorded answers, with their token usage and timing,
+  from a JSONL fixture store; with REPLAY_ON_MISS=record it calls the real
+  upstream model on a miss and appends the answer to the store.
+
+errors are raised as the same openai exceptions the real providers raise,
+so retries and backoff go through the provider scheduler unchanged.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+from abc import abstractmethod
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+import openai
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+from database.tokens import estimate_tokens
+
+
+WORDS = ('知识', '节点', '图谱', '推理', '结构', '语义', '关系', '实体', '模型', '数据', '检索', '上下文',
+         'graph', 'node', 'token', 'latency', 'context', 'answer')
+
+
+def _env(name: str, default):
+    value = os.environ.get(name)
+    return type(default)(value) if value else default
+
+
+def _prompt(messages: List[BaseMessage]) -> List[Tuple[str, Any]]:
+    return [(m.type, m.content) for m in messages]
+
+
+def _usage(input_tokens: int, output_tokens: int) -> Dict:
+    return {'input_tokens': input_tokens, 'output_tokens': output_tokens,
+            'total_tokens': input_tokens + output_tokens}
+
+
+def _request() -> httpx.Request:
+    return httpx.Request('POST', 'http://offline.invalid/v1/chat/completions')
+
+
+def rate_limit_error(retry_after: float) -> openai.RateLimitError:
+    response = httpx.Response(429, headers={'retry-after-ms': str(int(retry_after * 1000))}, request=_request())
+    return openai.RateLimitError('simulated rate limit', response=response, body=None)
+
+
+def timeout_error() -> openai.APITimeoutError:
+    return openai.APITimeoutError(request=_request())
+
+
+class _Plan:
+    """what one simulated call does: wait, then fail or emit chunks at the given offsets"""
+    def __init__(self, error: Optional[Exception] = None, error_after: float = 0.0,
+                 chunks: Optional[List[Tuple[float, str]]] = None, usage: Optional[Dict] = None):
+        self.error = error
+        self.error_after = error_after
+        self.chunks = chunks or []
+        self.usage = usage or _usage(0, 0)
+
+    @property
+    def content(self) -> str:
+        return ''.join(text for _, text in self.chunks)
+
+    @property
+    def duration(self) -> float:
+        return self.chunks[-1][0] if self.chunks else 0.0
+
+
+def _result(plan: _Plan) -> ChatResult:
+    message = AIMessage(content=plan.content, usage_metadata=plan.usage)
+    return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def _run(plan: _Plan) -> ChatResult:
+    time.sleep(plan.error_after if plan.error is not None else plan.duration)
+    if plan.error is not None:
+        raise plan.error
+    return _result(plan)
+
+
+async def _arun(plan: _Plan) -> ChatResult:
+    await asyncio.sleep(plan.error_after if plan.error is not None else plan.duration)
+    if plan.error is not None:
+        raise plan.error
+    return _result(plan)
+
+
+def _chunk(text: str, usage: Optional[Dict] = None) -> ChatGenerationChunk:
+    return ChatGenerationChunk(message=AIMessageChunk(content=text, usage_metadata=usage))
+
+
+def _play(plan: _Plan) -> Iterator[ChatGenerationChunk]:
+    start = time.monotonic()
+    if plan.error is not None:
+        time.sleep(plan.error_after)
+        raise plan.error
+    last = len(plan.chunks) - 1
+    for i, (offset, text) in enumerate(plan.chunks):
+        delay = offset - (time.monotonic() - start)
+        if delay > 0:
+            time.sleep(delay)
+        # usage rides on the last chunk, like openai with stream_usage
+        yield _chunk(text, plan.usage if i == last else None)
+
+
+async def _aplay(plan: _Plan) -> AsyncIterator[ChatGenerationChunk]:
+    start = time.monotonic()
+    if plan.error is not None:
+        await asyncio.sleep(plan.error_after)
+        raise plan.error
+    last = len(plan.chunks) - 1
+    for i, (offset, text) in enumerate(plan.chunks):
+        delay = offset - (time.monotonic() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        yield _chunk(text, plan.usage if i == last else None)
+
+
+class _PlannedChatModel(BaseChatModel):
+    """chat model whose calls are fully described by a _Plan"""
+
+    @abstractmethod
+    def _plan(self, messages: List[BaseMessage]) -> _Plan:
+        """describe the next call: its timing, chunks and usage, or the error it raises"""
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        return _run(self._plan(messages))
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        return await _arun(self._plan(messages))
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        yield from _play(self._plan(messages))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        async for chunk in _aplay(self._plan(messages)):
+            yield chunk
+
+
+class SimulatedChatModel(_PlannedChatModel):
+    """filler answers with simulated timing and failures
+
+    time to first token is drawn from `distribution` (fixed, uniform,
+    exponential or lognormal) around `ttft` seconds; after that one chunk of
+    `chunk_tokens` words arrives every `chunk_interval` seconds until
+    `output_tokens` (±50%) words were sent. the answer text depends only on
+    the prompt, so the response cache sees realistic hits.
+    """
+    model_name: str = 'simulated'
+    ttft: float = 0.3
+    distribution: str = 'lognormal'
+    sigma: float = 0.5               # spread for lognormal, relative width for uniform
+    chunk_interval: float = 0.02
+    chunk_tokens: int = 4
+    output_tokens: int = 200
+    rate_limit_rate: float = 0.0     # probability of an immediate 429
+    retry_after: float = 1.0
+    timeout_rate: float = 0.0        # probability of a timeout after `timeout` seconds
+    timeout: float = 10.0
+    rpm: float = 0.0                 # provider-side request limit, 429 with retry-after when exceeded
+    seed: Optional[int] = None
+
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _rng: random.Random = PrivateAttr()
+    _level: float = PrivateAttr()
+    _updated: float = PrivateAttr()
+
+    def model_post_init(self, __context: Any) -> None:
+        super().model_post_init(__context)
+        self._rng = random.Random(self.seed)
+        self._level = max(1.0, self.rpm / 60)  # one second of burst
+        self._updated = time.monotonic()
+
+    @property
+    def _llm_type(self) -> str:
+        return 'knode-simulated'
+
+    @classmethod
+    def from_env(cls, model_name: str) -> 'SimulatedChatModel':
+        seed = os.environ.get('SIMULATED_SEED')
+        return cls(
+            model_name=model_name,
+            ttft=_env('SIMULATED_TTFT_MS', 300.0) / 1000,
+            distribution=_env('SIMULATED_LATENCY_DISTRIBUTION', 'lognormal'),
+            sigma=_env('SIMULATED_LATENCY_SIGMA', 0.5),
+            chunk_interval=_env('SIMULATED_CHUNK_MS', 20.0) / 1000,
+            chunk_tokens=_env('SIMULATED_CHUNK_TOKENS', 4),
+            output_tokens=_env('SIMULATED_OUTPUT_TOKENS', 200),
+            rate_limit_rate=_env('SIMULATED_429_RATE', 0.0),
+            retry_after=_env('SIMULATED_RETRY_AFTER_MS', 1000.0) / 1000,
+            timeout_rate=_env('SIMULATED_TIMEOUT_RATE', 0.0),
+            timeout=_env('SIMULATED_TIMEOUT_MS', 10000.0) / 1000,
+            rpm=_env('SIMULATED_LIMIT_RPM', 0.0),
+            seed=int(seed) if seed else None,
+        )
+
+    def _sample_ttft(self) -> float:
+        rng = self._rng
+        if self.distribution == 'fixed':
+            return self.ttft
+        if self.distribution == 'uniform':
+            return rng.uniform(self.ttft * (1 - self.sigma), self.ttft * (1 + self.sigma))
+        if self.distribution == 'exponential':
+            return rng.expovariate(1 / self.ttft) if self.ttft > 0 else 0.0
+        if self.distribution == 'lognormal':
+            # median at ttft, long right tail
+            return self.ttft * math.exp(rng.gauss(0, self.sigma))
+        raise ValueError(f"unknown latency distribution: {self.distribution}")
+
+    def _throttle(self) -> Optional[float]:
+        """take one request from the provider-side bucket (lock held); seconds to wait when empty"""
+        if not self.rpm:
+            return None
+        rate = self.rpm / 60
+        now = time.monotonic()
+        self._level = min(max(1.0, rate), self._level + (now - self._updated) * rate)
+        self._updated = now
+        if self._level < 1:
+            return (1 - self._level) / rate
+        self._level -= 1
+        return None
+
+    def _plan(self, messages: List[BaseMessage]) -> _Plan:
+        with self._lock:
+            wait = self._throttle()
+            if wait is not None:
+                return _Plan(rate_limit_error(wait))
+            if self._rng.random() < self.rate_limit_rate:
+                return _Plan(rate_limit_error(self.retry_after))
+            if self._rng.random() < self.timeout_rate:
+                return _Plan(timeout_error(), error_after=self.timeout)
+            ttft = max(0.0, self._sample_ttft())
+            jitter = self._rng.uniform(0.5, 1.5)
+
+        prompt = json.dumps(_prompt(messages), ensure_ascii=False)
+        rng = random.Random(hashlib.sha256(prompt.encode('utf-8')).digest())
+        count = max(1, int(self.output_tokens * rng.uniform(0.5, 1.5)))
+        words = [rng.choice(WORDS) for _ in range(count)]
+        chunks = []
+        offset = ttft
+        for i in range(0, count, max(1, self.chunk_tokens)):
+            chunks.append((offset, ''.join(words[i:i + self.chunk_tokens])))
+            offset += self.chunk_interval * jitter
+        input_tokens = sum(estimate_tokens(m.content) for m in messages if isinstance(m.content, str))
+        return _Plan(chunks=chunks, usage=_usage(input_tokens, count))
+
+
+def fixture_key(messages: List[BaseMessage]) -> str:
+    """fixture lookup key: the prompt (message types and contents), independent of the model"""
+    prompt = json.dumps(_prompt(messages), ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+
+class FixtureStore:
+    """recorded answers in a JSONL file, one record per line
+
+    {"key", "model", "prompt", "content", "input_tokens", "output_tokens",
+     "chunks": [[offset_seconds, text], ...]}
+    """
+    _stores: Dict[str, 'FixtureStore'] = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._records: Dict[str, Dict] = {}
+        self._order: List[str] = []
+        self._next = 0
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        self._add(json.loads(line))
+
+    @classmethod
+    def open(cls, path: str) -> 'FixtureStore':
+        """one store per file, shared by every replay model in the process"""
+        path = os.path.abspath(path)
+        with cls._stores_lock:
+            store = cls._stores.get(path)
+            if store is None:
+                store = cls._stores[path] = cls(path)
+            return store
+
+    def _add(self, record: Dict):
+        if record['key'] not in self._records:
+            self._order.append(record['key'])
+        self._records[record['key']] = record
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def get(self, key: str) -> Optional[Dict]:
+        return self._records.get(key)
+
+    def cycle(self) -> Optional[Dict]:
+        """the next record in file order, wrapping around"""
+        with self._lock:
+            if not self._order:
+                return None
+            record = self._records[self._order[self._next % len(self._order)]]
+            self._next += 1
+            return record
+
+    def add(self, record: Dict):
+        with self._lock:
+            self._add(record)
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def _record(key: str, model: str, messages: List[BaseMessage], chunks: List[Tuple[float, str]],
+            usage: Optional[Dict]) -> Dict:
+    content = ''.join(text for _, text in chunks)
+    if not usage:
+        usage = _usage(sum(estimate_tokens(m.content) for m in messages if isinstance(m.content, str)),
+                       estimate_tokens(content))
+    return {
+        'key': key,
+        'model': model,
+        'prompt': _prompt(messages),
+        'content': content,
+        'input_tokens': usage.get('input_tokens', 0),
+        'output_tokens': usage.get('output_tokens', 0),
+        'chunks': [[round(offset, 4), text] for offset, text in chunks],
+    }
+
+
+class ReplayChatModel(_PlannedChatModel):
+    """answers from a fixture store
+
+    on a miss: `error` raises, `cycle` serves the recorded answers in turn
+    (for load tests with fresh prompts), `record` calls `upstream` and appends
+    the answer. recorded timing is scaled by `speed` (0 replays instantly).
+    """
+    model_name: str = 'replay'
+    path: str = 'replay_fixtures.jsonl'
+    on_miss: str = 'error'
+    speed: float = 1.0
+    upstream: Optional[BaseChatModel] = None
+
+    _store: FixtureStore = PrivateAttr()
+
+    def model_post_init(self, __context: Any) -> None:
+        super().model_post_init(__context)
+        if self.on_miss not in ('error', 'cycle', 'record'):
+            raise ValueError(f"REPLAY_ON_MISS must be error, cycle or record, not {self.on_miss}")
+        if self.on_miss == 'record' and self.upstream is None:
+            raise ValueError("recording needs an upstream model (REPLAY_UPSTREAM)")
+        self._store = FixtureStore.open(self.path)
+
+    @property
+    def _llm_type(self) -> str:
+        return 'knode-replay'
+
+    @classmethod
+    def from_env(cls, model_name: str, upstream_factory) -> 'ReplayChatModel':
+        on_miss = _env('REPLAY_ON_MISS', 'error')
+        upstream = None
+        if on_miss == 'record':
+            upstream = upstream_factory(_env('REPLAY_UPSTREAM', 'glm-4.5-air'))
+        return cls(
+            model_name=model_name,
+            path=_env('REPLAY_FIXTURES', 'replay_fixtures.jsonl'),
+            on_miss=on_miss,
+            speed=_env('REPLAY_SPEED', 1.0),
+            upstream=upstream,
+        )
+
+    def _plan(self, messages: List[BaseMessage]) -> _Plan:
+        key = fixture_key(messages)
+        record = self._store.get(key)
+        if record is None and self.on_miss == 'cycle':
+            record = self._store.cycle()
+        if record is None:
+            raise LookupError(f"no recorded answer for prompt {key[:12]} in {self.path}")
+        chunks = record.get('chunks') or [[0.0, record['content']]]
+        return _Plan(chunks=[(offset * self.speed, text) for offset, text in chunks],
+                     usage=_usage(record['input_tokens'], record['output_tokens']))
+
+    # recorded prompts replay through _plan; in record mode a miss goes to the upstream
+    # model instead and is stored with its timing
+
+    def _miss(self, messages: List[BaseMessage]) -> Optional[str]:
+        """the fixture key when the prompt has to be recorded, None when it can be replayed"""
+        if self.on_miss != 'record':
+            return None
+        key = fixture_key(messages)
+        return key if self._store.get(key) is None else None
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        key = self._miss(messages)
+        if key is None:
+            return super()._generate(messages, stop, run_manager, **kwargs)
+        start = time.monotonic()
+        response = self.upstream.invoke(messages)
+        chunks = [(time.monotonic() - start, response.content)]
+        self._store.add(_record(key, self.upstream_name, messages, chunks, response.usage_metadata))
+        return ChatResult(generations=[ChatGeneration(message=response)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        key = self._miss(messages)
+        if key is None:
+            return await super()._agenerate(messages, stop, run_manager, **kwargs)
+        start = time.monotonic()
+        response = await self.upstream.ainvoke(messages)
+        chunks = [(time.monotonic() - start, response.content)]
+        await asyncio.to_thread(self._store.add,
+                                _record(key, self.upstream_name, messages, chunks, response.usage_metadata))
+        return ChatResult(generations=[ChatGeneration(message=response)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        key = self._miss(messages)
+        if key is None:
+            yield from super()._stream(messages, stop, run_manager, **kwargs)
+            return
+        start = time.monotonic()
+        chunks = []
+        usage = None
+        for chunk in self.upstream.stream(messages):
+            chunks.append((time.monotonic() - start, chunk.content))
+            usage = chunk.usage_metadata or usage
+            yield ChatGenerationChunk(message=chunk)
+        self._store.add(_record(key, self.upstream_name, messages, chunks, usage))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        key = self._miss(messages)
+        if key is None:
+            async for chunk in super()._astream(messages, stop, run_manager, **kwargs):
+                yield chunk
+            return
+        start = time.monotonic()
+        chunks = []
+        usage = None
+        async for chunk in self.upstream.astream(messages):
+            chunks.append((time.monotonic() - start, chunk.content))
+            usage = chunk.usage_metadata or usage
+            yield ChatGenerationChunk(message=chunk)
+        await asyncio.to_thread(self._store.add, _record(key, self.upstream_name, messages, chunks, usage))
+
+    @property
+    def upstream_name(self) -> str:
+        return getattr(self.upstream, 'model_name', None) or getattr(self.upstream, 'model', None) or 'upstream'
@@ -0,0 +1,435 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+import openai
+
+from monitoring.metrics import observe_span, span
+
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """token bucket refilled continuously at rate_per_minute; rate 0 means unlimited
+
+    the level may go negative when a call turns out to cost more than reserved,
+    later callers then wait until the debt is paid back.
+    """
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float, scale: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate * scale)
+        self.updated = now
+
+    def delay(self, amount: float, now: float, scale: float = 1.0) -> float:
+        """seconds until amount is available (0 when it is available now)"""
+        if not self.rate:
+            return 0.0
+        self._refill(now, scale)
+        # a single request larger than the bucket only needs a full bucket
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / (self.rate * scale)
+
+    def take(self, amount: float):
+        if self.rate:
+            self.level -= amount
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """seconds requested by Retry-After / retry-after-ms on the error's response, if any"""
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def status_code(e: Exception) -> Optional[int]:
+    code = getattr(e, 'status_code', None)
+    if code is None:
+        code = getattr(getattr(e, 'response', None), 'status_code', None)
+    return code if isinstance(code, int) else None
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, (openai.APIConnectionError, httpx.TransportError, TimeoutError, ConnectionError)):
+        return True
+    return status_code(e) in RETRYABLE_STATUS
+
+
+class ProviderScheduler:
+    """shared admission control and the single retry policy for one provider/model
+
+    every upstream call waits for a free in-flight slot and for the RPM/TPM token
+    buckets, in FIFO order across threads and event loops. a 429 pauses the whole
+    provider until Retry-After (or an exponential backoff) has passed and halves
+    the effective rate and concurrency; successful calls grow them back.
+    """
+    def __init__(self, name: str, rpm: float = 0, tpm: float = 0, max_in_flight: int = 16,
+                 max_attempts: int = 3, base_delay: float = 1.0, max_delay: float = 30.0,
+                 min_scale: float = 0.1):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.min_scale = min_scale
+
+        self.requests = TokenBucket(rpm)
+        self.learned = False         # requests bucket estimated from 429s because no RPM was configured
+        self._completed = deque(maxlen=1000)  # monotonic times of recent successful calls
+        self.tokens = TokenBucket(tpm)
+        self.scale = 1.0             # multiplier on rate and concurrency, lowered on 429
+        self.limit = max_in_flight   # current concurrency limit
+        self.paused_until = 0.0      # monotonic time before which nobody is admitted
+
+        self._lock = threading.Lock()
+        self._waiters: List[Tuple[Any, Any]] = []  # FIFO of (loop or None, future or event)
+        self.in_flight = 0
+
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.retries = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+
+    # admission
+
+    def _admit(self, tokens: float) -> Optional[float]:
+        """take a slot and budget if possible (lock held); returns None when admitted,
+        otherwise how long to wait (0 when only a slot release can help)"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.in_flight >= self.limit:
+            return 0.0
+        delay = max(self.requests.delay(1, now, self.scale), self.tokens.delay(tokens, now, self.scale))
+        if delay > 0:
+            return delay
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.in_flight += 1
+        self.calls += 1
+        return None
+
+    def _wake_next(self):
+        """wake the oldest waiter so it re-checks admission (lock held)"""
+        if not self._waiters:
+            return
+        loop, waiter = self._waiters[0]
+        if loop is None:
+            waiter.set()
+        else:
+            loop.call_soon_threadsafe(_set_future, waiter)
+
+    def acquire(self, tokens: float = 0):
+        start = time.monotonic()
+        event = threading.Event()
+        entry = (None, event)
+        with self._lock:
+            self._waiters.append(entry)
+            try:
+                while True:
+                    delay = self._admit(tokens) if self._waiters[0] is entry else 0.0
+                    if delay is None:
+                        break
+                    event.clear()
+                    self._lock.release()
+                    try:
+                        event.wait(delay or None)
+                    finally:
+                        self._lock.acquire()
+            finally:
+                self._waiters.remove(entry)
+                waited = time.monotonic() - start
+                self.wait_seconds += waited
+                self._wake_next()
+        observe_span('model_wait', waited)
+
+    async def aacquire(self, tokens: float = 0):
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        entry = [loop, loop.create_future()]
+        with self._lock:
+            self._waiters.append(entry)
+        try:
+            while True:
+                with self._lock:
+                    delay = self._admit(tokens) if self._waiters[0] is entry else 0.0
+                    if delay is None:
+                        break
+                    entry[1] = future = loop.create_future()
+                try:
+                    await asyncio.wait_for(future, delay or None)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._lock:
+                self._waiters.remove(entry)
+                waited = time.monotonic() - start
+                self.wait_seconds += waited
+                self._wake_next()
+        observe_span('model_wait', waited)
+
+    def release(self, error: Optional[BaseException] = None, attempt: int = 1,
+                retryable: bool = True) -> Optional[float]:
+        """free the slot and adapt to the outcome; returns the delay before retrying,
+        or None when the error should not be retried
+
+        retryable=False records the error as a plain failure without backing off or
+        adapting the rate, e.g. a stream that broke after output reached the caller.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            retry_delay = None
+            if error is not None and not isinstance(error, Exception):
+                # cancelled or closed by the caller, says nothing about the provider
+                self._wake_next()
+                return None
+            if error is not None and not retryable:
+                self.failures += 1
+                self._wake_next()
+                return None
+            now = time.monotonic()
+            if error is None:
+                self.successes += 1
+                self._completed.append(now)
+                # additive increase back toward the configured rate and concurrency
+                if self.scale >= 1.0 and self.learned:
+                    # probe above a learned rate, the provider may allow more than we observed
+                    self.requests.rate *= 1.002
+                self.scale = min(1.0, self.scale + 0.05)
+                self.limit = min(self.max_in_flight, max(self.limit, round(self.max_in_flight * self.scale)))
+            elif is_retryable(error):
+                retry_delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+                retry_delay *= random.uniform(0.5, 1.0)
+                if status_code(error) == 429:
+                    self.throttled += 1
+                    requested = retry_after(error)
+                    if requested is not None:
+                        retry_delay = min(self.max_delay, requested)
+                    # multiplicative decrease once per back-off, not once per rejected call in the burst,
+                    # and hold everyone back until the provider recovers
+                    if now >= self.paused_until:
+                        self._learn_rate(now)
+                        self.scale = max(self.min_scale, self.scale / 2)
+                        self.limit = max(1, self.limit // 2)
+                    self.paused_until = max(self.paused_until, now + retry_delay)
+                if attempt >= self.max_attempts:
+                    retry_delay = None
+            if error is not None and retry_delay is None:
+                self.failures += 1
+            elif error is not None:
+                self.retries += 1
+            self._wake_next()
+            return retry_delay
+
+    def _learn_rate(self, now: float):
+        """without a configured RPM, rate-limit to the success rate observed before the 429 (lock held)"""
+        if self.requests.rate and not self.learned:
+            return
+        recent = [t for t in self._completed if now - t <= 10]
+        # a short window only measures the provider's burst allowance
+        if len(recent) < 2 or now - recent[0] < 1.0:
+            return
+        rpm = (len(recent) - 1) / (now - recent[0]) * 60
+        if self.learned:
+            rpm = min(rpm, self.requests.rate * 60)
+        bucket = TokenBucket(rpm, capacity=max(1.0, rpm / 600))
+        if self.learned:
+            # keep what is left (or owed) in the current bucket, only the rate changes
+            bucket.level = min(self.requests.level, bucket.capacity)
+        self.requests = bucket
+        self.learned = True
+
+    def settle(self, reserved: float, used: float):
+        """charge the difference between reserved and actual tokens once usage is known"""
+        with self._lock:
+            self.tokens.take(used - reserved)
+            self.tokens.level = min(self.tokens.level, self.tokens.capacity)
+
+    # calls
+
+    def call(self, fn: Callable[[], Any], tokens: float = 0) -> Any:
+        """run fn under the scheduler, retrying transient failures"""
+        attempt = 1
+        while True:
+            self.acquire(tokens)
+            try:
+                with span('model_call'):
+                    result = fn()
+            except Exception as e:
+                delay = self.release(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException as e:
+                self.release(e)
+                raise
+            self.release()
+            return result
+
+    async def acall(self, fn: Callable[[], Any], tokens: float = 0) -> Any:
+        """async variant of call; fn returns an awaitable"""
+        attempt = 1
+        while True:
+            await self.aacquire(tokens)
+            try:
+                with span('model_call'):
+                    result = await fn()
+            except Exception as e:
+                delay = self.release(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException as e:
+                self.release(e)
+                raise
+            self.release()
+            return result
+
+    def stream(self, fn: Callable[[], Any], tokens: float = 0):
+        """iterate fn() under the scheduler; retried only until the first chunk arrives"""
+        attempt = 1
+        while True:
+            self.acquire(tokens)
+            started = False
+            start = time.perf_counter()
+            try:
+                for chunk in fn():
+                    if not started:
+                        started = True
+                        observe_span('first_token', time.perf_counter() - start)
+                    yield chunk
+            except Exception as e:
+                delay = self.release(e, attempt, retryable=not started)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException as e:
+                # GeneratorExit when the consumer stops early
+                self.release(e)
+                raise
+            self.release()
+            return
+
+    async def astream(self, fn: Callable[[], Any], tokens: float = 0):
+        """async variant of stream; fn returns an async iterator"""
+        attempt = 1
+        while True:
+            await self.aacquire(tokens)
+            started = False
+            start = time.perf_counter()
+            try:
+                async for chunk in fn():
+                    if not started:
+                        started = True
+                        observe_span('first_token', time.perf_counter() - start)
+                    yield chunk
+            except Exception as e:
+                delay = self.release(e, attempt, retryable=not started)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException as e:
+                self.release(e)
+                raise
+            self.release()
+            return
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'name': self.name,
+                'waiting': len(self._waiters),
+                'in_flight': self.in_flight,
+                'limit': self.limit,
+                'max_in_flight': self.max_in_flight,
+                'scale': round(self.scale, 3),
+                'rpm': round(self.requests.rate * 60 * self.scale, 1),
+                'rpm_learned': self.learned,
+                'tpm': round(self.tokens.rate * 60 * self.scale, 1),
+                'paused_for': round(max(0.0, self.paused_until - time.monotonic()), 3),
+                'calls': self.calls,
+                'successes': self.successes,
+                'failures': self.failures,
+                'retries': self.retries,
+                'throttled': self.throttled,
+                'wait_seconds': round(self.wait_seconds, 3),
+            }
+
+
+def _set_future(future):
+    if not future.done():
+        future.set_result(None)
+
+
+_scheduler_lock = threading.Lock()
+_schedulers: Dict[tuple, ProviderScheduler] = {}
+
+
+def _setting(provider: str, name: str, default):
+    """per-provider override (ZHIPU_RPM) falling back to the global one (MODEL_RPM)"""
+    value = os.environ.get(f'{provider.upper()}_{name}', os.environ.get(f'MODEL_{name}'))
+    return type(default)(value) if value else default
+
+
+def get_scheduler(provider: str, model_name: str) -> ProviderScheduler:
+    """return the process-wide scheduler for this provider/model, creating it on first use"""
+    key = (provider, model_name)
+    with _scheduler_lock:
+        scheduler = _schedulers.get(key)
+        if scheduler is None:
+            scheduler = ProviderScheduler(
+                f'{provider}/{model_name}',
+                rpm=_setting(provider, 'RPM', 0.0),
+                tpm=_setting(provider, 'TPM', 0.0),
+                max_in_flight=_setting(provider, 'MAX_IN_FLIGHT', 16),
+                max_attempts=_setting(provider, 'MAX_ATTEMPTS', 3),
+            )
+            _schedulers[key] = scheduler
+        return scheduler
+
+
+def scheduler_stats() -> List[Dict]:
+    with _scheduler_lock:
+        schedulers = list(_schedulers.values())
+    return [scheduler.stats() for scheduler in schedulers]
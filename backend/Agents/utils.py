@@ -1,6 +1,10 @@
 
+import os
 from typing import Dict, Any, Optional, List, Tuple, TypedDict
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+
+# providers that run locally without an upstream, for load testing (see offline.py)
+OFFLINE_PROVIDERS = ('simulated', 'replay')
 
 
 @dataclass
@@ -9,10 +13,15 @@ class ModelConfig:
     provider: str
     temperature: float = 0.7
     max_tokens: int = 4096
+    context_budget: int = 8192  # max prompt tokens for system message + ancestor context + question
+
 
+def _get_model_config(model_id: str, offline_override: bool = True) -> ModelConfig:
+    """get model configuration
 
-def _get_model_config(model_id: str) -> ModelConfig:
-    """get model configuration"""
+    MODEL_PROVIDER=simulated or replay serves every model id from that offline
+    provider, keeping the id's context budget.
+    """
     configs = {
         # "claude": ModelConfig("claude-sonnet-4-20250514", "anthropic"),
         # "claude-sonnet-4-20250514": ModelConfig("claude-sonnet-4-20250514", "anthropic"),
@@ -21,16 +30,22 @@ def _get_model_config(model_id: str) -> ModelConfig:
         # "gpt-4o-2024-08-06": ModelConfig("gpt-4o-2024-08-06", "openai"),
         # "gpt-4.1-2025-04-14": ModelConfig("gpt-4.1-2025-04-14", "openai"),
         # "gpt-4.1-mini-2025-04-14": ModelConfig("gpt-4.1-mini-2025-04-14", "openai"),
-        "glm-4.6": ModelConfig("glm-4.6", "zhipu"),
-        "glm-4.5": ModelConfig("glm-4.5", "zhipu"),
-        "glm-4.5-air": ModelConfig("glm-4.5-air", "zhipu"),
+        "glm-4.6": ModelConfig("glm-4.6", "zhipu", context_budget=16384),
+        "glm-4.5": ModelConfig("glm-4.5", "zhipu", context_budget=16384),
+        "glm-4.5-air": ModelConfig("glm-4.5-air", "zhipu", context_budget=8192),
         # "glm-4.5v": ModelConfig("glm-4.5v", "zhipu"),
-        "glm-4": ModelConfig("glm-4", "zhipu"),
+        "glm-4": ModelConfig("glm-4", "zhipu", context_budget=4096),
         # "glm-4v": ModelConfig("glm-4v", "zhipu"),
         # "kimi-k2-turbo-preview": ModelConfig("kimi-k2-turbo-preview", "moonshot"),
         # "moonshot-v1-8k-vision-preview": ModelConfig("moonshot-v1-8k-vision-preview", "moonshot"),
         # "MiniMax-M2": ModelConfig("MiniMax-M2", "Minimax"),
         # "qwen3-max": ModelConfig("qwen3-max", "Alibaba"),
         # "qwen3-vl-plus": ModelConfig("qwen3-vl-plus", "Alibaba"),
+        "simulated": ModelConfig("simulated", "simulated", context_budget=8192),
+        "replay": ModelConfig("replay", "replay", context_budget=8192),
     }
-    return configs.get(model_id, configs["glm-4.5-air"])
\ No newline at end of file
+    config = configs.get(model_id, configs["glm-4.5-air"])
+    provider = os.environ.get('MODEL_PROVIDER', '') if offline_override else ''
+    if provider in OFFLINE_PROVIDERS and config.provider != provider:
+        config = replace(config, provider=provider)
+    return config
\ No newline at end of file
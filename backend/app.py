@@ -1,52 +1,389 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, request, jsonify, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-import json
+import asyncio
+import logging
 import os
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait as wait_futures
+from dataclasses import replace
 from datetime import datetime
 from backend.Agents import LangGraphAgent, _get_model_config
+from backend.Agents.scheduler import scheduler_stats
+from backend.compression import Compressor
 import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from database import serialization
 from database.database import db, ConversationNode, Conversation
-from langchain.messages import HumanMessage, AIMessage
+from database.response_cache import ResponseCache
+from monitoring.log import get_logger
+from monitoring.metrics import end_trace, format_trace, histogram, register_stats, render, span, start_trace
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify 使用 JSON_ENCODER 选定的编码器，输出紧凑的 UTF-8 JSON（中文不转义为 \\uXXXX，键不排序）"""
+
+    ensure_ascii = False
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return serialization.dumps(obj, default=self.default).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return serialization.loads(s)
+
+    def response(self, *args, **kwargs):
+        if self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(serialization.dumps(obj, default=self.default), mimetype=self.mimetype)
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 CORS(app)
 
+logger = get_logger(__name__)
+
+def create_response_cache():
+    """按环境变量创建响应缓存，RESPONSE_CACHE_MODE=off 时关闭"""
+    mode = os.environ.get('RESPONSE_CACHE_MODE', 'exact')
+    if mode == 'off':
+        return None
+    return ResponseCache(
+        db,
+        mode=mode,
+        ttl=float(os.environ.get('RESPONSE_CACHE_TTL', 86400)),
+        max_entries=int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 10000))
+    )
+
+response_cache = create_response_cache()
+
+# DB_WRITE_BEHIND=1 时问答写入进入后台队列批量提交，读取同一对话前会等待其落库
+if os.environ.get('DB_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes'):
+    db.enable_write_behind(
+        max_pending=int(os.environ.get('DB_WRITE_BEHIND_MAX_PENDING', 1000)),
+        batch_size=int(os.environ.get('DB_WRITE_BEHIND_BATCH_SIZE', 100))
+    )
+
 # Agent management
 class AgentManager:
-    def __init__(self):
-        self.agents = {}  # conversation_id -> agent
+    """按对话缓存 agent：LRU 淘汰 + 空闲超时，被淘汰的 agent 下次使用时从数据库重建
+
+    同一对话的 agent 只创建一次：并发的未命中请求等待第一个请求创建完成。
+    """
+
+    def __init__(self, max_size=None, idle_timeout=None):
+        self.agents = OrderedDict()  # conversation_id -> agent，按最近使用排序
+        self.last_used = {}  # conversation_id -> monotonic time
+        self.max_size = max_size or int(os.environ.get('AGENT_CACHE_SIZE', 256))
+        self.idle_timeout = idle_timeout or float(os.environ.get('AGENT_IDLE_TIMEOUT', 1800))
         self.default_system_msg = "你是一个专业的知识助手"
         self.default_model_id = "glm-4.5-air"
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._creating = {}  # conversation_id -> 正在创建的 agent 的 Future
+
+    def _build_agent(self, conversation_id, system_msg=None, model_id=None):
+        # 未指定时使用对话保存的配置，保证淘汰后重建的 agent 与原来一致
+        conversation = db.get_conversation(conversation_id)
+        if conversation:
+            system_msg = system_msg or conversation.system_msg
+            model_id = model_id or conversation.model_id
+        use_cache = conversation.response_cache if conversation else True
+        return LangGraphAgent(
+            system_msg=system_msg or self.default_system_msg,
+            config=_get_model_config(model_id or self.default_model_id),
+            cache=response_cache if use_cache else None
+        )
+
+    def _evict_idle(self, now):
+        while self.agents:
+            conversation_id = next(iter(self.agents))
+            if now - self.last_used[conversation_id] <= self.idle_timeout:
+                break
+            self._pop(conversation_id)
+            self.evictions += 1
+
+    def _pop(self, conversation_id):
+        self.agents.pop(conversation_id, None)
+        self.last_used.pop(conversation_id, None)
+
+    def _put(self, conversation_id, agent):
+        now = time.monotonic()
+        self.agents[conversation_id] = agent
+        self.agents.move_to_end(conversation_id)
+        self.last_used[conversation_id] = now
+        while len(self.agents) > self.max_size:
+            self._pop(next(iter(self.agents)))
+            self.evictions += 1
 
     def get_or_create_agent(self, conversation_id, system_msg=None, model_id=None):
-        if conversation_id not in self.agents:
-            system_msg = system_msg or self.default_system_msg
-            model_id = model_id or self.default_model_id
-            self.agents[conversation_id] = LangGraphAgent(
-                system_msg=system_msg,
-                config=_get_model_config(model_id)
-            )
-        return self.agents[conversation_id]
+        with self._lock:
+            now = time.monotonic()
+            self._evict_idle(now)
+            agent = self.agents.get(conversation_id)
+            if agent is not None:
+                self.hits += 1
+                self.agents.move_to_end(conversation_id)
+                self.last_used[conversation_id] = now
+                return agent
+            future = self._creating.get(conversation_id)
+            creator = future is None
+            if creator:
+                self.misses += 1
+                future = Future()
+                self._creating[conversation_id] = future
+            else:
+                self.hits += 1
+
+        if not creator:
+            return future.result()
+        try:
+            agent = self._build_agent(conversation_id, system_msg, model_id)
+        except BaseException as e:
+            with self._lock:
+                if self._creating.get(conversation_id) is future:
+                    del self._creating[conversation_id]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            # 创建期间被 reset/remove 时不放入缓存，下次按最新配置重建
+            if self._creating.get(conversation_id) is future:
+                del self._creating[conversation_id]
+                self._put(conversation_id, agent)
+        future.set_result(agent)
+        return agent
 
     def reset_agent(self, conversation_id, system_msg=None, model_id=None):
-        system_msg = system_msg or self.default_system_msg
-        model_id = model_id or self.default_model_id
-        self.agents[conversation_id] = LangGraphAgent(
-            system_msg=system_msg,
-            config=_get_model_config(model_id)
-        )
-        return self.agents[conversation_id]
+        agent = self._build_agent(conversation_id, system_msg, model_id)
+        with self._lock:
+            self._creating.pop(conversation_id, None)
+            self._put(conversation_id, agent)
+        return agent
 
     def remove_agent(self, conversation_id):
-        if conversation_id in self.agents:
-            del self.agents[conversation_id]
+        with self._lock:
+            self._creating.pop(conversation_id, None)
+            self._pop(conversation_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self.agents),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
 
 # Global agent manager
 agent_manager = AgentManager()
 
+
+# 等待同一对话中前一轮的最长秒数，超时后这一轮以 TimeoutError 失败，不再无限期排队
+TURN_WAIT_TIMEOUT = float(os.environ.get('TURN_WAIT_TIMEOUT', 600))
+
+
+class Turn:
+    """TurnCoordinator.begin 的结果
+
+    leader 为 True 时由本请求执行这一轮：先等待同一对话中排在前面的轮次，完成后调用 finish；
+    否则已有相同的请求在执行，等待它的结果即可。future 为本轮的结果，tail 在本轮及它之前的
+    轮次都结束后完成，后面的轮次等待的是 tail。
+    """
+
+    def __init__(self, coordinator, key, future, tail, previous, leader):
+        self.coordinator = coordinator
+        self.key = key
+        self.future = future
+        self.tail = tail
+        self.previous = previous
+        self.leader = leader
+
+    def wait_turn(self):
+        if self.previous is not None:
+            done, _ = wait_futures([self.previous], timeout=TURN_WAIT_TIMEOUT)
+            if not done:
+                raise self._timeout()
+
+    async def await_turn(self):
+        if self.previous is not None:
+            done, _ = await asyncio.wait([asyncio.wrap_future(self.previous)], timeout=TURN_WAIT_TIMEOUT)
+            if not done:
+                raise self._timeout()
+
+    def _timeout(self):
+        return TimeoutError(f"previous turn in conversation {self.key[0]} did not finish "
+                            f"within {TURN_WAIT_TIMEOUT:g}s")
+
+    def result(self):
+        return self.future.result()
+
+    async def aresult(self):
+        # shield：等待方被取消时不能取消执行方的 Future
+        return await asyncio.shield(asyncio.wrap_future(self.future))
+
+    def finish(self, result=None, error=None):
+        self.coordinator._finish(self, result, error)
+
+
+class TurnCoordinator:
+    """按对话串行执行问答轮次，并合并相同的并发请求
+
+    同一对话的轮次按到达顺序依次执行，不会同时读写同一对话。与正在执行或排队的轮次
+    conversation_id、parent_id 和消息都相同的请求（例如前端重复提交）不再调用模型，
+    等待那一轮完成后得到同一个结果（同一对问答节点）。Flask 线程和 ASGI 协程共用同一份状态。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}  # (conversation_id, parent_id, message) -> 该轮的 Future
+        self._tails = {}  # conversation_id -> 该对话最后一个排队轮次的 Future
+        self.turns = 0
+        self.coalesced = 0
+
+    def begin(self, conversation_id, parent_id, message):
+        key = (conversation_id, parent_id, message)
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return Turn(self, key, future, None, None, False)
+            self.turns += 1
+            future = Future()
+            tail = Future()
+            self._inflight[key] = future
+            previous = self._tails.get(conversation_id)
+            self._tails[conversation_id] = tail
+            return Turn(self, key, future, tail, previous, True)
+
+    def _finish(self, turn, result, error):
+        conversation_id = turn.key[0]
+        with self._lock:
+            if self._inflight.get(turn.key) is turn.future:
+                del self._inflight[turn.key]
+        if error is not None:
+            turn.future.set_exception(error)
+        else:
+            turn.future.set_result(result)
+
+        # 没等到前一轮就结束（等待超时或被取消）时，前一轮可能仍在写入这个对话，
+        # 后面的轮次要继续等它：本轮的 tail 在前一轮结束后才完成
+        if turn.previous is not None and not turn.previous.done():
+            turn.previous.add_done_callback(lambda _: self._release(conversation_id, turn.tail))
+        else:
+            self._release(conversation_id, turn.tail)
+
+    def _release(self, conversation_id, tail):
+        with self._lock:
+            if self._tails.get(conversation_id) is tail:
+                del self._tails[conversation_id]
+        tail.set_result(None)
+
+    def run(self, conversation_id, parent_id, message, fn):
+        """执行一轮（或等待相同的那一轮），返回 (结果, 是否为合并的请求)"""
+        turn = self.begin(conversation_id, parent_id, message)
+        if not turn.leader:
+            return turn.result(), True
+        try:
+            turn.wait_turn()
+            result = fn()
+        except BaseException as e:
+            turn.finish(error=e)
+            raise
+        turn.finish(result)
+        return result, False
+
+    async def arun(self, conversation_id, parent_id, message, fn):
+        """run 的异步版本，fn 返回 awaitable"""
+        turn = self.begin(conversation_id, parent_id, message)
+        if not turn.leader:
+            return await turn.aresult(), True
+        try:
+            await turn.await_turn()
+            result = await fn()
+        except BaseException as e:
+            turn.finish(error=e)
+            raise
+        turn.finish(result)
+        return result, False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'conversations': len(self._tails),
+                'in_flight': len(self._inflight),
+                'turns': self.turns,
+                'coalesced': self.coalesced
+            }
+
+
+turn_coordinator = TurnCoordinator()
+
+# 各组件已有的计数在抓取 /metrics 时读取
+register_stats('knode_tree_cache', lambda: db.tree_cache.stats() if db.tree_cache else None,
+               counters=('hits', 'misses', 'evictions', 'invalidations'))
+register_stats('knode_db_pool', lambda: db.pool.stats() if db.pool else None)
+register_stats('knode_write_behind', lambda: db.write_behind.stats() if db.write_behind else None,
+               counters=('batches', 'written', 'failed'))
+register_stats('knode_response_cache', lambda: response_cache.stats() if response_cache else None,
+               counters=('hits', 'misses'))
+register_stats('knode_agents', agent_manager.stats, counters=('hits', 'misses', 'evictions'))
+register_stats('knode_turn_coordinator', turn_coordinator.stats, counters=('turns', 'coalesced'))
+register_stats('knode_scheduler', scheduler_stats, label='name',
+               counters=('calls', 'successes', 'failures', 'retries', 'throttled', 'wait_seconds'))
+
+# 请求耗时；流式响应只计到响应开始，生成过程中的 span 仍计入 knode_span_seconds
+REQUEST_SECONDS = histogram('knode_request_seconds', 'HTTP request handling time', ('endpoint', 'method', 'status'))
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 1000))
+
+def record_request(endpoint, method, path, status, elapsed, trace):
+    """记录一次请求的耗时；超过 SLOW_REQUEST_MS 时连同各 span 的耗时一起输出警告"""
+    REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, method=method, status=status)
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        logger.warning("Slow request %s %s %d: %.1fms %s", method, path, status, elapsed * 1000, format_trace(trace))
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s %s %d: %.1fms %s", method, path, status, elapsed * 1000, format_trace(trace))
+
+@app.before_request
+def begin_request_trace():
+    g.trace_token = start_trace()
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def end_request_trace(response):
+    token = g.pop('trace_token', None)
+    if token is None:
+        return response
+    record_request(request.endpoint or 'unmatched', request.method, request.path, response.status_code,
+                   time.perf_counter() - g.request_start, end_trace(token))
+    return response
+
+@app.teardown_request
+def discard_request_trace(_error=None):
+    # after_request 未执行时（处理过程中抛出异常）丢弃本次汇总
+    token = g.pop('trace_token', None)
+    if token is not None:
+        end_trace(token)
+
+compressor = Compressor.from_env()
+register_stats('knode_compression', compressor.stats,
+               counters=('responses', 'bytes_in', 'bytes_out', 'hits', 'misses'))
+
+# 后注册的 after_request 先执行：压缩耗时计入本次请求的 trace
+@app.after_request
+def compress_response(response):
+    return compressor.process(response, request)
+
 @app.route('/')
 def index():
     return send_from_directory('../frontend', 'index.html')
@@ -62,6 +399,7 @@ def init_agent():
     model_id = data.get('model_id', 'glm-4.5-air')
     new_conversation = data.get('new_conversation', True)
     conversation_id = data.get('conversation_id')  # 可选的现有对话ID
+    use_response_cache = data.get('response_cache', True)
 
     try:
         # 创建新对话或继续现有对话
@@ -69,7 +407,8 @@ def init_agent():
             conversation_id = db.create_conversation(
                 title="新对话",
                 system_msg=system_msg,
-                model_id=model_id
+                model_id=model_id,
+                response_cache=use_response_cache
             )
 
         # 获取或创建对应的agent
@@ -83,6 +422,110 @@ def init_agent():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def turn_context(agent, conversation_id, parent_id, message):
+    """只取从根节点到 parent_id 的祖先路径作为上下文，避免混入兄弟分支；
+    按模型的 token 预算截断，最早的节点先被丢弃。只沿本对话中的节点查找"""
+    if not parent_id:
+        return []
+    path = db.get_node_path(parent_id, token_budget=agent.context_budget(message), conversation_id=conversation_id)
+    if not path:
+        raise LookupError(f'Parent node not found in conversation: {parent_id}')
+    return path
+
+def parent_error(conversation_id, parent_id):
+    """parent_id 不属于该对话时返回错误信息；在调用模型之前检查，不会用其他对话的内容作上下文"""
+    if parent_id and not db.has_node(conversation_id, parent_id):
+        return f'Parent node not found in conversation: {parent_id}'
+    return None
+
+def turn_title(parent_id, message):
+    """第一个问题作为对话标题"""
+    if parent_id is None:
+        return message[:50] + ('...' if len(message) > 50 else '')
+    return None
+
+def turn_nodes(conversation_id, parent_id, message):
+    """新一轮的问题节点和回答节点 id"""
+    question_node = ConversationNode(
+        id=str(uuid.uuid4()),
+        parent_id=parent_id,
+        conversation_id=conversation_id,
+        node_type='question',
+        content=message
+    )
+    return question_node, str(uuid.uuid4())
+
+def answer_node(question_node, answer_id, content, input_tokens=None, output_tokens=None, cached=False):
+    return ConversationNode(
+        id=answer_id,
+        parent_id=question_node.id,
+        conversation_id=question_node.conversation_id,
+        node_type='answer',
+        content=content,
+        tokens_input=input_tokens,
+        tokens_output=output_tokens,
+        tokens_cached=cached
+    )
+
+def turn_result(question_node, answer, response):
+    """一轮问答的结果；合并的重复请求得到同一个结果"""
+    return {
+        'id': answer.id,
+        'question_id': question_node.id,
+        'content': response.content,
+        'input_tokens': response.input_tokens,
+        'output_tokens': response.output_tokens,
+        'cached': response.cached
+    }
+
+def chat_payload(result):
+    """/api/chat 的返回内容"""
+    return {
+        'success': True,
+        'response': {
+            'id': result['id'],
+            'content': result['content'],
+            'input_tokens': result['input_tokens'],
+            'output_tokens': result['output_tokens'],
+            'cached': result['cached']
+        },
+        'question_id': result['question_id']
+    }
+
+def replay_events(result):
+    """合并的重复流式请求：等执行的那一轮结束后一次性返回完整回答"""
+    yield sse_event('start', {'question_id': result['question_id'], 'answer_id': result['id']})
+    yield sse_event('token', {'content': result['content']})
+    yield sse_event('done', {
+        'id': result['id'],
+        'question_id': result['question_id'],
+        'input_tokens': result['input_tokens'],
+        'output_tokens': result['output_tokens'],
+        'cached': result['cached']
+    })
+
+def chat_turn(conversation_id, parent_id, message):
+    """执行一轮问答：调用模型，问答节点和标题在同一个事务中写入"""
+    # 获取对应的agent
+    agent = agent_manager.get_or_create_agent(conversation_id)
+
+    logger.debug("Processing chat request for conversation %s: %.50s", conversation_id, message)
+
+    response = agent.step(message, turn_context(agent, conversation_id, parent_id, message))
+    logger.debug("Agent response received: %.100s", response.content)
+
+    question_node, answer_id = turn_nodes(conversation_id, parent_id, message)
+    answer = answer_node(question_node, answer_id, response.content, response.input_tokens,
+                         response.output_tokens, response.cached)
+
+    title = turn_title(parent_id, message)
+    db.save_turn(question_node, answer, title=title)
+    logger.debug("Turn saved: question %s, answer %s", question_node.id, answer.id)
+    if title is not None:
+        logger.debug("Conversation title updated: %s", title)
+
+    return turn_result(question_node, answer, response)
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     data = request.json
@@ -92,61 +535,331 @@ def chat():
 
     if not conversation_id:
         return jsonify({'success': False, 'error': 'Conversation ID is required'}), 400
+    error = parent_error(conversation_id, parent_id)
+    if error:
+        return jsonify({'success': False, 'error': error}), 404
 
     try:
-        # 获取对应的agent
-        agent = agent_manager.get_or_create_agent(conversation_id)
+        # 同一对话的轮次依次执行，相同的并发请求共用一次模型调用
+        result, coalesced = turn_coordinator.run(
+            conversation_id, parent_id, message,
+            lambda: chat_turn(conversation_id, parent_id, message)
+        )
+        if coalesced:
+            logger.info("Duplicate chat request coalesced for conversation %s", conversation_id)
+
+        return jsonify(chat_payload(result))
+    except Exception as e:
+        logger.error("Error in chat for conversation %s: %s", conversation_id, e)
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        print(f"Processing chat request for conversation {conversation_id}: {message[:50]}...")
+def sse_event(event, data):
+    """格式化一条 Server-Sent Event"""
+    return f"event: {event}\ndata: {serialization.dumps(data).decode('utf-8')}\n\n"
 
-        response = agent.step(message)
-        print(f"Agent response received: {response.content[:100]}...")
+def conversation_response(payload, tree_json):
+    """返回含对话树的 JSON 响应
 
-        # 保存问题节点
-        question_node = ConversationNode(
-            id=str(uuid.uuid4()),
-            parent_id=parent_id,
-            conversation_id=conversation_id,
-            node_type='question',
-            content=message
-        )
-        db.save_node(question_node)
-        print(f"Question node saved: {question_node.id}")
-
-        # 保存回答节点
-        answer_node = ConversationNode(
-            id=str(uuid.uuid4()),
-            parent_id=question_node.id,
-            conversation_id=conversation_id,
-            node_type='answer',
-            content=response.content,
-            tokens_input=response.input_tokens,
-            tokens_output=response.output_tokens
-        )
-        db.save_node(answer_node)
-        print(f"Answer node saved: {answer_node.id}")
+    payload['conversation'] 不含 tree，树以预先序列化好的 JSON（通常来自树缓存）直接拼接，
+    不再对整棵树重新序列化。
+    """
+    with span('json_serialize'):
+        conversation = serialization.dumps(payload.pop('conversation'))
+        head = serialization.dumps(payload)
+        body = b''.join((
+            head[:-1], b',"conversation":', conversation[:-1], b',"tree":',
+            tree_json if tree_json is not None else b'null', b'}}'
+        ))
+    return Response(body, mimetype='application/json')
 
-        # 更新对话标题（使用第一个问题作为标题）
-        if parent_id is None:  # 这是第一个问题
-            title = message[:50] + ('...' if len(message) > 50 else '')
-            db.update_conversation_title(conversation_id, title)
-            print(f"Conversation title updated: {title}")
+def tree_etag(conversation, *variant):
+    """对话树响应的弱 ETag：写入节点时修订号递增，修改标题时 updated_at 改变
 
-        print(f"Chat request completed successfully for conversation {conversation_id}")
+    variant 为影响响应内容的请求参数（子树的根和深度、骨架的预览长度等）。
+    """
+    return '.'.join(str(part) for part in (conversation.id, conversation.revision, conversation.updated_at) + variant)
 
-        return jsonify({
-            'success': True,
-            'response': {
-                'id': answer_node.id,
-                'content': response.content,
+def not_modified(etag):
+    """请求的 If-None-Match 与 etag 匹配时返回 304 响应，否则返回 None"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
+
+def with_etag(response, etag):
+    """附加 ETag；no-cache 要求客户端每次带 If-None-Match 重新验证"""
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """流式对话：通过 SSE 逐段返回回答，结束时（或客户端断开时）保存问答节点"""
+    data = request.json
+    message = data.get('message', '')
+    conversation_id = data.get('conversation_id')  # 必需的对话ID
+    parent_id = data.get('parent_id')
+
+    if not conversation_id:
+        return jsonify({'success': False, 'error': 'Conversation ID is required'}), 400
+    error = parent_error(conversation_id, parent_id)
+    if error:
+        return jsonify({'success': False, 'error': error}), 404
+
+    try:
+        agent = agent_manager.get_or_create_agent(conversation_id)
+    except Exception as e:
+        logger.error("Error in chat stream for conversation %s: %s", conversation_id, e)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+    question_node, answer_id = turn_nodes(conversation_id, parent_id, message)
+
+    def save(content, input_tokens=None, output_tokens=None, cached=False):
+        answer = answer_node(question_node, answer_id, content, input_tokens, output_tokens, cached)
+        db.save_turn(question_node, answer, title=turn_title(parent_id, message))
+        return answer
+
+    def generate():
+        # 在响应开始后才加入队列，客户端未读取响应时不会占住对话
+        turn = turn_coordinator.begin(conversation_id, parent_id, message)
+        if not turn.leader:
+            try:
+                yield from replay_events(turn.result())
+            except Exception as e:
+                yield sse_event('error', {'error': str(e)})
+            return
+
+        stream = None
+        result = None
+        error = None
+        try:
+            turn.wait_turn()
+            # 等前面的轮次写完再读取上下文
+            stream = agent.stream(message, turn_context(agent, conversation_id, parent_id, message))
+            yield sse_event('start', {'question_id': question_node.id, 'answer_id': answer_id})
+            for delta in stream:
+                yield sse_event('token', {'content': delta})
+
+            response = stream.response
+            answer = save(response.content, response.input_tokens, response.output_tokens, response.cached)
+            result = turn_result(question_node, answer, response)
+            yield sse_event('done', {
+                'id': answer_id,
+                'question_id': question_node.id,
                 'input_tokens': response.input_tokens,
-                'output_tokens': response.output_tokens
-            },
-            'question_id': question_node.id
-        })
+                'output_tokens': response.output_tokens,
+                'cached': response.cached
+            })
+        except Exception as e:
+            error = e
+            logger.error("Error in chat stream for conversation %s: %s", conversation_id, e)
+            yield sse_event('error', {'error': str(e)})
+        finally:
+            try:
+                # 客户端断开或模型出错时保留已生成的部分回答
+                if result is None and stream is not None and stream.content:
+                    save(stream.content)
+                    logger.info("Partial answer saved: %s", answer_id)
+            except Exception as e:
+                logger.error("Failed to save partial answer %s: %s", answer_id, e)
+            finally:
+                # 无论保存是否成功都要结束这一轮，否则同一对话后面的轮次会一直等待
+                if result is None:
+                    turn.finish(error=error or RuntimeError('stream interrupted'))
+                else:
+                    turn.finish(result)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# 批量分支：同一个问题同时发往多个父节点 / 多个模型
+BATCH_MAX_BRANCHES = int(os.environ.get('BATCH_MAX_BRANCHES', 16))
+BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', 8))
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS, thread_name_prefix='knode-batch')
+
+def batch_request(data):
+    """解析批量请求，返回 (对话, 分支列表)；分支为 parent_ids × model_ids，参数有误时抛出 ValueError
+
+    每个分支是一个字典：index、parent_id、model_id、agent、question（问题节点）、answer_id。
+    """
+    conversation_id = data.get('conversation_id')
+    message = data.get('message', '')
+    if not conversation_id:
+        raise ValueError('Conversation ID is required')
+    conversation = db.get_conversation(conversation_id)
+    if conversation is None:
+        raise ValueError('Conversation not found')
+
+    parent_ids = data.get('parent_ids', [data.get('parent_id')])
+    model_ids = data.get('model_ids') or [conversation.model_id]
+    if not isinstance(parent_ids, list) or not parent_ids or not isinstance(model_ids, list):
+        raise ValueError('parent_ids and model_ids must be non-empty lists')
+    parent_ids = list(dict.fromkeys(parent_ids))
+    model_ids = list(dict.fromkeys(model_ids))
+    if len(parent_ids) * len(model_ids) > BATCH_MAX_BRANCHES:
+        raise ValueError(f'At most {BATCH_MAX_BRANCHES} branches per request')
+    for parent_id in parent_ids:
+        if parent_id is not None and not db.has_node(conversation_id, parent_id):
+            raise ValueError(f'Parent node not found: {parent_id}')
+
+    # 对话自己的模型用缓存的 agent，其他模型临时创建（模型客户端是共享的）
+    default_agent = agent_manager.get_or_create_agent(conversation_id)
+    agents = {}
+    for model_id in model_ids:
+        if model_id == conversation.model_id:
+            agents[model_id] = default_agent
+        else:
+            agents[model_id] = LangGraphAgent(
+                system_msg=conversation.system_msg,
+                config=_get_model_config(model_id),
+                cache=default_agent.cache
+            )
+
+    branches = []
+    for parent_id in parent_ids:
+        for model_id in model_ids:
+            question_node, answer_id = turn_nodes(conversation_id, parent_id, message)
+            branches.append({
+                'index': len(branches),
+                'parent_id': parent_id,
+                'model_id': model_id,
+                'agent': agents[model_id],
+                'question': question_node,
+                'answer_id': answer_id
+            })
+    return conversation, branches
+
+def batch_key(branches):
+    """批量请求在 TurnCoordinator 中的 parent_id：相同的分支组合视为相同请求"""
+    return ('batch',) + tuple((branch['parent_id'], branch['model_id']) for branch in branches)
+
+def batch_start(branches):
+    return {'branches': [
+        {
+            'index': branch['index'],
+            'parent_id': branch['parent_id'],
+            'model_id': branch['model_id'],
+            'question_id': branch['question'].id,
+            'answer_id': branch['answer_id']
+        }
+        for branch in branches
+    ]}
+
+def branch_done(branch, response):
+    """分支完成：返回 (待写入的一轮问答, 推送给客户端的结果)"""
+    question_node = branch['question']
+    answer = answer_node(question_node, branch['answer_id'], response.content, response.input_tokens,
+                         response.output_tokens, response.cached)
+    result = turn_result(question_node, answer, response)
+    result.update(index=branch['index'], parent_id=branch['parent_id'], model_id=branch['model_id'])
+    return (question_node, answer), result
+
+def batch_turns(done, message):
+    """按请求中的顺序排列已完成的分支；第一个根节点问题作为对话标题"""
+    turns = []
+    titled = False
+    for _, (question_node, answer) in sorted(done.items()):
+        title = None
+        if not titled and question_node.parent_id is None:
+            title = turn_title(None, message)
+            titled = True
+        turns.append((question_node, answer, title))
+    return turns
+
+def batch_events(result):
+    """合并的重复批量请求：返回执行的那一次的全部结果"""
+    yield sse_event('start', result['start'])
+    for branch in result['branches']:
+        yield sse_event('branch' if 'error' not in branch else 'branch_error', branch)
+    yield sse_event('done', {'saved': result['saved'], 'failed': result['failed']})
+
+def run_branch(branch, message):
+    agent = branch['agent']
+    conversation_id = branch['question'].conversation_id
+    return agent.step(message, turn_context(agent, conversation_id, branch['parent_id'], message))
+
+@app.route('/api/chat/batch', methods=['POST'])
+def chat_batch():
+    """批量分支：把同一个问题同时发往多个父节点和/或多个模型
+
+    模型调用在有界线程池中并发执行，每个分支完成时立即通过 SSE 推送（branch / branch_error 事件），
+    全部结束后所有问答节点作为并列分支在一个事务中写入，耗时约等于最慢的一次调用。
+    """
+    data = request.json
+    message = data.get('message', '')
+    try:
+        conversation, branches = batch_request(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
-        print(f"Error in chat for conversation {conversation_id}: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
+    conversation_id = conversation.id
+
+    def generate():
+        turn = turn_coordinator.begin(conversation_id, batch_key(branches), message)
+        if not turn.leader:
+            try:
+                yield from batch_events(turn.result())
+            except Exception as e:
+                yield sse_event('error', {'error': str(e)})
+            return
+
+        start = batch_start(branches)
+        done = {}
+        results = []
+        futures = {}
+        saved = False
+        error = None
+        try:
+            turn.wait_turn()
+            yield sse_event('start', start)
+            futures = {batch_pool.submit(run_branch, branch, message): branch for branch in branches}
+            for future in as_completed(futures):
+                branch = futures[future]
+                try:
+                    pair, result = branch_done(branch, future.result())
+                except Exception as e:
+                    logger.warning("Batch branch %d failed for conversation %s: %s", branch['index'], conversation_id, e)
+                    result = {'index': branch['index'], 'parent_id': branch['parent_id'],
+                              'model_id': branch['model_id'], 'error': str(e)}
+                else:
+                    done[branch['index']] = pair
+                results.append(result)
+                yield sse_event('branch' if 'error' not in result else 'branch_error', result)
+
+            db.save_turns(batch_turns(done, message))
+            saved = True
+            yield sse_event('done', {'saved': len(done), 'failed': len(branches) - len(done)})
+        except Exception as e:
+            error = e
+            logger.error("Error in chat batch for conversation %s: %s", conversation_id, e)
+            yield sse_event('error', {'error': str(e)})
+        finally:
+            # 客户端断开时取消尚未开始的分支，已完成的分支照常保存
+            for future in futures:
+                future.cancel()
+            try:
+                if not saved and done and error is None:
+                    db.save_turns(batch_turns(done, message))
+                    logger.info("Partial batch saved: %d branches", len(done))
+            except Exception as e:
+                logger.error("Failed to save partial batch for conversation %s: %s", conversation_id, e)
+            finally:
+                # 无论保存是否成功都要结束这一轮，否则同一对话后面的轮次会一直等待
+                if saved:
+                    turn.finish({'start': start, 'branches': results, 'saved': len(done),
+                                 'failed': len(branches) - len(done)})
+                else:
+                    turn.finish(error=error or RuntimeError('batch interrupted'))
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 @app.route('/api/reset', methods=['POST'])
 def reset_agent():
@@ -176,22 +889,23 @@ def reset_agent():
 # Conversation management endpoints
 @app.route('/api/conversations', methods=['GET'])
 def get_conversations():
-    """获取对话列表"""
+    """获取对话列表
+
+    查询参数: limit（默认 50，最大 200）、cursor（上一页返回的 next_cursor）、
+    fields（逗号分隔的字段名，默认不含 system_msg）
+    """
     try:
-        conversations = db.get_conversations()
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+        cursor = request.args.get('cursor') or None
+        fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()] or None
+        try:
+            conversations, next_cursor = db.get_conversations(limit=limit, cursor=cursor, fields=fields)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
         return jsonify({
             'success': True,
-            'conversations': [
-                {
-                    'id': conv.id,
-                    'title': conv.title,
-                    'system_msg': conv.system_msg,
-                    'model_id': conv.model_id,
-                    'created_at': conv.created_at,
-                    'updated_at': conv.updated_at
-                }
-                for conv in conversations
-            ]
+            'conversations': conversations,
+            'next_cursor': next_cursor
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -204,8 +918,21 @@ def get_conversation(conversation_id):
         if not conversation:
             return jsonify({'success': False, 'error': 'Conversation not found'}), 404
 
-        tree = db.get_conversation_tree(conversation_id)
-        return jsonify({
+        # 对话未变化时不构建、不序列化树
+        etag = tree_etag(conversation)
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
+        # 树可能已被之后的写入更新，ETag 和修订号以实际返回的树为准
+        snapshot = db.get_conversation_tree_snapshot(conversation_id, conversation.revision)
+        if snapshot is None:
+            return jsonify({'success': False, 'error': 'Conversation not found'}), 404
+        revision, tree_json = snapshot
+        if revision != conversation.revision:
+            conversation = replace(conversation, revision=revision)
+            etag = tree_etag(conversation)
+        return with_etag(conversation_response({
             'success': True,
             'conversation': {
                 'id': conversation.id,
@@ -214,9 +941,75 @@ def get_conversation(conversation_id):
                 'model_id': conversation.model_id,
                 'created_at': conversation.created_at,
                 'updated_at': conversation.updated_at,
-                'tree': tree
+                'revision': conversation.revision
             }
-        })
+        }, tree_json), etag)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/conversations/<conversation_id>/subtree/<node_id>', methods=['GET'])
+def get_subtree(conversation_id, node_id):
+    """获取以某节点为根的子树，depth 限制展开层数"""
+    try:
+        conversation = db.get_conversation(conversation_id)
+        if not conversation:
+            return jsonify({'success': False, 'error': 'Conversation not found'}), 404
+
+        depth = request.args.get('depth', type=int)
+        etag = tree_etag(conversation, node_id, depth)
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
+        subtree = db.get_subtree(conversation_id, node_id, max_depth=depth)
+        if subtree is None:
+            return jsonify({'success': False, 'error': 'Node not found'}), 404
+        return with_etag(jsonify({'success': True, 'tree': subtree}), etag)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/conversations/<conversation_id>/changes', methods=['GET'])
+def get_changes(conversation_id):
+    """获取 since 修订号之后新增或修改的节点"""
+    try:
+        since = request.args.get('since', 0, type=int)
+        changes = db.get_nodes_since(conversation_id, since)
+        if changes is None:
+            return jsonify({'success': False, 'error': 'Conversation not found'}), 404
+        return jsonify({'success': True, 'revision': changes['revision'], 'nodes': changes['nodes']})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/conversations/<conversation_id>/skeleton', methods=['GET'])
+def get_skeleton(conversation_id):
+    """获取树的骨架（内容只含预览），完整内容通过节点接口按需加载"""
+    try:
+        conversation = db.get_conversation(conversation_id)
+        if not conversation:
+            return jsonify({'success': False, 'error': 'Conversation not found'}), 404
+
+        preview = request.args.get('preview', 80, type=int)
+        etag = tree_etag(conversation, 'skeleton', preview)
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
+        tree = db.get_tree_skeleton(conversation_id, preview_chars=preview)
+        return with_etag(jsonify({'success': True, 'revision': conversation.revision, 'tree': tree}), etag)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/conversations/<conversation_id>/nodes/<node_id>', methods=['GET'])
+def get_node(conversation_id, node_id):
+    """获取单个节点的完整内容"""
+    try:
+        node = db.get_node(conversation_id, node_id)
+        if node is None:
+            return jsonify({'success': False, 'error': 'Node not found'}), 404
+        node_data = db._node_data(node)
+        del node_data['children']
+        node_data['parent_id'] = node.parent_id
+        return jsonify({'success': True, 'node': node_data})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -228,48 +1021,35 @@ def load_conversation(conversation_id):
         if not conversation:
             return jsonify({'success': False, 'error': 'Conversation not found'}), 404
 
-        # 重置或创建对应的agent
-        agent = agent_manager.reset_agent(conversation_id, conversation.system_msg, conversation.model_id)
-
-        # 恢复对话历史到agent
-        nodes = db.get_conversation_nodes(conversation_id)
-        print(f"Loading conversation {conversation_id} with {len(nodes)} nodes")
-        for node in nodes:
-            if node.node_type == 'question':
-                agent.history.append(HumanMessage(content=node.content))
-            elif node.node_type == 'answer':
-                agent.history.append(AIMessage(content=node.content))
+        # 重置或创建对应的agent（上下文在每轮对话时从节点树中按路径读取）
+        agent_manager.reset_agent(conversation_id, conversation.system_msg, conversation.model_id)
+        logger.debug("Loading conversation %s", conversation_id)
 
-        print(f"Agent history restored with {len(agent.history)} messages")
-
-        tree = db.get_conversation_tree(conversation_id)
-        return jsonify({
+        tree_json = db.get_conversation_tree_json(conversation_id, conversation.revision)
+        return conversation_response({
             'success': True,
             'message': 'Conversation loaded successfully',
             'conversation': {
                 'id': conversation.id,
                 'title': conversation.title,
                 'system_msg': conversation.system_msg,
-                'model_id': conversation.model_id,
-                'tree': tree
+                'model_id': conversation.model_id
             }
-        })
+        }, tree_json)
     except Exception as e:
-        print(f"Error loading conversation {conversation_id}: {str(e)}")
+        logger.error("Error loading conversation %s: %s", conversation_id, e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/conversations/<conversation_id>', methods=['DELETE'])
 def delete_conversation(conversation_id):
     """删除对话"""
     try:
-        print(f"收到删除对话请求: {conversation_id}")
         result = db.delete_conversation(conversation_id)
-        print(f"数据库删除结果: {result}")
 
         if result['success']:
             # 清理对应的agent
             agent_manager.remove_agent(conversation_id)
-            print(f"Agent removed for conversation {conversation_id}")
+            logger.info("删除对话 %s，%d 个节点", conversation_id, result.get('nodes_deleted', 0))
 
             return jsonify({
                 'success': True,
@@ -280,7 +1060,7 @@ def delete_conversation(conversation_id):
         else:
             return jsonify({'success': False, 'error': 'Conversation not found'}), 404
     except Exception as e:
-        print(f"删除对话时出错: {e}")
+        logger.error("删除对话时出错: %s", e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/conversations/<conversation_id>/title', methods=['PUT'])
@@ -300,6 +1080,21 @@ def update_conversation_title(conversation_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/conversations/<conversation_id>/response_cache', methods=['PUT'])
+def update_response_cache(conversation_id):
+    """开启或关闭对话的响应缓存"""
+    try:
+        data = request.json
+        enabled = bool(data.get('enabled', True))
+        if not db.set_response_cache(conversation_id, enabled):
+            return jsonify({'success': False, 'error': 'Conversation not found'}), 404
+
+        # 下次使用时按新设置重建agent
+        agent_manager.remove_agent(conversation_id)
+        return jsonify({'success': True, 'response_cache': enabled})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/conversations/search', methods=['GET'])
 def search_conversations():
     """搜索对话"""
@@ -318,7 +1113,8 @@ def search_conversations():
                     'system_msg': row[2],
                     'model_id': row[3],
                     'created_at': row[4],
-                    'updated_at': row[5]
+                    'updated_at': row[5],
+                    'snippet': row[6]
                 }
                 for row in results
             ]
@@ -326,6 +1122,16 @@ def search_conversations():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/schedulers', methods=['GET'])
+def get_schedulers():
+    """各提供方/模型调度器的排队深度、并发和限流情况"""
+    return jsonify({'success': True, 'schedulers': scheduler_stats()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus 文本格式的指标"""
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
 # Serve static files for React app
 @app.route('/static/<path:filename>')
 def serve_static(filename):
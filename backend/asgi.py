@@ -0,0 +1,285 @@
+"""
+Knode ASGI 入口
+
+对话接口（/api/chat、/api/chat/stream）以原生异步方式实现：模型调用走 ainvoke/astream，
+数据库访问通过线程池执行，等待上游模型时不占用线程。其余接口仍由 Flask 应用处理，
+以 WSGI 方式挂载。
+
+启动: uvicorn backend.asgi:app --port 5001   或   python main.py --asgi
+"""
+import asyncio
+import functools
+import time
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from backend.app import (app as flask_app, agent_manager, turn_coordinator, turn_title, turn_nodes,
+                         answer_node, turn_result, chat_payload, replay_events, sse_event,
+                         batch_request, batch_key, batch_start, branch_done, batch_turns, batch_events,
+                         BATCH_MAX_WORKERS, record_request, parent_error)
+from database.aio import AsyncDatabaseManager
+from database.database import db
+from monitoring.log import get_logger
+from monitoring.metrics import end_trace, start_trace
+
+logger = get_logger(__name__)
+
+adb = AsyncDatabaseManager(db)
+
+
+def traced(endpoint):
+    """与 Flask 的 before_request/after_request 相同：记录请求耗时和各 span 的汇总"""
+    @functools.wraps(endpoint)
+    async def wrapper(request):
+        token = start_trace()
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await endpoint(request)
+            status = response.status_code
+            return response
+        finally:
+            record_request(endpoint.__name__, request.method, request.url.path, status,
+                           time.perf_counter() - start, end_trace(token))
+    return wrapper
+
+
+async def turn_context(agent, conversation_id, parent_id, message):
+    """与 backend.app.turn_context 相同，但在线程池中读取祖先路径"""
+    if not parent_id:
+        return []
+    path = await adb.get_node_path(parent_id, token_budget=agent.context_budget(message),
+                                   conversation_id=conversation_id)
+    if not path:
+        raise LookupError(f'Parent node not found in conversation: {parent_id}')
+    return path
+
+
+async def chat_turn(conversation_id, parent_id, message):
+    """与 backend.app.chat_turn 相同，但模型调用和数据库访问不占用事件循环"""
+    # 未缓存时会同步读取对话，放到线程中执行
+    agent = await asyncio.to_thread(agent_manager.get_or_create_agent, conversation_id)
+    response = await agent.astep(message, await turn_context(agent, conversation_id, parent_id, message))
+
+    question_node, answer_id = turn_nodes(conversation_id, parent_id, message)
+    answer = answer_node(question_node, answer_id, response.content, response.input_tokens,
+                         response.output_tokens, response.cached)
+    # 客户端断开时请求会被取消，shield 保证写入完成
+    await asyncio.shield(adb.save_turn(question_node, answer, title=turn_title(parent_id, message)))
+    return turn_result(question_node, answer, response)
+
+
+async def chat(request):
+    data = await request.json()
+    message = data.get('message', '')
+    conversation_id = data.get('conversation_id')  # 必需的对话ID
+    parent_id = data.get('parent_id')
+
+    if not conversation_id:
+        return JSONResponse({'success': False, 'error': 'Conversation ID is required'}, status_code=400)
+    error = await asyncio.to_thread(parent_error, conversation_id, parent_id)
+    if error:
+        return JSONResponse({'success': False, 'error': error}, status_code=404)
+
+    try:
+        # 同一对话的轮次依次执行，相同的并发请求共用一次模型调用
+        result, _ = await turn_coordinator.arun(
+            conversation_id, parent_id, message,
+            lambda: chat_turn(conversation_id, parent_id, message)
+        )
+        return JSONResponse(chat_payload(result))
+    except Exception as e:
+        logger.error("Error in chat for conversation %s: %s", conversation_id, e)
+        return JSONResponse({'success': False, 'error': str(e)}, status_code=500)
+
+
+async def chat_stream(request):
+    data = await request.json()
+    message = data.get('message', '')
+    conversation_id = data.get('conversation_id')  # 必需的对话ID
+    parent_id = data.get('parent_id')
+
+    if not conversation_id:
+        return JSONResponse({'success': False, 'error': 'Conversation ID is required'}, status_code=400)
+    error = await asyncio.to_thread(parent_error, conversation_id, parent_id)
+    if error:
+        return JSONResponse({'success': False, 'error': error}, status_code=404)
+
+    try:
+        agent = await asyncio.to_thread(agent_manager.get_or_create_agent, conversation_id)
+    except Exception as e:
+        logger.error("Error in chat stream for conversation %s: %s", conversation_id, e)
+        return JSONResponse({'success': False, 'error': str(e)}, status_code=500)
+
+    question_node, answer_id = turn_nodes(conversation_id, parent_id, message)
+
+    async def save(content, input_tokens=None, output_tokens=None, cached=False):
+        answer = answer_node(question_node, answer_id, content, input_tokens, output_tokens, cached)
+        # 客户端断开时生成器会被取消，shield 保证写入完成
+        await asyncio.shield(adb.save_turn(question_node, answer, title=turn_title(parent_id, message)))
+        return answer
+
+    async def generate():
+        turn = turn_coordinator.begin(conversation_id, parent_id, message)
+        if not turn.leader:
+            try:
+                for event in replay_events(await turn.aresult()):
+                    yield event
+            except Exception as e:
+                yield sse_event('error', {'error': str(e)})
+            return
+
+        stream = None
+        result = None
+        error = None
+        try:
+            await turn.await_turn()
+            # 等前面的轮次写完再读取上下文
+            stream = agent.stream(message, await turn_context(agent, conversation_id, parent_id, message))
+            yield sse_event('start', {'question_id': question_node.id, 'answer_id': answer_id})
+            async for delta in stream:
+                yield sse_event('token', {'content': delta})
+
+            response = stream.response
+            answer = await save(response.content, response.input_tokens, response.output_tokens, response.cached)
+            result = turn_result(question_node, answer, response)
+            yield sse_event('done', {
+                'id': answer_id,
+                'question_id': question_node.id,
+                'input_tokens': response.input_tokens,
+                'output_tokens': response.output_tokens,
+                'cached': response.cached
+            })
+        except Exception as e:
+            error = e
+            logger.error("Error in chat stream for conversation %s: %s", conversation_id, e)
+            yield sse_event('error', {'error': str(e)})
+        finally:
+            try:
+                # 客户端断开或模型出错时保留已生成的部分回答
+                if result is None and stream is not None and stream.content:
+                    await save(stream.content)
+                    logger.info("Partial answer saved: %s", answer_id)
+            except Exception as e:
+                logger.error("Failed to save partial answer %s: %s", answer_id, e)
+            finally:
+                # 无论保存是否成功都要结束这一轮，否则同一对话后面的轮次会一直等待
+                if result is None:
+                    turn.finish(error=error or RuntimeError('stream interrupted'))
+                else:
+                    turn.finish(result)
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+async def chat_batch(request):
+    """与 backend.app.chat_batch 相同，分支以协程并发执行，并发数与线程池大小相同"""
+    data = await request.json()
+    message = data.get('message', '')
+    try:
+        conversation, branches = await asyncio.to_thread(batch_request, data)
+    except ValueError as e:
+        return JSONResponse({'success': False, 'error': str(e)}, status_code=400)
+    except Exception as e:
+        return JSONResponse({'success': False, 'error': str(e)}, status_code=500)
+    conversation_id = conversation.id
+    limit = asyncio.Semaphore(BATCH_MAX_WORKERS)
+
+    async def run_branch(branch):
+        async with limit:
+            agent = branch['agent']
+            response = await agent.astep(message, await turn_context(agent, conversation_id, branch['parent_id'], message))
+        return branch, response
+
+    async def save(done):
+        await asyncio.shield(adb.save_turns(batch_turns(done, message)))
+
+    async def generate():
+        turn = turn_coordinator.begin(conversation_id, batch_key(branches), message)
+        if not turn.leader:
+            try:
+                for event in batch_events(await turn.aresult()):
+                    yield event
+            except Exception as e:
+                yield sse_event('error', {'error': str(e)})
+            return
+
+        start = batch_start(branches)
+        done = {}
+        results = []
+        tasks = []
+        saved = False
+        error = None
+        try:
+            await turn.await_turn()
+            yield sse_event('start', start)
+            tasks = [asyncio.ensure_future(run_branch(branch)) for branch in branches]
+            pending = {task: branch for task, branch in zip(tasks, branches)}
+            while pending:
+                finished, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    branch = pending.pop(task)
+                    try:
+                        pair, result = branch_done(*task.result())
+                    except Exception as e:
+                        logger.warning("Batch branch %d failed for conversation %s: %s", branch['index'], conversation_id, e)
+                        result = {'index': branch['index'], 'parent_id': branch['parent_id'],
+                                  'model_id': branch['model_id'], 'error': str(e)}
+                    else:
+                        done[branch['index']] = pair
+                    results.append(result)
+                    yield sse_event('branch' if 'error' not in result else 'branch_error', result)
+
+            await save(done)
+            saved = True
+            yield sse_event('done', {'saved': len(done), 'failed': len(branches) - len(done)})
+        except Exception as e:
+            error = e
+            logger.error("Error in chat batch for conversation %s: %s", conversation_id, e)
+            yield sse_event('error', {'error': str(e)})
+        finally:
+            # 客户端断开时取消未完成的分支，已完成的分支照常保存
+            for task in tasks:
+                task.cancel()
+            try:
+                if not saved and done and error is None:
+                    await save(done)
+                    logger.info("Partial batch saved: %d branches", len(done))
+            except Exception as e:
+                logger.error("Failed to save partial batch for conversation %s: %s", conversation_id, e)
+            finally:
+                # 无论保存是否成功都要结束这一轮，否则同一对话后面的轮次会一直等待
+                if saved:
+                    turn.finish({'start': start, 'branches': results, 'saved': len(done),
+                                 'failed': len(branches) - len(done)})
+                else:
+                    turn.finish(error=error or RuntimeError('batch interrupted'))
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    adb.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/chat', traced(chat), methods=['POST']),
+        Route('/api/chat/stream', traced(chat_stream), methods=['POST']),
+        Route('/api/chat/batch', traced(chat_batch), methods=['POST']),
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan,
+)
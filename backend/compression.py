@@ -0,0 +1,153 @@
+"""
+HTTP 响应压缩
+
+按请求的 Accept-Encoding（含 q 值）在 COMPRESS_ENCODINGS 中协商编码，q 值相同时按配置的顺序优先；
+br 需要安装 brotli（pip install knode[fast]），未安装时自动跳过。只压缩不小于 COMPRESS_MIN_BYTES
+的 JSON / 文本响应，流式响应（SSE）和静态文件响应原样返回。
+
+带 ETag 的响应（对话树）的压缩结果按 (路径, ETag, 编码) 缓存，同一版本的树只压缩一次。
+"""
+import gzip
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from monitoring.metrics import span
+
+try:
+    import brotli
+except ImportError:  # 可选依赖，未安装时只使用 gzip
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = frozenset((
+    'application/json', 'application/javascript', 'text/javascript',
+    'text/html', 'text/css', 'text/plain',
+))
+
+
+def supported_encodings() -> Tuple[str, ...]:
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    """按编码压缩；gzip 的 level 为 1-9，br 的 level 为 quality 0-11"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    if encoding == 'gzip':
+        # mtime 固定为 0，相同内容的压缩结果相同
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+class Compressor:
+    """Flask after_request 中调用 process(response, request) 压缩响应体"""
+
+    def __init__(self, encodings: Iterable[str] = ('br', 'gzip'), min_bytes: int = 1024,
+                 gzip_level: int = 4, brotli_quality: int = 4, cache_bytes: int = 32 * 1024 * 1024):
+        supported = supported_encodings()
+        self.encodings = tuple(e for e in encodings if e in supported)
+        self.min_bytes = min_bytes
+        self.levels = {'gzip': gzip_level, 'br': brotli_quality}
+        self.cache_bytes = cache_bytes
+        self.responses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache: 'OrderedDict[tuple, bytes]' = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'Compressor':
+        encodings = os.environ.get('COMPRESS_ENCODINGS', 'br,gzip')
+        return cls(
+            encodings=[e.strip().lower() for e in encodings.split(',') if e.strip()],
+            min_bytes=int(os.environ.get('COMPRESS_MIN_BYTES', 1024)),
+            gzip_level=int(os.environ.get('COMPRESS_GZIP_LEVEL', 4)),
+            brotli_quality=int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4)),
+            cache_bytes=int(os.environ.get('COMPRESS_CACHE_BYTES', 32 * 1024 * 1024))
+        )
+
+    def negotiate(self, accept_encodings) -> Optional[str]:
+        """在支持的编码中选出客户端 q 值最高的一个，客户端都不接受时返回 None"""
+        best, best_quality = None, 0
+        for encoding in self.encodings:
+            quality = accept_encodings.quality(encoding)
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def process(self, response, request):
+        if response.status_code == 304 and self.encodings:
+            # 304 要带上 200 响应会有的 Vary，缓存才能按编码区分已保存的版本
+            response.vary.add('Accept-Encoding')
+            return response
+        if (not self.encodings or response.direct_passthrough or response.is_streamed
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES
+                or not 200 <= response.status_code < 300 or response.status_code in (204, 206)
+                or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+
+        encoding = self.negotiate(request.accept_encodings)
+        if encoding is None:
+            return response
+        data = response.get_data()
+        if len(data) < self.min_bytes:
+            return response
+
+        etag, _ = response.get_etag()
+        key = (request.full_path, etag, encoding) if etag else None
+        body = self._get(key) if key else None
+        if body is None:
+            with span('compress'):
+                body = compress(data, encoding, self.levels[encoding])
+            if key:
+                self._put(key, body)
+        if len(body) >= len(data):
+            return response
+
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        with self._lock:
+            self.responses += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(body)
+        return response
+
+    def _get(self, key: tuple) -> Optional[bytes]:
+        with self._lock:
+            body = self._cache.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def _put(self, key: tuple, body: bytes) -> None:
+        if len(body) > self.cache_bytes:
+            return
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self._cached_bytes -= len(old)
+            self._cache[key] = body
+            self._cached_bytes += len(body)
+            while self._cached_bytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'responses': self.responses,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'hits': self.hits,
+                'misses': self.misses,
+                'cache_entries': len(self._cache),
+                'cache_bytes': self._cached_bytes
+            }
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+agent 构建开销：每个对话各建一个 ChatOpenAI vs 共享模型客户端
+
+不发起任何网络请求，只测量构建时间和常驻内存。
+
+用法: python -m benchmarks.bench_agent_construction [--agents 1000]
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('ZHIPU_API_KEY', 'bench')
+os.environ.setdefault('ZHIPU_BASE_URL', '')
+
+from backend.Agents import langgraph_utils, LangGraphAgent, _get_model_config
+
+
+def build(count: int, shared: bool):
+    config = _get_model_config('glm-4.5-air')
+    langgraph_utils._models.clear()
+    original = langgraph_utils.get_model
+    if not shared:
+        # 旧行为：每个 agent 单独创建模型客户端
+        langgraph_utils.get_model = langgraph_utils.create_model
+
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    agents = [LangGraphAgent(system_msg='你是一个专业的知识助手', config=config) for _ in range(count)]
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    langgraph_utils.get_model = original
+    distinct = len({id(agent.model) for agent in agents})
+    return elapsed, current, distinct
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--agents', type=int, default=1000)
+    args = parser.parse_args()
+
+    for label, shared in (('per-agent', False), ('shared', True)):
+        elapsed, memory, distinct = build(args.agents, shared)
+        print(f"{label:>9}: {args.agents} agents in {elapsed * 1000:8.1f}ms "
+              f"({elapsed / args.agents * 1e6:7.1f}us each)  "
+              f"memory={memory / 1024 / 1024:6.1f}MiB  model clients={distinct}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+连接池 vs 每次调用单独连接的基准测试
+
+模拟 /api/chat 一轮的数据库访问（两次 save_node + 一次 update_conversation_title）
+以及列表/读取请求，分别在单线程和多线程下计时。
+
+用法: python -m benchmarks.bench_connection_pool [--turns 500] [--threads 8]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from database.database import DatabaseManager, ConversationNode
+
+
+def run_turn(db: DatabaseManager, conversation_id: str, parent_id):
+    question = ConversationNode(
+        id=str(uuid.uuid4()), parent_id=parent_id, conversation_id=conversation_id,
+        node_type='question', content='什么是知识图谱？' * 4
+    )
+    db.save_node(question)
+    answer = ConversationNode(
+        id=str(uuid.uuid4()), parent_id=question.id, conversation_id=conversation_id,
+        node_type='answer', content='知识图谱是一种结构化的语义网络。' * 40,
+        tokens_input=120, tokens_output=480
+    )
+    db.save_node(answer)
+    db.update_conversation_title(conversation_id, '基准测试')
+    db.get_conversation(conversation_id)
+    return answer.id
+
+
+def bench(pool_size: int, turns: int, threads: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'bench.db'), pool_size=pool_size)
+        conversation_ids = [db.create_conversation('基准测试', 'system', 'glm-4.5-air')
+                            for _ in range(max(threads, 1))]
+
+        latencies = []
+
+        def worker(index: int):
+            conversation_id = conversation_ids[index % len(conversation_ids)]
+            start = time.perf_counter()
+            run_turn(db, conversation_id, None)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        if threads <= 1:
+            for i in range(turns):
+                worker(i)
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(worker, range(turns)))
+        elapsed = time.perf_counter() - start
+        db.close()
+
+    latencies.sort()
+    return {
+        'turns_per_sec': turns / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--pool-size', type=int, default=8)
+    args = parser.parse_args()
+
+    for threads in (1, args.threads):
+        for label, pool_size in (('per-call', 0), ('pooled', args.pool_size)):
+            result = bench(pool_size, args.turns, threads)
+            print(f"{label:>9} threads={threads:<3} "
+                  f"{result['turns_per_sec']:8.1f} turns/s  "
+                  f"p50={result['p50_ms']:6.2f}ms  p99={result['p99_ms']:6.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
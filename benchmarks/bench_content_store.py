@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+节点内容存储（node_content）各编码方式的体积与读取耗时
+
+把合成数据库复制若干份，分别把全部节点内容重新编码为 raw / zlib / zstd（zstd 需要安装 zstandard），
+VACUUM 后记录文件和各表的大小，再在每份副本上测需要内容的查询（解码）和只读结构的查询。
+与内容内联在节点表中的旧版本比较时，在两个提交上分别运行 bench_database 并用 benchmarks.results 比较。
+
+合成内容由随机词组成，压缩率明显低于真实对话；用 --db 指向真实 knode.db 的副本可得到实际的体积。
+
+用法: python -m benchmarks.bench_content_store [--db bench.db] [--output results.json] [--repeat 20]
+                                               [--only zstd,get_node] [生成参数...]
+"""
+import argparse
+import itertools
+import os
+import sqlite3
+import sys
+import tempfile
+from contextlib import closing
+from typing import Dict
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from benchmarks import synthetic
+from benchmarks.bench_database import SAMPLE_CONVERSATIONS, copy_database, sample
+from benchmarks.results import Recorder
+from database.content import CODECS, ZSTD, decode_content, encode_content, zstd
+from database.database import DatabaseManager
+
+
+def reencode(path: str, codec: int) -> Dict:
+    """把 node_content 全部改为 codec 编码并 VACUUM，返回文件和各表的大小"""
+    with closing(sqlite3.connect(path, isolation_level=None)) as conn:
+        conn.create_function('reencode', 1, lambda data: encode_content(decode_content(data), codec)[1])
+        conn.execute('UPDATE node_content SET data = reencode(data)')
+        conn.execute('VACUUM')
+        sizes = {'bytes': os.path.getsize(path)}
+        try:
+            for name, size in conn.execute('''
+                SELECT name, SUM(pgsize) FROM dbstat
+                WHERE name IN ('conversation_nodes', 'node_content', 'node_fts_content', 'node_fts_data')
+                GROUP BY name
+            '''):
+                sizes[f'{name}_bytes'] = size
+        except sqlite3.OperationalError:
+            pass  # SQLite 未启用 dbstat
+        sizes['content_bytes'] = conn.execute('SELECT SUM(length(data)) FROM node_content').fetchone()[0]
+    return sizes
+
+
+def bench_codec(recorder: Recorder, name: str, path: str, samples: list, sizes: Dict):
+    db = DatabaseManager(path, tree_cache_bytes=0)
+    cycle = itertools.cycle(samples)
+    try:
+        recorder.run(f'{name}.get_conversation_nodes', lambda: db.get_conversation_nodes(next(cycle)['id']), **sizes)
+        recorder.run(f'{name}.get_conversation_tree_json', lambda: db.get_conversation_tree_json(next(cycle)['id']))
+        recorder.run(f'{name}.get_node', lambda: (lambda s: db.get_node(s['id'], s['middle']))(next(cycle)))
+        recorder.run(f'{name}.get_node_path', lambda: db.get_node_path(next(cycle)['leaf']))
+        recorder.run(f'{name}.get_tree_skeleton', lambda: db.get_tree_skeleton(next(cycle)['id']))
+        recorder.run(f'{name}.get_conversations', lambda: db.get_conversations(limit=50))
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='合成数据库路径，不存在时生成')
+    parser.add_argument('--output', help='结果 JSON 路径')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--only', help='逗号分隔，只运行名称包含其中任一项的基准')
+    synthetic.add_arguments(parser)
+    args = parser.parse_args()
+
+    recorder = Recorder('content_store', repeat=args.repeat, only=args.only.split(',') if args.only else None)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, 'bench.db')
+        dataset = synthetic.ensure(path, synthetic.from_arguments(args))
+        with closing(DatabaseManager(path, tree_cache_bytes=0)) as db:
+            samples = sample(db, SAMPLE_CONVERSATIONS, args.seed)
+
+        for name, codec in CODECS.items():
+            if codec == ZSTD and zstd is None:
+                print("zstandard is not installed, skipping zstd")
+                continue
+            copy = os.path.join(tmp, f'{name}.db')
+            copy_database(path, copy)
+            sizes = reencode(copy, codec)
+            print(f"{name}: {sizes['bytes'] / 1048576:.1f} MiB, node_content {sizes['content_bytes'] / 1048576:.1f} MiB")
+            dataset[f'{name}_sizes'] = sizes
+            bench_codec(recorder, name, copy, samples, sizes)
+        recorder.save(args.output, dataset)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+DatabaseManager 各方法的微基准
+
+读取类方法在合成数据库上运行，写入类方法在它的副本上运行（原库不变）。
+每次调用轮流使用一组固定的对话，结果以 JSON 写入 --output，
+可用 python -m benchmarks.results 比较两个提交的结果。
+
+--db 指定的数据库不存在时按生成参数创建（见 benchmarks.synthetic），
+不指定时在临时目录中生成。
+
+用法: python -m benchmarks.bench_database [--db bench.db] [--output results.json] [--repeat 20]
+                                          [--only search,tree] [生成参数...]
+"""
+import argparse
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import uuid
+from contextlib import closing
+from typing import Dict, List
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from benchmarks import synthetic
+from benchmarks.results import Recorder
+from database.database import DatabaseManager, ConversationNode
+
+SAMPLE_CONVERSATIONS = 16
+
+
+def sample(db: DatabaseManager, count: int, seed: int = 0) -> List[Dict]:
+    """挑选一组对话，并记下各自的根节点、最深的叶子和修订号"""
+    conversation_ids = []
+    cursor = None
+    while True:
+        page, cursor = db.get_conversations(limit=200, cursor=cursor, fields=['id'])
+        conversation_ids += [c['id'] for c in page]
+        if cursor is None:
+            break
+    rng = random.Random(seed)
+    picked = rng.sample(conversation_ids, min(count, len(conversation_ids)))
+
+    samples = []
+    for conversation_id in picked:
+        nodes = db.get_conversation_nodes(conversation_id)
+        by_id = {node.id: node for node in nodes}
+        depth = {}
+        for node in nodes:
+            depth[node.id] = depth.get(node.parent_id, 0) + 1 if node.parent_id in by_id else 1
+        leaf = max(nodes, key=lambda node: depth[node.id])
+        samples.append({
+            'id': conversation_id,
+            'root': next(node.id for node in nodes if node.parent_id is None),
+            'leaf': leaf.id,
+            'middle': nodes[len(nodes) // 2].id,
+            'revision': db.get_conversation(conversation_id).revision,
+        })
+    return samples
+
+
+def copy_database(source: str, target: str):
+    with closing(sqlite3.connect(source)) as src, closing(sqlite3.connect(target)) as dst:
+        src.backup(dst)
+
+
+def bench_reads(recorder: Recorder, path: str, samples: List[Dict]):
+    db = DatabaseManager(path, tree_cache_bytes=0)
+    cached = DatabaseManager(path)
+    cycle = itertools.cycle(samples)
+    _, middle_cursor = db.get_conversations(limit=100, fields=['id'])
+
+    try:
+        recorder.run('get_conversations', lambda: db.get_conversations(limit=50))
+        recorder.run('get_conversations.cursor', lambda: db.get_conversations(limit=50, cursor=middle_cursor))
+        recorder.run('get_conversations.fields', lambda: db.get_conversations(limit=50, fields=['id', 'title']))
+        recorder.run('get_conversation', lambda: db.get_conversation(next(cycle)['id']))
+        recorder.run('get_conversation_nodes', lambda: db.get_conversation_nodes(next(cycle)['id']))
+        recorder.run('get_node', lambda: (lambda s: db.get_node(s['id'], s['middle']))(next(cycle)))
+        recorder.run('get_node_path', lambda: db.get_node_path(next(cycle)['leaf']))
+        recorder.run('get_node_path.budget', lambda: db.get_node_path(next(cycle)['leaf'], token_budget=2000))
+        recorder.run('get_subtree', lambda: (lambda s: db.get_subtree(s['id'], s['root']))(next(cycle)))
+        recorder.run('get_subtree.depth2',
+                     lambda: (lambda s: db.get_subtree(s['id'], s['root'], max_depth=2))(next(cycle)))
+        recorder.run('get_nodes_since', lambda: db.get_nodes_since(next(cycle)['id'], 0))
+        recorder.run('get_tree_skeleton', lambda: db.get_tree_skeleton(next(cycle)['id']))
+        recorder.run('get_conversation_tree', lambda: db.get_conversation_tree(next(cycle)['id']))
+        recorder.run('get_conversation_tree_json.cold', lambda: db.get_conversation_tree_json(next(cycle)['id']))
+        recorder.run('get_conversation_tree_json.cached',
+                     lambda: (lambda s: cached.get_conversation_tree_json(s['id'], s['revision']))(next(cycle)),
+                     warmup=len(samples))
+        recorder.run('search_conversations.rare', lambda: db.search_conversations(synthetic.RARE))
+        recorder.run('search_conversations.common', lambda: db.search_conversations(synthetic.COMMON))
+        recorder.run('search_conversations.short', lambda: db.search_conversations(synthetic.VOCABULARY[42]))
+        recorder.run('search_conversations.latin', lambda: db.search_conversations('attention'))
+    finally:
+        db.close()
+        cached.close()
+
+
+def bench_writes(recorder: Recorder, path: str, samples: List[Dict], tmp: str):
+    copy = os.path.join(tmp, 'writes.db')
+    copy_database(path, copy)
+    db = DatabaseManager(copy)
+    cycle = itertools.cycle(samples)
+    content = synthetic.Generator(seed=1).text(400)
+
+    def turn(conversation_id, parent_id):
+        question = ConversationNode(id=str(uuid.uuid4()), parent_id=parent_id, conversation_id=conversation_id,
+                                    node_type='question', content=content[:100])
+        answer = ConversationNode(id=str(uuid.uuid4()), parent_id=question.id, conversation_id=conversation_id,
+                                  node_type='answer', content=content, tokens_input=500, tokens_output=400)
+        return question, answer
+
+    def save_turn():
+        s = next(cycle)
+        db.save_turn(*turn(s['id'], s['leaf']))
+
+    def batch():
+        s = next(cycle)
+        nodes = []
+        for _ in range(50):
+            nodes += turn(s['id'], s['leaf'])
+        return nodes
+
+    try:
+        recorder.run('create_conversation', lambda: db.create_conversation('基准测试', 'system', 'glm-4.5-air'))
+        recorder.run('save_turn', save_turn)
+        recorder.run('save_nodes.100', db.save_nodes, setup=batch)
+        recorder.run('update_conversation_title', lambda: db.update_conversation_title(next(cycle)['id'], '新标题'))
+        recorder.run('set_response_cache', lambda: db.set_response_cache(next(cycle)['id'], False))
+
+        # 每次删除一个不同的对话
+        victims = [c['id'] for c in db.get_conversations(limit=recorder.repeat, fields=['id'])[0]]
+        recorder.run('delete_conversation', db.delete_conversation, setup=iter(victims).__next__,
+                     repeat=len(victims), warmup=0)
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='合成数据库路径，不存在时生成')
+    parser.add_argument('--output', help='结果 JSON 路径')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--only', help='逗号分隔，只运行名称包含其中任一项的基准')
+    synthetic.add_arguments(parser)
+    args = parser.parse_args()
+
+    recorder = Recorder('database', repeat=args.repeat, only=args.only.split(',') if args.only else None)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, 'bench.db')
+        dataset = synthetic.ensure(path, synthetic.from_arguments(args))
+
+        with closing(DatabaseManager(path, tree_cache_bytes=0)) as db:
+            samples = sample(db, SAMPLE_CONVERSATIONS, args.seed)
+        bench_reads(recorder, path, samples)
+        bench_writes(recorder, path, samples, tmp)
+        recorder.save(args.output, dataset)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+/api/* 接口的端到端基准（Flask test client）
+
+在合成数据库的副本上运行，上游模型由桩模型代替（默认零延迟，只测本服务的开销），
+响应缓存关闭。每次请求都完整读取响应体（包括 SSE 流），结果以 JSON 写入 --output，
+可用 python -m benchmarks.results 比较两个提交的结果。
+
+--db 指定的数据库不存在时按生成参数创建（见 benchmarks.synthetic），
+不指定时在临时目录中生成。
+
+用法: python -m benchmarks.bench_endpoints [--db bench.db] [--output results.json] [--repeat 20]
+                                           [--latency 0] [--only chat,search] [生成参数...]
+"""
+import argparse
+import itertools
+import os
+import sys
+import tempfile
+from urllib.parse import quote
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+os.environ['RESPONSE_CACHE_MODE'] = 'off'
+from benchmarks import synthetic
+from benchmarks.bench_database import SAMPLE_CONVERSATIONS, copy_database, sample
+from benchmarks.results import Recorder
+from benchmarks.stub_model import install_stub_model
+from database.database import DatabaseManager
+
+
+def request(client, method: str, url: str, **kwargs):
+    response = client.open(url, method=method, **kwargs)
+    response.get_data()  # 流式响应在读取时才生成
+    assert response.status_code < 400, f"{method} {url}: {response.status_code} {response.get_data(as_text=True)[:200]}"
+    return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='合成数据库路径，不存在时生成')
+    parser.add_argument('--output', help='结果 JSON 路径')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0, help='桩模型每次调用的延迟（秒）')
+    parser.add_argument('--only', help='逗号分隔，只运行名称包含其中任一项的基准')
+    synthetic.add_arguments(parser)
+    args = parser.parse_args()
+
+    install_stub_model(args.latency)
+    from backend import app as app_module
+
+    recorder = Recorder('endpoints', repeat=args.repeat, only=args.only.split(',') if args.only else None)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, 'bench.db')
+        dataset = synthetic.ensure(path, synthetic.from_arguments(args))
+        dataset['model_latency'] = args.latency
+
+        copy = os.path.join(tmp, 'endpoints.db')
+        copy_database(path, copy)
+        bench_db = DatabaseManager(copy)
+        app_module.db = bench_db
+        samples = sample(bench_db, SAMPLE_CONVERSATIONS, args.seed)
+        cycle = itertools.cycle(samples)
+        counter = itertools.count()
+        client = app_module.app.test_client()
+        _, middle_cursor = bench_db.get_conversations(limit=100, fields=['id'])
+
+        def get(url):
+            return lambda: request(client, 'GET', url)
+
+        def per_conversation(method, template, **kwargs):
+            return lambda: (lambda s: request(client, method, template.format(**s), **kwargs))(next(cycle))
+
+        def chat(url):
+            def call():
+                s = next(cycle)
+                request(client, 'POST', url, json={
+                    'conversation_id': s['id'], 'parent_id': s['leaf'], 'message': f'基准问题 {next(counter)}'})
+            return call
+
+        def cold_conversation():
+            s = next(cycle)
+            bench_db.tree_cache.invalidate(s['id'])
+            return s['id']
+
+        try:
+            recorder.run('GET /api/conversations', get('/api/conversations'))
+            recorder.run('GET /api/conversations?cursor', get(f'/api/conversations?cursor={middle_cursor or ""}'))
+            recorder.run('GET /api/conversations/<id>.cold',
+                         lambda conversation_id: request(client, 'GET', f'/api/conversations/{conversation_id}'),
+                         setup=cold_conversation)
+            recorder.run('GET /api/conversations/<id>', per_conversation('GET', '/api/conversations/{id}'),
+                         warmup=len(samples))
+            recorder.run('GET /skeleton', per_conversation('GET', '/api/conversations/{id}/skeleton'))
+            recorder.run('GET /subtree', per_conversation('GET', '/api/conversations/{id}/subtree/{root}?depth=2'))
+            recorder.run('GET /nodes/<id>', per_conversation('GET', '/api/conversations/{id}/nodes/{middle}'))
+            recorder.run('GET /changes', per_conversation('GET', '/api/conversations/{id}/changes?since=0'))
+            recorder.run('GET /search.rare', get(f'/api/conversations/search?q={quote(synthetic.RARE)}'))
+            recorder.run('GET /search.common', get(f'/api/conversations/search?q={quote(synthetic.COMMON)}'))
+            recorder.run('POST /load', per_conversation('POST', '/api/conversations/{id}/load'))
+            recorder.run('POST /api/init', lambda: request(client, 'POST', '/api/init', json={}))
+            recorder.run('POST /api/chat', chat('/api/chat'))
+            recorder.run('POST /api/chat/stream', chat('/api/chat/stream'))
+            recorder.run('POST /api/chat/batch', lambda: (lambda s: request(client, 'POST', '/api/chat/batch', json={
+                'conversation_id': s['id'], 'parent_ids': [s['leaf'], s['middle']],
+                'message': f'基准问题 {next(counter)}'}))(next(cycle)))
+            recorder.run('PUT /title', per_conversation('PUT', '/api/conversations/{id}/title', json={'title': '新标题'}))
+            recorder.run('GET /metrics', get('/metrics'))
+
+            victims = [c['id'] for c in bench_db.get_conversations(limit=args.repeat, fields=['id'])[0]]
+            recorder.run('DELETE /api/conversations/<id>',
+                         lambda conversation_id: request(client, 'DELETE', f'/api/conversations/{conversation_id}'),
+                         setup=iter(victims).__next__, repeat=len(victims), warmup=0)
+        finally:
+            bench_db.close()
+        recorder.save(args.output, dataset)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+对话树响应的序列化与压缩基准
+
+- encode.*: 同一批对话树分别用原来的 jsonify 方式（json.dumps，ASCII 转义并排序键）、
+  逐节点拼接（encode_tree_json）和 orjson（已安装时）序列化，记录耗时和体积
+- compress.*: 最大一棵树的 JSON 在各压缩级别下的耗时和压缩后体积（br 需要安装 brotli）
+- GET *: 完整的对话接口，分别测不压缩、首次压缩、命中压缩缓存和 If-None-Match 命中（304）
+
+默认生成较大的树（每个对话 242 个节点，回答约 1500 字）。合成内容由随机词组成，
+压缩率低于真实对话；用 --db 指向真实的 knode.db 可得到实际的体积数据。
+
+用法: python -m benchmarks.bench_payload [--db bench.db] [--output results.json] [--repeat 20]
+                                         [--only encode,compress] [生成参数...]
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+from contextlib import closing
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+os.environ['RESPONSE_CACHE_MODE'] = 'off'
+from benchmarks import synthetic
+from benchmarks.bench_database import SAMPLE_CONVERSATIONS, sample
+from benchmarks.results import Recorder
+from backend.compression import compress, supported_encodings
+from database import serialization
+from database.database import DatabaseManager
+from database.tree import encode_tree_json, tree_to_dict
+
+LEVELS = {'gzip': (1, 4, 6, 9), 'br': (1, 4, 6, 11)}
+
+
+def bench_encode(recorder: Recorder, trees: list):
+    cycle = itertools.cycle(trees)
+    encoders = {
+        'jsonify': lambda roots: json.dumps(tree_to_dict(roots), separators=(',', ':'), sort_keys=True).encode(),
+        'encode_tree_json': encode_tree_json,
+        'json': lambda roots: serialization.get_encoder('json')(tree_to_dict(roots)),
+    }
+    if serialization.orjson is not None:
+        encoders['orjson'] = lambda roots: serialization.get_encoder('orjson')(tree_to_dict(roots))
+    for name, encode in encoders.items():
+        size = sum(len(encode(roots)) for roots in trees) // len(trees)
+        recorder.run(f'encode.{name}', lambda: encode(next(cycle)), mean_bytes=size)
+
+
+def bench_compress(recorder: Recorder, data: bytes):
+    for encoding in supported_encodings():
+        for level in LEVELS[encoding]:
+            size = len(compress(data, encoding, level))
+            recorder.run(f'compress.{encoding}.{level}', lambda: compress(data, encoding, level),
+                         bytes=size, ratio=round(size / len(data), 4))
+
+
+def bench_endpoint(recorder: Recorder, path: str, largest: str):
+    from backend import app as app_module
+
+    db = DatabaseManager(path)
+    app_module.db = db
+    client = app_module.app.test_client()
+    url = f'/api/conversations/{largest}'
+    encoding = supported_encodings()[0]
+
+    def get(**headers):
+        response = client.get(url, headers=headers)
+        response.get_data()
+        assert response.status_code in (200, 304), f"GET {url}: {response.status_code}"
+        return response
+
+    try:
+        etag = get().headers['ETag']
+        identity = get(**{'Accept-Encoding': 'identity'})
+        compressed = get(**{'Accept-Encoding': encoding})
+        recorder.run('GET /api/conversations/<id>.identity', lambda: get(**{'Accept-Encoding': 'identity'}),
+                     bytes=len(identity.get_data()))
+        recorder.run(f'GET /api/conversations/<id>.{encoding}.cold',
+                     lambda _: get(**{'Accept-Encoding': encoding}),
+                     setup=lambda: app_module.compressor._cache.clear(), bytes=len(compressed.get_data()))
+        recorder.run(f'GET /api/conversations/<id>.{encoding}.cached', lambda: get(**{'Accept-Encoding': encoding}))
+        recorder.run('GET /api/conversations/<id>.304', lambda: get(**{'If-None-Match': etag}), bytes=0)
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='合成数据库路径，不存在时生成')
+    parser.add_argument('--output', help='结果 JSON 路径')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--only', help='逗号分隔，只运行名称包含其中任一项的基准')
+    synthetic.add_arguments(parser)
+    parser.set_defaults(conversations=20, depth=5, content_chars=1500)
+    args = parser.parse_args()
+
+    recorder = Recorder('payload', repeat=args.repeat, only=args.only.split(',') if args.only else None)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, 'bench.db')
+        dataset = synthetic.ensure(path, synthetic.from_arguments(args))
+        dataset['json_encoder'] = serialization.ENCODER
+        dataset['encodings'] = list(supported_encodings())
+
+        with closing(DatabaseManager(path, tree_cache_bytes=0)) as db:
+            samples = sample(db, SAMPLE_CONVERSATIONS, args.seed)
+            trees = {s['id']: db._build_tree(s['id']).roots for s in samples}
+        largest = max(trees, key=lambda conversation_id: len(encode_tree_json(trees[conversation_id])))
+        dataset['largest_tree_bytes'] = len(encode_tree_json(trees[largest]))
+
+        bench_encode(recorder, list(trees.values()))
+        bench_compress(recorder, encode_tree_json(trees[largest]))
+        bench_endpoint(recorder, path, largest)
+        recorder.save(args.output, dataset)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+节点记录基准：旧的 @dataclass（__dict__ + __post_init__ + 关键字构造 + ISO 时间戳）
+vs slots 数据类按位置构造（starmap）+ 整数毫秒时间戳
+
+对相同的查询结果行分别测量构造耗时、常驻内存和按 created_at 排序的耗时，
+最后从真实数据库读取一次 get_conversation_nodes 作为端到端参考。
+
+用法: python -m benchmarks.bench_records [--rows 200000]
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import starmap
+from typing import Optional
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from database.database import DatabaseManager, ConversationNode, now_ms
+
+
+@dataclass
+class LegacyNode:
+    """改造前的 ConversationNode"""
+    id: str
+    parent_id: Optional[str]
+    conversation_id: str
+    node_type: str
+    content: str
+    tokens_input: Optional[int] = None
+    tokens_output: Optional[int] = None
+    created_at: str = None
+    content_tokens: Optional[int] = None
+    tokens_cached: bool = False
+    revision: int = 0
+
+    def __post_init__(self):
+        if self.created_at is None:
+            self.created_at = datetime.now().isoformat()
+
+
+def make_rows(count: int):
+    rng = random.Random(0)
+    conversation_id = str(uuid.uuid4())
+    start = now_ms()
+    rows = []
+    for i in range(count):
+        created = start + rng.randint(0, 10 ** 9)
+        rows.append((str(uuid.uuid4()), None, conversation_id, 'answer', '知识图谱是一种结构化的语义网络。' * 4,
+                     120, 480, created, 64, 0, i))
+    legacy_rows = [row[:7] + (datetime.fromtimestamp(row[7] / 1000).isoformat(),) + row[8:] for row in rows]
+    return rows, legacy_rows
+
+
+def legacy_build(rows):
+    return [
+        LegacyNode(
+            id=row[0], parent_id=row[1], conversation_id=row[2],
+            node_type=row[3], content=row[4], tokens_input=row[5],
+            tokens_output=row[6], created_at=row[7], tokens_cached=bool(row[9])
+        )
+        for row in rows
+    ]
+
+
+def slotted_build(rows):
+    return list(starmap(ConversationNode, rows))
+
+
+def measure(label: str, build, rows):
+    gc.collect()
+    start = time.perf_counter()
+    nodes = build(rows)
+    elapsed = time.perf_counter() - start
+    del nodes
+
+    gc.collect()
+    tracemalloc.start()
+    nodes = build(rows)
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    nodes.sort(key=lambda node: node.created_at)
+    sort_elapsed = time.perf_counter() - start
+
+    print(f"{label:>8}: build {elapsed * 1000:8.1f}ms ({elapsed / len(rows) * 1e6:5.2f}us/row)  "
+          f"records={memory / 1024 / 1024:6.1f}MiB  sort={sort_elapsed * 1000:6.1f}ms")
+
+
+def end_to_end(count: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'bench.db'), tree_cache_bytes=0)
+        conversation_id = db.create_conversation('基准测试', 'system', 'glm-4.5-air')
+        db.save_nodes(
+            ConversationNode(id=str(uuid.uuid4()), parent_id=None, conversation_id=conversation_id,
+                             node_type='answer', content='知识图谱是一种结构化的语义网络。' * 4)
+            for _ in range(count)
+        )
+        start = time.perf_counter()
+        nodes = db.get_conversation_nodes(conversation_id)
+        elapsed = time.perf_counter() - start
+        print(f"get_conversation_nodes: {len(nodes)} nodes in {elapsed * 1000:.1f}ms")
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000)
+    args = parser.parse_args()
+
+    rows, legacy_rows = make_rows(args.rows)
+    measure('legacy', legacy_build, legacy_rows)
+    measure('slotted', slotted_build, rows)
+    end_to_end(args.rows)
+
+
+if __name__ == '__main__':
+    main()
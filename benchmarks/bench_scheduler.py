@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+模型调用调度基准：旧的叠加重试（tenacity 3 次 × 客户端 max_retries=2）vs 按提供方共享的 ProviderScheduler
+
+用本地的假模型代替上游：它按自己的速率限制放行请求，超出时返回 429 和 retry-after-ms，
+不发起任何网络请求。多个线程同时发起调用，统计上游请求数、429 次数、失败数、总耗时和延迟分位数。
+时间按比例缩小（假模型每秒放行 --provider-rps 个请求），几秒内即可跑完。
+
+用法: python -m benchmarks.bench_scheduler [--workers 32] [--calls 10] [--provider-rps 100]
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+from tenacity import retry, stop_after_attempt, wait_exponential
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from backend.Agents.scheduler import ProviderScheduler
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, headers: dict):
+        self.status_code = status_code
+        self.headers = headers
+
+
+class FakeRateLimitError(Exception):
+    """与 openai.RateLimitError 一样带 status_code 和 response.headers"""
+    def __init__(self, retry_after: float):
+        super().__init__('429 Too Many Requests')
+        self.status_code = 429
+        self.response = FakeResponse(429, {'retry-after-ms': str(int(retry_after * 1000))})
+
+
+class FakeRateLimitedModel:
+    """每秒放行 rps 个请求（突发最多 burst 个）的假模型，超出时抛出 429"""
+    def __init__(self, rps: float, burst: int, latency: float):
+        self.rps = rps
+        self.burst = burst
+        self.latency = latency
+        self.level = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rejected = 0
+
+    def invoke(self, _messages=None) -> str:
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            self.level = min(self.burst, self.level + (now - self.updated) * self.rps)
+            self.updated = now
+            if self.level < 1:
+                self.rejected += 1
+                raise FakeRateLimitError((1 - self.level) / self.rps)
+            self.level -= 1
+        time.sleep(self.latency)
+        return 'ok'
+
+
+def legacy_call(model: FakeRateLimitedModel):
+    """改造前：tenacity 3 次，每次内部再由客户端重试 2 次（等待时间按比例缩小）"""
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=0.01, min=0.04, max=0.1))
+    def step():
+        for attempt in range(3):
+            try:
+                return model.invoke()
+            except FakeRateLimitError:
+                if attempt == 2:
+                    raise
+                time.sleep(0.005 * 2 ** attempt)
+    return step()
+
+
+def run(label: str, call, model: FakeRateLimitedModel, workers: int, calls: int, scheduler=None):
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(calls):
+            start = time.perf_counter()
+            try:
+                call()
+            except Exception:
+                with lock:
+                    failures[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0
+    print(f"{label:>18}: upstream={model.requests:5d}  429={model.rejected:5d}  failed={failures[0]:4d}  "
+          f"wall={elapsed:6.2f}s  p50={statistics.median(latencies or [0]) * 1000:7.1f}ms  p95={p95 * 1000:7.1f}ms")
+    if scheduler is not None:
+        stats = scheduler.stats()
+        print(f"{'':>18}  scheduler: limit={stats['limit']} scale={stats['scale']} "
+              f"rpm={stats['rpm']} learned={stats['rpm_learned']} retries={stats['retries']} throttled={stats['throttled']} wait={stats['wait_seconds']}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--calls', type=int, default=10)
+    parser.add_argument('--provider-rps', type=float, default=100)
+    parser.add_argument('--latency', type=float, default=0.02, help='fake model latency in seconds')
+    args = parser.parse_args()
+
+    print(f"workers={args.workers} calls={args.calls} provider limit={args.provider_rps}/s")
+    burst = max(1, int(args.provider_rps / 10))
+
+    model = FakeRateLimitedModel(args.provider_rps, burst, args.latency)
+    run('legacy', lambda: legacy_call(model), model, args.workers, args.calls)
+
+    # 不知道上游限额：只靠 429 自适应并发
+    model = FakeRateLimitedModel(args.provider_rps, burst, args.latency)
+    scheduler = ProviderScheduler('fake/adaptive', max_in_flight=args.workers, max_attempts=3,
+                                  base_delay=0.01, max_delay=1.0)
+    run('scheduler adaptive', lambda: scheduler.call(model.invoke), model, args.workers, args.calls, scheduler)
+
+    # 按上游限额配置 RPM
+    model = FakeRateLimitedModel(args.provider_rps, burst, args.latency)
+    scheduler = ProviderScheduler('fake/rpm', rpm=args.provider_rps * 60 * 0.95, max_in_flight=args.workers,
+                                  max_attempts=3, base_delay=0.01, max_delay=1.0)
+    scheduler.requests.capacity = scheduler.requests.level = burst
+    run('scheduler rpm', lambda: scheduler.call(model.invoke), model, args.workers, args.calls, scheduler)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+对话搜索基准：LIKE 全表扫描 vs FTS5 trigram 索引
+
+生成一个合成数据库（默认一百万个节点），分别用旧的 LIKE 查询和
+search_conversations 的 FTS5 路径执行若干查询并计时。
+
+用法: python -m benchmarks.bench_search [--nodes 1000000] [--nodes-per-conversation 50] [--db PATH]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from database.database import DatabaseManager, ConversationNode
+
+CHARS = ('的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而'
+         '方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它')
+VOCABULARY = [''.join(random.Random(i).sample(CHARS, 2)) for i in range(3000)] + [
+    'transformer', 'attention', 'database', 'latency', 'throughput', 'gradient', 'compiler']
+RARE = '薛定谔的猫'
+
+# 稀有短语、英文单词、常见的双词组合，以及走 LIKE 回退路径的两字查询
+QUERIES = [RARE, 'attention', VOCABULARY[7] + VOCABULARY[8][:1], VOCABULARY[42]]
+
+
+def random_text(rng: random.Random, words: int) -> str:
+    return ''.join(rng.choice(VOCABULARY) for _ in range(words))
+
+
+def generate(db: DatabaseManager, nodes: int, per_conversation: int, seed: int = 0):
+    rng = random.Random(seed)
+    batch = []
+    for i in range(0, nodes, per_conversation):
+        conversation_id = db.create_conversation(random_text(rng, 3), 'system', 'glm-4.5-air')
+        parent_id = None
+        for j in range(min(per_conversation, nodes - i)):
+            content = random_text(rng, 40)
+            if rng.random() < 0.0005:
+                content += RARE
+            if rng.random() < 0.01:
+                content += VOCABULARY[7] + VOCABULARY[8]
+            node = ConversationNode(
+                id=str(uuid.uuid4()), parent_id=parent_id, conversation_id=conversation_id,
+                node_type='question' if j % 2 == 0 else 'answer', content=content
+            )
+            parent_id = node.id
+            batch.append(node)
+        if len(batch) >= 10000:
+            db.save_nodes(batch)
+            batch = []
+    if batch:
+        db.save_nodes(batch)
+
+
+def timed(fn, repeat: int = 3):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, default=1_000_000)
+    parser.add_argument('--nodes-per-conversation', type=int, default=50)
+    parser.add_argument('--db', help='复用已有的合成数据库（不存在时生成）')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, 'search.db')
+        exists = os.path.exists(path)
+        db = DatabaseManager(path)
+        if not exists:
+            start = time.perf_counter()
+            generate(db, args.nodes, args.nodes_per_conversation)
+            print(f"generated {args.nodes} nodes in {time.perf_counter() - start:.1f}s")
+        print(f"database size: {os.path.getsize(path) / 1024 / 1024:.1f}MiB")
+
+        for query in QUERIES:
+            like_time, like_rows = timed(lambda: db._search_conversations_like(query, 20))
+            fts_time, fts_rows = timed(lambda: db.search_conversations(query, 20))
+            print(f"{query!r:>16}: LIKE {like_time * 1000:9.1f}ms ({len(like_rows):>2} rows)   "
+                  f"FTS5 {fts_time * 1000:8.1f}ms ({len(fts_rows):>2} rows)   "
+                  f"x{like_time / fts_time:6.1f}")
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
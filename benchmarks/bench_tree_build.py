@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+对话树构建基准：旧实现（ConversationNode → 字典 → 两次遍历 → json.dumps）
+vs 一次遍历的 build_tree + tree_to_json
+
+生成一个节点数很多的对话（默认 10 万个节点），分别测量构建+序列化耗时和内存峰值。
+bushy 形状的每轮问答随机接在之前的某个回答下；chain 形状是一条线性长对话，
+旧实现在序列化时会超出递归深度。
+
+用法: python -m benchmarks.bench_tree_build [--nodes 100000] [--shape bushy|chain|both]
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from database.database import DatabaseManager, ConversationNode
+
+
+def generate(db: DatabaseManager, nodes: int, shape: str, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    conversation_id = db.create_conversation('基准测试', 'system', 'glm-4.5-air')
+    answers = [None]
+    batch = []
+    for _ in range(nodes // 2):
+        parent_id = answers[-1] if shape == 'chain' else rng.choice(answers)
+        question = ConversationNode(
+            id=str(uuid.uuid4()), parent_id=parent_id, conversation_id=conversation_id,
+            node_type='question', content='什么是知识图谱？' * rng.randint(1, 4)
+        )
+        answer = ConversationNode(
+            id=str(uuid.uuid4()), parent_id=question.id, conversation_id=conversation_id,
+            node_type='answer', content='知识图谱是一种结构化的语义网络。' * rng.randint(2, 20),
+            tokens_input=120, tokens_output=480
+        )
+        answers.append(answer.id)
+        batch += (question, answer)
+        if len(batch) >= 10000:
+            db.save_nodes(batch)
+            batch = []
+    if batch:
+        db.save_nodes(batch)
+    return conversation_id
+
+
+def legacy(db: DatabaseManager, conversation_id: str) -> bytes:
+    """改造前的 get_conversation_tree，加上接口里的 JSON 序列化"""
+    nodes = db.get_conversation_nodes(conversation_id)
+    node_dict = {}
+    for node in nodes:
+        node_dict[node.id] = db._node_data(node)
+    root_nodes = []
+    for node in nodes:
+        node_data = node_dict[node.id]
+        if node.parent_id is None:
+            root_nodes.append(node_data)
+        elif node.parent_id in node_dict:
+            node_dict[node.parent_id]['children'].append(node_data)
+    tree = root_nodes[0] if len(root_nodes) == 1 else root_nodes
+    return json.dumps(tree, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def measure(fn, repeat: int):
+    gc.collect()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak, result
+
+
+def run(nodes: int, shape: str, repeat: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'bench.db'), tree_cache_bytes=0)
+        cached = DatabaseManager(os.path.join(tmp, 'bench.db'))
+        conversation_id = generate(db, nodes, shape)
+        revision = db.get_conversation(conversation_id).revision
+        print(f"shape={shape} nodes={nodes}")
+
+        cases = (
+            ('legacy', lambda: legacy(db, conversation_id)),
+            ('linear', lambda: db.get_conversation_tree_json(conversation_id)),
+            ('cached', lambda: cached.get_conversation_tree_json(conversation_id, revision)),
+        )
+        outputs = {}
+        for label, fn in cases:
+            try:
+                elapsed, peak, outputs[label] = measure(fn, repeat)
+            except RecursionError:
+                print(f"{label:>7}: RecursionError")
+                continue
+            print(f"{label:>7}: {elapsed * 1000:8.1f}ms  peak={peak / 1024 / 1024:7.1f}MiB")
+
+        if 'legacy' in outputs:
+            assert json.loads(outputs['legacy']) == json.loads(outputs['linear'])
+        assert outputs['linear'] == outputs['cached']
+        db.close()
+        cached.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, default=100000)
+    parser.add_argument('--shape', choices=('bushy', 'chain', 'both'), default='both')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for shape in (('bushy', 'chain') if args.shape == 'both' else (args.shape,)):
+        run(args.nodes, shape, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+同步（Flask + 固定线程数）与异步（ASGI）对话接口的并发压测
+
+上游模型由本地桩模型代替，每次调用固定延迟 --latency 秒；--provider simulated / replay
+改用离线模型提供方（延迟分布、分段输出和 429/超时注入由 SIMULATED_* 环境变量配置，
+回放数据见 REPLAY_*）。同步模式模拟
+gthread 类 WSGI 服务器：最多 --threads 个请求同时处理；异步模式把全部请求
+同时发给 ASGI 应用，由事件循环等待模型返回。
+
+用法: python -m benchmarks.load_test_async [--requests 200] [--latency 0.5] [--threads 16]
+                                          [--provider stub|simulated|replay]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from benchmarks.stub_model import install_stub_model
+
+
+def summarize(label, latencies, elapsed, errors=0):
+    latencies = sorted(latencies) or [0.0]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{label:>6}: {len(latencies)} requests in {elapsed:6.2f}s  "
+          f"{len(latencies) / elapsed:8.1f} req/s  "
+          f"p50={statistics.median(latencies) * 1000:7.1f}ms  p99={p99 * 1000:7.1f}ms  errors={errors}")
+
+
+def run_sync(flask_app, conversation_ids, threads):
+    latencies = []
+    errors = []
+
+    # 延迟从全部请求提交时开始计算，包含在线程池中排队的时间
+    def one(index):
+        client = flask_app.test_client()
+        response = client.post('/api/chat', json={
+            'message': f'问题 {index}',
+            'conversation_id': conversation_ids[index % len(conversation_ids)]
+        })
+        if response.status_code != 200:
+            errors.append(response.get_data(as_text=True))
+            return
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(one, range(len(conversation_ids))))
+    summarize('sync', latencies, time.perf_counter() - start, len(errors))
+
+
+async def run_async(asgi_app, conversation_ids):
+    import httpx
+
+    latencies = []
+    errors = []
+    transport = httpx.ASGITransport(app=asgi_app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://knode', timeout=None) as client:
+        async def one(index):
+            response = await client.post('/api/chat', json={
+                'message': f'问题 {index}',
+                'conversation_id': conversation_ids[index % len(conversation_ids)]
+            })
+            if response.status_code != 200:
+                errors.append(response.text)
+                return
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(len(conversation_ids))))
+    summarize('async', latencies, time.perf_counter() - start, len(errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.5)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--provider', choices=('stub', 'simulated', 'replay'), default='stub')
+    args = parser.parse_args()
+
+    if args.provider == 'stub':
+        install_stub_model(args.latency)
+    else:
+        # 所有模型都由离线提供方代替；--latency 作为模拟的首个 token 延迟（未单独配置时）
+        os.environ['MODEL_PROVIDER'] = args.provider
+        os.environ.setdefault('SIMULATED_TTFT_MS', str(args.latency * 1000))
+        os.environ.setdefault('RESPONSE_CACHE_MODE', 'off')
+
+    from backend import app as app_module
+    from backend import asgi
+    from database.aio import AsyncDatabaseManager
+    from database.database import DatabaseManager
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_db = DatabaseManager(os.path.join(tmp, 'load.db'))
+        app_module.db = bench_db
+        asgi.adb = AsyncDatabaseManager(bench_db)
+
+        conversation_ids = [bench_db.create_conversation('压测', 'system', 'glm-4.5-air')
+                            for _ in range(args.requests)]
+
+        print(f"model latency {args.latency}s, {args.requests} concurrent requests")
+        run_sync(app_module.app, conversation_ids, args.threads)
+        asyncio.run(run_async(asgi.app, conversation_ids))
+
+        asgi.adb.close()
+        bench_db.close()
+
+
+if __name__ == '__main__':
+    main()
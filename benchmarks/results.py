@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+基准结果的记录、保存与比较
+
+bench_database / bench_endpoints 用 Recorder 计时，结果写成 JSON，
+可以在两个提交之间比较：
+
+    python -m benchmarks.bench_database --db bench.db --output before.json
+    git checkout ...
+    python -m benchmarks.bench_database --db bench.db --output after.json
+    python -m benchmarks.results before.json after.json [--threshold 0.1]
+
+比较时按中位数计算变化，超过阈值的变慢项以非零状态退出，可用于 CI。
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+FORMAT_VERSION = 1
+
+
+def git_revision() -> Optional[str]:
+    """当前提交（工作区有改动时加 -dirty），不在 git 仓库中时为 None"""
+    root = os.path.join(os.path.dirname(__file__), '..')
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=root, capture_output=True,
+                              text=True, check=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def environment() -> Dict:
+    return {
+        'git': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def summarize(samples: List[float]) -> Dict:
+    """单位为秒的样本 -> 统计量（毫秒）"""
+    ordered = sorted(samples)
+    return {
+        'n': len(ordered),
+        'min_ms': round(ordered[0] * 1000, 4),
+        'median_ms': round(statistics.median(ordered) * 1000, 4),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 4),
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 4),
+    }
+
+
+class Recorder:
+    """按名称记录各基准的耗时样本
+
+    每个基准先运行 warmup 次（不计入），再运行 repeat 次；setup 在每次运行前调用
+    且不计时，返回值作为参数传给 fn。
+    """
+
+    def __init__(self, suite: str, repeat: int = 20, warmup: int = 2, only: Optional[List[str]] = None):
+        self.suite = suite
+        self.repeat = repeat
+        self.warmup = warmup
+        self.only = only
+        self.results: Dict[str, Dict] = {}
+
+    def wanted(self, name: str) -> bool:
+        return not self.only or any(pattern in name for pattern in self.only)
+
+    def run(self, name: str, fn: Callable, setup: Optional[Callable] = None,
+            repeat: Optional[int] = None, warmup: Optional[int] = None, **info) -> Optional[Dict]:
+        if not self.wanted(name):
+            return None
+        repeat = repeat or self.repeat
+        warmup = self.warmup if warmup is None else warmup
+        samples = []
+        gc.collect()
+        for i in range(warmup + repeat):
+            arg = setup() if setup is not None else None
+            start = time.perf_counter()
+            fn(arg) if setup is not None else fn()
+            elapsed = time.perf_counter() - start
+            if i >= warmup:
+                samples.append(elapsed)
+        result = summarize(samples)
+        result.update(info)
+        self.results[name] = result
+        print(f"{name:<44} median={result['median_ms']:10.3f}ms  p95={result['p95_ms']:10.3f}ms  "
+              f"min={result['min_ms']:10.3f}ms  n={result['n']}", flush=True)
+        return result
+
+    def report(self, dataset: Optional[Dict] = None) -> Dict:
+        return {
+            'format': FORMAT_VERSION,
+            'suite': self.suite,
+            'created_at': int(time.time()),
+            'environment': environment(),
+            'dataset': dataset or {},
+            'results': self.results,
+        }
+
+    def save(self, path: Optional[str], dataset: Optional[Dict] = None) -> Dict:
+        report = self.report(dataset)
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+                f.write('\n')
+            print(f"results written to {path}")
+        return report
+
+
+def compare(before: Dict, after: Dict, threshold: float) -> List[str]:
+    """打印两份结果的中位数变化，返回变慢超过 threshold（比例）的基准名"""
+    if before.get('dataset') != after.get('dataset'):
+        print("warning: datasets differ, timings may not be comparable")
+    regressions = []
+    old, new = before['results'], after['results']
+    print(f"{'benchmark':<44} {'before':>11} {'after':>11} {'change':>8}")
+    for name in sorted(set(old) | set(new)):
+        if name not in old or name not in new:
+            print(f"{name:<44} {'only in ' + ('before' if name in old else 'after'):>32}")
+            continue
+        a, b = old[name]['median_ms'], new[name]['median_ms']
+        change = (b - a) / a if a else 0.0
+        flag = ''
+        if change > threshold:
+            flag = '  slower'
+            regressions.append(name)
+        elif change < -threshold:
+            flag = '  faster'
+        print(f"{name:<44} {a:9.3f}ms {b:9.3f}ms {change * 100:+7.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=0.1, help='中位数变慢超过该比例时视为退化')
+    args = parser.parse_args()
+
+    with open(args.before, encoding='utf-8') as f:
+        before = json.load(f)
+    with open(args.after, encoding='utf-8') as f:
+        after = json.load(f)
+    regressions = compare(before, after, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold * 100:.0f}%")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
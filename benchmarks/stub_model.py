@@ -0,0 +1,53 @@
+"""
+本地桩模型：不访问网络，按固定延迟返回回答，用于压测和基准测试
+"""
+import asyncio
+import time
+from typing import Any, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+
+class StubChatModel(BaseChatModel):
+    latency: float = 0.5
+    reply: str = '这是一个来自桩模型的回答。'
+
+    @property
+    def _llm_type(self) -> str:
+        return 'knode-stub'
+
+    def _result(self, messages: List[BaseMessage]) -> ChatResult:
+        prompt_chars = sum(len(m.content) for m in messages if isinstance(m.content, str))
+        message = AIMessage(content=self.reply, usage_metadata={
+            'input_tokens': prompt_chars,
+            'output_tokens': len(self.reply),
+            'total_tokens': prompt_chars + len(self.reply),
+        })
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.latency)
+        return self._result(messages)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return self._result(messages)
+
+
+def install_stub_model(latency: float = 0.5) -> StubChatModel:
+    """让 LangGraphAgent 创建的模型全部替换为桩模型"""
+    import os
+    os.environ.setdefault('ZHIPU_API_KEY', 'stub')
+    os.environ.setdefault('ZHIPU_BASE_URL', '')
+    os.environ.setdefault('OPENAI_API_KEY', 'stub')
+    os.environ.setdefault('OPENAI_BASE_URL', '')
+
+    from backend.Agents import langgraph_utils
+    model = StubChatModel(latency=latency)
+    langgraph_utils.create_model = lambda config: model
+    langgraph_utils._models.clear()
+    return model
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+合成 knode.db 生成器
+
+按给定的对话数、树深度（每条路径上的问答轮数）、分支数（每个回答下的追问数）和
+内容长度生成对话树。相同参数和 --seed 生成的数据库内容完全相同（ID、内容、时间戳），
+不同提交上的基准结果可以直接比较。每个对话的节点数为 2 × (1 + b + b² + … + b^(depth-1))。
+
+内容由随机词组成；约 RARE_RATE 的节点含稀有短语 RARE，约 COMMON_RATE 的节点含
+常见短语 COMMON，供搜索基准使用。生成参数另存为 <db>.meta.json。
+
+用法: python -m benchmarks.synthetic --out bench.db [--conversations 200] [--depth 4] [--branching 3]
+                                     [--content-chars 400] [--seed 0] [--force]
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+import uuid
+from contextlib import closing
+from typing import Dict, Iterator, List, Optional
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from database.database import DatabaseManager, ConversationNode
+
+CHARS = ('的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而'
+         '方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它')
+VOCABULARY = [''.join(random.Random(i).sample(CHARS, 2)) for i in range(3000)] + [
+    'transformer', 'attention', 'database', 'latency', 'throughput', 'gradient', 'compiler']
+RARE = '薛定谔的猫'
+COMMON = '知识图谱'
+RARE_RATE = 0.001
+COMMON_RATE = 0.02
+
+# 固定的起始时间，保证时间戳可复现
+BASE_TIME_MS = 1_700_000_000_000
+
+
+class Generator:
+    def __init__(self, conversations: int = 200, depth: int = 4, branching: int = 3,
+                 content_chars: int = 400, seed: int = 0):
+        self.conversations = conversations
+        self.depth = depth
+        self.branching = branching
+        self.content_chars = content_chars
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+    @property
+    def nodes_per_conversation(self) -> int:
+        return 2 * sum(self.branching ** level for level in range(self.depth))
+
+    def params(self) -> Dict:
+        return {
+            'conversations': self.conversations,
+            'depth': self.depth,
+            'branching': self.branching,
+            'content_chars': self.content_chars,
+            'seed': self.seed,
+            'nodes': self.conversations * self.nodes_per_conversation,
+        }
+
+    def uuid(self) -> str:
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+    def text(self, chars: int) -> str:
+        rng = self.rng
+        words = []
+        length = 0
+        while length < chars:
+            word = rng.choice(VOCABULARY)
+            words.append(word)
+            length += len(word)
+        if rng.random() < RARE_RATE:
+            words.insert(rng.randrange(len(words) + 1), RARE)
+        if rng.random() < COMMON_RATE:
+            words.insert(rng.randrange(len(words) + 1), COMMON)
+        return ''.join(words)
+
+    def tree(self, conversation_id: str, created_at: int) -> List[ConversationNode]:
+        """一个对话的全部节点，父节点总在子节点之前，created_at 依次递增"""
+        nodes = []
+        level = [None]
+        for _ in range(self.depth):
+            next_level = []
+            for parent_id in level:
+                for _ in range(self.branching if parent_id is not None else 1):
+                    question = ConversationNode(
+                        id=self.uuid(), parent_id=parent_id, conversation_id=conversation_id,
+                        node_type='question', content=self.text(max(1, self.content_chars // 4)),
+                        created_at=created_at + len(nodes) * 1000
+                    )
+                    answer_chars = max(1, int(self.content_chars * self.rng.uniform(0.5, 1.5)))
+                    answer = ConversationNode(
+                        id=self.uuid(), parent_id=question.id, conversation_id=conversation_id,
+                        node_type='answer', content=self.text(answer_chars),
+                        tokens_input=self.rng.randint(50, 2000), tokens_output=answer_chars,
+                        created_at=created_at + len(nodes) * 1000 + 500
+                    )
+                    nodes += (question, answer)
+                    next_level.append(answer.id)
+            level = next_level
+        return nodes
+
+    def conversations_iter(self) -> Iterator[tuple]:
+        """(对话行, 节点列表)；对话的 updated_at 为最后一个节点的时间"""
+        for i in range(self.conversations):
+            conversation_id = self.uuid()
+            created_at = BASE_TIME_MS + i * 3_600_000
+            title = self.text(12)[:20]
+            nodes = self.tree(conversation_id, created_at)
+            row = (conversation_id, title, '你是一个专业的知识助手', 'glm-4.5-air',
+                   created_at, nodes[-1].created_at if nodes else created_at)
+            yield row, nodes
+
+    def write(self, path: str, batch_size: int = 20000) -> Dict:
+        db = DatabaseManager(path, tree_cache_bytes=0)
+        updated = []
+        rows = []
+        batch: List[ConversationNode] = []
+        try:
+            with closing(sqlite3.connect(path)) as conn:
+                def flush():
+                    # 对话 ID 固定，直接写入；节点通过 save_nodes 写入，与应用的写入路径一致
+                    with conn:
+                        conn.executemany('''
+                            INSERT INTO conversations (id, title, system_msg, model_id, created_at, updated_at)
+                            VALUES (?, ?, ?, ?, ?, ?)
+                        ''', rows)
+                    db.save_nodes(batch)
+                    rows.clear()
+                    batch.clear()
+
+                for row, nodes in self.conversations_iter():
+                    rows.append(row)
+                    updated.append((row[5], row[0]))
+                    batch.extend(nodes)
+                    if len(batch) >= batch_size:
+                        flush()
+                if rows:
+                    flush()
+                # save_nodes 把 updated_at 设为当前时间，改回可复现的值
+                with conn:
+                    conn.executemany('UPDATE conversations SET updated_at = ? WHERE id = ?', updated)
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        finally:
+            db.close()
+
+        params = self.params()
+        with open(meta_path(path), 'w', encoding='utf-8') as f:
+            json.dump(params, f, indent=2, sort_keys=True)
+        return params
+
+
+def meta_path(path: str) -> str:
+    return path + '.meta.json'
+
+
+def describe(path: str) -> Dict:
+    """数据库的生成参数（如有）和实际规模，写入基准结果供比较时核对"""
+    info = {}
+    if os.path.exists(meta_path(path)):
+        with open(meta_path(path), encoding='utf-8') as f:
+            info.update(json.load(f))
+    with closing(sqlite3.connect(f'file:{path}?mode=ro', uri=True)) as conn:
+        info['conversation_rows'] = conn.execute('SELECT COUNT(*) FROM conversations').fetchone()[0]
+        info['node_rows'] = conn.execute('SELECT COUNT(*) FROM conversation_nodes').fetchone()[0]
+        info['schema_version'] = conn.execute('PRAGMA user_version').fetchone()[0]
+    info['bytes'] = os.path.getsize(path)
+    return info
+
+
+def ensure(path: str, generator: Optional[Generator] = None) -> Dict:
+    """path 不存在时按 generator 的参数生成，返回 describe(path)"""
+    if not os.path.exists(path):
+        generator = generator or Generator()
+        start = time.perf_counter()
+        params = generator.write(path)
+        print(f"generated {path}: {params['conversations']} conversations, {params['nodes']} nodes "
+              f"in {time.perf_counter() - start:.1f}s")
+    return describe(path)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """生成参数，供各基准脚本在数据库不存在时使用"""
+    parser.add_argument('--conversations', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=4, help='每条路径上的问答轮数')
+    parser.add_argument('--branching', type=int, default=3, help='每个回答下的追问数')
+    parser.add_argument('--content-chars', type=int, default=400, help='回答的平均字符数（问题为其 1/4）')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def from_arguments(args) -> Generator:
+    return Generator(args.conversations, args.depth, args.branching, args.content_chars, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--force', action='store_true', help='覆盖已有的数据库')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    if os.path.exists(args.out):
+        if not args.force:
+            parser.error(f"{args.out} already exists, use --force to overwrite")
+        for suffix in ('', '-wal', '-shm', '.meta.json'):
+            if os.path.exists(args.out + suffix):
+                os.remove(args.out + suffix)
+
+    info = ensure(args.out, from_arguments(args))
+    print(json.dumps(info, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from .database import DatabaseManager
+
+
+class AsyncDatabaseManager:
+    """DatabaseManager 的异步包装
+
+    sqlite3 本身是阻塞的，这里把每次调用放到专用线程池中执行，
+    使事件循环不会被数据库 I/O 阻塞。线程数默认与连接池大小一致。
+    """
+
+    def __init__(self, db: DatabaseManager, max_workers: Optional[int] = None):
+        self.db = db
+        if max_workers is None:
+            max_workers = db.pool.max_size if db.pool is not None else 4
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='knode-db')
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+
+        return call
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
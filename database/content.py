@@ -0,0 +1,88 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import zlib
+from typing import Optional, Tuple
+
+try:
+    import zstandard as zstd
+except ImportError:  # 可选依赖，未安装时使用 zlib
+    zstd = None
+
+# node_content.data 的第一个字节为编码方式，其后是内容
+RAW = 0
+ZLIB = 1
+ZSTD = 2
+CODECS = {'raw': RAW, 'zlib': ZLIB, 'zstd': ZSTD}
+
+# 短于该字节数的内容压缩后通常不会更小，直接保存
+MIN_COMPRESS_BYTES = 64
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def resolve_codec(name: Optional[str] = None) -> int:
+    """解析编码方式（默认读取 NODE_CONTENT_CODEC）：auto 时有 zstd 用 zstd，否则 zlib"""
+    name = (name or os.environ.get('NODE_CONTENT_CODEC', 'auto')).lower()
+    if name == 'auto':
+        return ZSTD if zstd is not None else ZLIB
+    if name not in CODECS:
+        raise ValueError(f"Unknown node content codec: {name}, expected one of auto, {', '.join(CODECS)}")
+    if CODECS[name] == ZSTD and zstd is None:
+        raise ValueError("NODE_CONTENT_CODEC=zstd but zstandard is not installed")
+    return CODECS[name]
+
+
+CODEC = resolve_codec()
+
+# zstd 的压缩/解压上下文不是线程安全的，每个线程复用自己的一份（每次新建的开销与解压一个节点相当）
+_local = threading.local()
+
+
+def _zstd_context() -> threading.local:
+    if not hasattr(_local, 'compressor'):
+        _local.compressor = zstd.ZstdCompressor(level=ZSTD_LEVEL)
+        _local.decompressor = zstd.ZstdDecompressor()
+    return _local
+
+
+def content_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+
+def encode_content(text: str, codec: Optional[int] = None) -> Tuple[bytes, bytes]:
+    """返回 (内容哈希, 编码后的数据)；压缩后不更小时按原样保存"""
+    raw = text.encode('utf-8')
+    digest = hashlib.sha256(raw).digest()
+    codec = CODEC if codec is None else codec
+    if codec != RAW and len(raw) >= MIN_COMPRESS_BYTES:
+        if codec == ZSTD:
+            packed = _zstd_context().compressor.compress(raw)
+        else:
+            packed = zlib.compress(raw, ZLIB_LEVEL)
+        if len(packed) < len(raw):
+            return digest, bytes((codec,)) + packed
+    return digest, bytes((RAW,)) + raw
+
+
+def decode_content(data: Optional[bytes]) -> Optional[str]:
+    if data is None:
+        return None
+    codec = data[0]
+    if codec == RAW:
+        return data[1:].decode('utf-8')
+    if codec == ZLIB:
+        return zlib.decompress(data[1:]).decode('utf-8')
+    if codec == ZSTD:
+        if zstd is None:
+            raise ValueError("node content is zstd-compressed but zstandard is not installed")
+        return _zstd_context().decompressor.decompress(data[1:]).decode('utf-8')
+    raise ValueError(f"Unknown node content codec: {codec}")
+
+
+def register_functions(conn: sqlite3.Connection) -> None:
+    """注册读写 node_content 所需的 SQL 函数；每个连接（连接池、迁移）创建时调用"""
+    conn.create_function('decode_content', 1, decode_content, deterministic=True)
+    conn.create_function('content_hash', 1, content_hash, deterministic=True)
+    conn.create_function('encode_content', 1, lambda text: encode_content(text)[1], deterministic=True)
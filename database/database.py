@@ -1,11 +1,68 @@
 import sqlite3
 import uuid
 import os
-from datetime import datetime
-from typing import List, Dict, Optional
-from dataclasses import dataclass
-
-@dataclass
+import atexit
+import base64
+import json
+import time
+from contextlib import contextmanager, closing
+from itertools import starmap
+from typing import List, Dict, Optional, Iterable, Set, Sequence, Tuple
+from dataclasses import dataclass, field
+
+from monitoring.log import get_logger
+from monitoring.metrics import timed
+
+from .content import encode_content, register_functions
+from .migrations import PREVIEW_CHARS, MigrationRunner, SchemaError, table_exists
+from .pool import ConnectionPool
+from .tokens import estimate_tokens
+from .tree import TREE_COLUMNS, build_tree
+from .tree_cache import TreeCache, CachedTree
+from .write_behind import WriteBehindQueue
+
+logger = get_logger(__name__)
+
+
+def now_ms() -> int:
+    """当前时间，Unix 纪元毫秒数；数据库中的时间戳都以此格式保存"""
+    return time.time_ns() // 1_000_000
+
+
+# 对话列表可选的字段；统计字段由触发器随节点增删改维护
+CONVERSATION_FIELDS = (
+    'id', 'title', 'system_msg', 'model_id', 'created_at', 'updated_at',
+    'response_cache', 'revision', 'node_count', 'total_tokens', 'last_preview'
+)
+# 列表默认不返回 system_msg
+CONVERSATION_LIST_FIELDS = tuple(f for f in CONVERSATION_FIELDS if f != 'system_msg')
+
+
+def encode_cursor(updated_at: int, conversation_id: str) -> str:
+    """把分页位置编码为不透明的游标字符串"""
+    raw = json.dumps([updated_at, conversation_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[int, str]:
+    """解析游标，格式不正确时抛出 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        updated_at, conversation_id = json.loads(raw)
+    except Exception:
+        raise ValueError(f"invalid cursor: {cursor}")
+    if not isinstance(updated_at, int) or not isinstance(conversation_id, str):
+        raise ValueError(f"invalid cursor: {cursor}")
+    return updated_at, conversation_id
+
+# 与数据类字段顺序一致的列，查询结果可以直接 ConversationNode(*row) / Conversation(*row)
+# 节点内容压缩保存在 node_content 中，需要内容的查询 JOIN node_content b 并解码
+NODE_COLUMNS = ('n.id, n.parent_id, n.conversation_id, n.node_type, decode_content(b.data), n.tokens_input, '
+                'n.tokens_output, n.created_at, n.content_tokens, n.tokens_cached, n.revision')
+CONVERSATION_COLUMNS = 'id, title, system_msg, model_id, created_at, updated_at, response_cache, revision'
+
+
+@dataclass(slots=True)
 class ConversationNode:
     id: str
     parent_id: Optional[str]
@@ -14,272 +71,742 @@ class ConversationNode:
     content: str
     tokens_input: Optional[int] = None
     tokens_output: Optional[int] = None
-    created_at: str = None
+    created_at: int = field(default_factory=now_ms)  # 纪元毫秒
+    content_tokens: Optional[int] = None  # 写入时计算的内容 token 数，用于上下文预算
+    tokens_cached: bool = False  # 回答来自响应缓存，未实际调用模型；从数据库读出时为 0/1
+    revision: int = 0  # 写入时对话的修订号，用于增量拉取
 
-    def __post_init__(self):
-        if self.created_at is None:
-            self.created_at = datetime.now().isoformat()
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Conversation:
     id: str
     title: str
     system_msg: str
     model_id: str
-    created_at: str
-    updated_at: str
+    created_at: int  # 纪元毫秒
+    updated_at: int  # 纪元毫秒
+    response_cache: bool = True  # 是否允许使用响应缓存；从数据库读出时为 0/1
+    revision: int = 0  # 每次写入节点加一
 
-    def __post_init__(self):
-        if self.created_at is None:
-            self.created_at = datetime.now().isoformat()
-        if self.updated_at is None:
-            self.updated_at = datetime.now().isoformat()
 
 class DatabaseManager:
-    def __init__(self, db_path: str = os.path.join(os.path.dirname(__file__), "knode.db")):
+    def __init__(self, db_path: str = os.path.join(os.path.dirname(__file__), "knode.db"),
+                 pool_size: int = 8, tree_cache_bytes: int = 64 * 1024 * 1024, auto_migrate: bool = True):
         self.db_path = db_path
-        self.init_database()
-
-    def init_database(self):
-        """初始化数据库表结构"""
-        with sqlite3.connect(self.db_path) as conn:
-            # 启用外键约束
-            cursor = conn.cursor()
-            cursor.execute('PRAGMA foreign_keys = ON')
-
-            # 对话表
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id TEXT PRIMARY KEY,
-                    title TEXT NOT NULL,
-                    system_msg TEXT NOT NULL,
-                    model_id TEXT NOT NULL,
-                    created_at TEXT NOT NULL,
-                    updated_at TEXT NOT NULL
+        # pool_size=0 时退回到每次调用单独建立连接
+        self.pool = ConnectionPool(db_path, max_size=pool_size) if pool_size > 0 else None
+        # tree_cache_bytes=0 时不缓存对话树
+        self.tree_cache = TreeCache(tree_cache_bytes) if tree_cache_bytes > 0 else None
+        # 启用 write-behind 后 save_turn 只入队，由后台线程批量写入
+        self.write_behind: Optional[WriteBehindQueue] = None
+        self.init_database(auto_migrate)
+
+    @contextmanager
+    def _connection(self):
+        """获取数据库连接，退出时提交（异常时回滚）"""
+        if self.pool is not None:
+            with self.pool.connection() as conn:
+                yield conn
+        else:
+            with closing(sqlite3.connect(self.db_path)) as conn:
+                register_functions(conn)
+                with conn:
+                    yield conn
+
+    def close(self) -> None:
+        """写完 write-behind 队列中剩余的内容，然后关闭连接池"""
+        if self.write_behind is not None:
+            self.write_behind.close()
+        if self.pool is not None:
+            self.pool.close()
+
+    def enable_write_behind(self, max_pending: int = 1000, batch_size: int = 100,
+                            put_timeout: float = 10.0) -> WriteBehindQueue:
+        """启用 write-behind：问答写入进入后台队列，读取同一对话时会先等待其写入落库"""
+        if self.write_behind is None:
+            self.write_behind = WriteBehindQueue(self, max_pending=max_pending, batch_size=batch_size,
+                                                 put_timeout=put_timeout)
+        return self.write_behind
+
+    def _sync(self, conversation_id: Optional[str] = None, node_id: Optional[str] = None) -> None:
+        """write-behind 模式下等待相关写入落库（读自己的写入）；都不指定时等待此前的全部写入"""
+        if self.write_behind is not None:
+            self.write_behind.wait(conversation_id=conversation_id, node_id=node_id)
+
+    def init_database(self, auto_migrate: bool = True):
+        """检查数据库结构版本，需要时执行迁移（见 database/migrations.py）
+
+        结构已是最新时只读取 user_version，不执行任何 DDL。auto_migrate=False 时
+        有待处理的迁移会抛出 SchemaError，需要先运行 python -m database.migrations。
+        """
+        runner = MigrationRunner(self.db_path)
+        if auto_migrate:
+            runner.run()
+        else:
+            pending = runner.pending()
+            if pending:
+                raise SchemaError(
+                    f"database schema is at version {pending[0].version - 1}, {runner.latest} required; "
+                    f"run `python -m database.migrations`"
                 )
-            ''')
-
-            # 对话节点表
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS conversation_nodes (
-                    id TEXT PRIMARY KEY,
-                    parent_id TEXT,
-                    conversation_id TEXT NOT NULL,
-                    node_type TEXT NOT NULL CHECK (node_type IN ('question', 'answer')),
-                    content TEXT NOT NULL,
-                    tokens_input INTEGER,
-                    tokens_output INTEGER,
-                    created_at TEXT NOT NULL,
-                    FOREIGN KEY (parent_id) REFERENCES conversation_nodes (id),
-                    FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
-                )
-            ''')
-
-            # 创建索引
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_nodes_conversation
-                ON conversation_nodes (conversation_id)
-            ''')
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_nodes_parent
-                ON conversation_nodes (parent_id)
-            ''')
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_nodes_type
-                ON conversation_nodes (node_type)
-            ''')
 
-            conn.commit()
+        with self._connection() as conn:
+            # SQLite 不支持 FTS5/trigram 时迁移会跳过全文索引，搜索退回 LIKE
+            self.fts_enabled = table_exists(conn, 'node_fts')
 
-    def create_conversation(self, title: str, system_msg: str, model_id: str) -> str:
+    @timed('db_write')
+    def create_conversation(self, title: str, system_msg: str, model_id: str,
+                            response_cache: bool = True) -> str:
         """创建新对话"""
         conversation_id = str(uuid.uuid4())
-        now = datetime.now().isoformat()
+        now = now_ms()
 
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO conversations (id, title, system_msg, model_id, created_at, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (conversation_id, title, system_msg, model_id, now, now))
+                INSERT INTO conversations (id, title, system_msg, model_id, created_at, updated_at, response_cache)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (conversation_id, title, system_msg, model_id, now, now, int(response_cache)))
             conn.commit()
 
         return conversation_id
 
+    def _insert_nodes(self, cursor: sqlite3.Cursor, nodes: Iterable[ConversationNode]) -> Set[str]:
+        """在当前事务中写入节点，返回涉及的对话ID"""
+        nodes = list(nodes)
+        # 压缩在第一条写语句之前完成，不占用写锁
+        encoded = [encode_content(node.content) for node in nodes]
+
+        # 相同内容只存一份；INSERT 先取得写锁，之后的 SELECT 一定能看到已有的行
+        content_ids: Dict[bytes, int] = {}
+        for digest, data in encoded:
+            if digest in content_ids:
+                continue
+            cursor.execute('INSERT INTO node_content (hash, data) VALUES (?, ?) ON CONFLICT (hash) DO NOTHING',
+                           (digest, data))
+            if cursor.rowcount == 1:
+                content_ids[digest] = cursor.lastrowid
+            else:
+                cursor.execute('SELECT id FROM node_content WHERE hash = ?', (digest,))
+                content_ids[digest] = cursor.fetchone()[0]
+
+        conversation_ids = set()
+
+        def rows():
+            for node, (digest, _) in zip(nodes, encoded):
+                conversation_ids.add(node.conversation_id)
+                if node.content_tokens is None:
+                    node.content_tokens = estimate_tokens(node.content)
+                yield (
+                    node.id, node.parent_id, node.conversation_id, node.node_type,
+                    content_ids[digest], len(node.content), node.content[:PREVIEW_CHARS],
+                    node.tokens_input, node.tokens_output, node.created_at,
+                    node.content_tokens, int(node.tokens_cached), node.conversation_id
+                )
+
+        # 使用 upsert 而不是 INSERT OR REPLACE，覆盖写入时保留 rowid，内容引用计数随 UPDATE 触发器调整；
+        # 节点的 revision 为对话当前修订号 + 1，调用方在同一事务中随后把对话修订号加一
+        cursor.executemany('''
+            INSERT INTO conversation_nodes
+            (id, parent_id, conversation_id, node_type, content_id, content_length, preview,
+             tokens_input, tokens_output, created_at, content_tokens, tokens_cached, revision)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, (SELECT revision + 1 FROM conversations WHERE id = ?))
+            ON CONFLICT (id) DO UPDATE SET
+                parent_id = excluded.parent_id,
+                conversation_id = excluded.conversation_id,
+                node_type = excluded.node_type,
+                content_id = excluded.content_id,
+                content_length = excluded.content_length,
+                preview = excluded.preview,
+                tokens_input = excluded.tokens_input,
+                tokens_output = excluded.tokens_output,
+                created_at = excluded.created_at,
+                content_tokens = excluded.content_tokens,
+                tokens_cached = excluded.tokens_cached,
+                revision = excluded.revision
+        ''', rows())
+
+        # 全文索引保存明文，按节点的 rowid 写入（覆盖写入时替换原有的行）
+        if self.fts_enabled:
+            cursor.executemany('''
+                INSERT OR REPLACE INTO node_fts (rowid, content, conversation_id)
+                SELECT rowid, ?, conversation_id FROM conversation_nodes WHERE id = ?
+            ''', ((node.content, node.id) for node in nodes))
+        return conversation_ids
+
     def save_node(self, node: ConversationNode) -> None:
         """保存对话节点"""
-        with sqlite3.connect(self.db_path) as conn:
+        self.save_nodes([node])
+
+    @timed('db_write')
+    def save_nodes(self, nodes: Iterable[ConversationNode]) -> int:
+        """在一个事务中批量保存节点（用于导入、回放），返回写入的节点数"""
+        # 同步写入，排在 write-behind 队列中已有的写入之后
+        self._sync()
+        nodes = list(nodes)
+        with self._connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO conversation_nodes
-                (id, parent_id, conversation_id, node_type, content, tokens_input, tokens_output, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                node.id, node.parent_id, node.conversation_id, node.node_type,
-                node.content, node.tokens_input, node.tokens_output, node.created_at
-            ))
-            conn.commit()
-
-            # 更新对话的最后更新时间
-            cursor.execute('''
-                UPDATE conversations SET updated_at = ? WHERE id = ?
-            ''', (datetime.now().isoformat(), node.conversation_id))
-
-    def get_conversations(self, limit: int = 50) -> List[Conversation]:
-        """获取对话列表"""
-        with sqlite3.connect(self.db_path) as conn:
+            # upsert 对每个节点都写入一行；total_changes 还会计入全文索引、内容表和触发器的修改
+            conversation_ids = self._insert_nodes(cursor, nodes)
+
+            # 更新对话的最后更新时间和修订号
+            now = now_ms()
+            revisions = {}
+            for conversation_id in conversation_ids:
+                cursor.execute('''
+                    UPDATE conversations SET updated_at = ?, revision = revision + 1 WHERE id = ?
+                    RETURNING revision
+                ''', (now, conversation_id))
+                row = cursor.fetchone()
+                if row:
+                    revisions[conversation_id] = row[0]
+
+        for conversation_id, revision in revisions.items():
+            self._apply_to_tree_cache(conversation_id, revision,
+                                      [node for node in nodes if node.conversation_id == conversation_id])
+        return len(nodes)
+
+    def save_turn(self, question: ConversationNode, answer: ConversationNode,
+                  title: Optional[str] = None) -> None:
+        """在一个事务中保存一轮问答，并可同时更新对话标题
+
+        启用 write-behind 时只放入队列，队列满时阻塞（背压）。
+        """
+        if self.write_behind is not None:
+            self.write_behind.submit_turn(question, answer, title)
+        else:
+            self._write_turns([(question, answer, title)])
+
+    def save_turns(self, turns: List[Tuple[ConversationNode, ConversationNode, Optional[str]]]) -> None:
+        """在一个事务中保存多轮 (question, answer, title)，例如同一问题的多个并列分支"""
+        if not turns:
+            return
+        if self.write_behind is not None:
+            self.write_behind.submit_turns(list(turns))
+        else:
+            self._write_turns(list(turns))
+
+    @timed('db_write')
+    def _write_turns(self, turns: List[Tuple[ConversationNode, ConversationNode, Optional[str]]]) -> None:
+        """在一个事务中按顺序写入多轮问答，每轮把对话修订号加一"""
+        applied = []
+        with self._connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, title, system_msg, model_id, created_at, updated_at
-                FROM conversations
-                ORDER BY updated_at DESC
-                LIMIT ?
-            ''', (limit,))
-
-            rows = cursor.fetchall()
-            return [
-                Conversation(
-                    id=row[0], title=row[1], system_msg=row[2], model_id=row[3],
-                    created_at=row[4], updated_at=row[5]
-                )
-                for row in rows
-            ]
-
+            for question, answer, title in turns:
+                self._insert_nodes(cursor, (question, answer))
+
+                now = now_ms()
+                if title is not None:
+                    cursor.execute('''
+                        UPDATE conversations SET title = ?, updated_at = ?, revision = revision + 1 WHERE id = ?
+                        RETURNING revision
+                    ''', (title, now, question.conversation_id))
+                else:
+                    cursor.execute('''
+                        UPDATE conversations SET updated_at = ?, revision = revision + 1 WHERE id = ?
+                        RETURNING revision
+                    ''', (now, question.conversation_id))
+                row = cursor.fetchone()
+                if row:
+                    applied.append((question.conversation_id, row[0], (question, answer)))
+
+        for conversation_id, revision, nodes in applied:
+            self._apply_to_tree_cache(conversation_id, revision, nodes)
+
+    def _apply_to_tree_cache(self, conversation_id: str, revision: int,
+                             nodes: Iterable[ConversationNode]) -> None:
+        """事务提交后把新写入的节点同步到缓存的对话树"""
+        if self.tree_cache is not None:
+            self.tree_cache.apply(conversation_id, revision, nodes)
+
+    @timed('db_read')
+    def get_conversations(self, limit: int = 50, cursor: Optional[str] = None,
+                          fields: Optional[Sequence[str]] = None) -> Tuple[List[Dict], Optional[str]]:
+        """按更新时间倒序分页获取对话列表
+
+        使用 (updated_at, id) 游标分页，配合 idx_conversations_updated 索引，
+        每页的开销只与页大小有关。fields 指定返回的字段，默认不含 system_msg。
+        返回 (对话列表, 下一页游标)，没有下一页时游标为 None。
+        """
+        self._sync()
+        fields = list(fields) if fields else list(CONVERSATION_LIST_FIELDS)
+        unknown = [f for f in fields if f not in CONVERSATION_FIELDS]
+        if unknown:
+            raise ValueError(f"unknown conversation fields: {', '.join(unknown)}")
+
+        # 游标需要 updated_at 和 id，即使调用方没有请求
+        columns = list(dict.fromkeys(['updated_at', 'id'] + fields))
+        sql = f'SELECT {", ".join(columns)} FROM conversations'
+        params: list = []
+        if cursor:
+            sql += ' WHERE (updated_at, id) < (?, ?)'
+            params.extend(decode_cursor(cursor))
+        sql += ' ORDER BY updated_at DESC, id DESC LIMIT ?'
+        params.append(limit + 1)
+
+        with self._connection() as conn:
+            db_cursor = conn.cursor()
+            db_cursor.execute(sql, params)
+            rows = db_cursor.fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][0], rows[-1][1])
+
+        conversations = []
+        for row in rows:
+            record = dict(zip(columns, row))
+            if 'response_cache' in record:
+                record['response_cache'] = bool(record['response_cache'])
+            conversations.append({f: record[f] for f in fields})
+        return conversations, next_cursor
+
+    @timed('db_read')
     def get_conversation(self, conversation_id: str) -> Optional[Conversation]:
         """获取特定对话"""
-        with sqlite3.connect(self.db_path) as conn:
+        self._sync(conversation_id)
+        with self._connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, title, system_msg, model_id, created_at, updated_at
-                FROM conversations
-                WHERE id = ?
-            ''', (conversation_id,))
-
+            cursor.execute(f'SELECT {CONVERSATION_COLUMNS} FROM conversations WHERE id = ?', (conversation_id,))
             row = cursor.fetchone()
-            if row:
-                return Conversation(
-                    id=row[0], title=row[1], system_msg=row[2], model_id=row[3],
-                    created_at=row[4], updated_at=row[5]
-                )
-            return None
+            return Conversation(*row) if row else None
 
+    @timed('db_read')
     def get_conversation_nodes(self, conversation_id: str) -> List[ConversationNode]:
         """获取对话的所有节点"""
-        with sqlite3.connect(self.db_path) as conn:
+        self._sync(conversation_id)
+        with self._connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, parent_id, conversation_id, node_type, content, tokens_input, tokens_output, created_at
-                FROM conversation_nodes
-                WHERE conversation_id = ?
-                ORDER BY created_at ASC
+            cursor.execute(f'''
+                SELECT {NODE_COLUMNS}
+                FROM conversation_nodes n
+                JOIN node_content b ON b.id = n.content_id
+                WHERE n.conversation_id = ?
+                ORDER BY n.created_at, n.rowid
             ''', (conversation_id,))
+            # 列顺序与字段一致，按位置构造，省去逐字段的关键字参数
+            return list(starmap(ConversationNode, cursor))
+
+    @timed('db_read')
+    def get_node_path(self, node_id: str, max_depth: Optional[int] = None,
+                      token_budget: Optional[int] = None,
+                      conversation_id: Optional[str] = None) -> List[ConversationNode]:
+        """获取从根节点到指定节点的路径（含该节点），按根到叶排序
+
+        通过递归 CTE 沿 parent_id 逐级按主键查找，只读取 O(深度) 行。
+        max_depth 限制最多返回离该节点最近的多少个节点；token_budget 按写入时
+        记录的 content_tokens 从该节点向上累加，超出预算的更早节点被丢弃。
+        指定 conversation_id 时只沿该对话中的节点查找，节点不属于该对话时返回空列表。
+        """
+        self._sync(conversation_id, node_id=node_id)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            # 递归部分只沿结构向上查找，最后只为返回的节点读取并解码内容
+            cursor.execute('''
+                WITH RECURSIVE ancestors (id, parent_id, depth, total_tokens) AS (
+                    SELECT id, parent_id, 0, COALESCE(content_tokens, 0)
+                    FROM conversation_nodes
+                    WHERE id = :node_id AND (:conversation_id IS NULL OR conversation_id = :conversation_id)
+                    UNION ALL
+                    SELECT n.id, n.parent_id, a.depth + 1, a.total_tokens + COALESCE(n.content_tokens, 0)
+                    FROM conversation_nodes n
+                    JOIN ancestors a ON n.id = a.parent_id
+                    WHERE (:conversation_id IS NULL OR n.conversation_id = :conversation_id)
+                      AND (:max_depth IS NULL OR a.depth + 1 < :max_depth)
+                      AND (:budget IS NULL OR a.total_tokens + COALESCE(n.content_tokens, 0) <= :budget)
+                )
+                SELECT n.id, n.parent_id, n.conversation_id, n.node_type, decode_content(b.data),
+                       n.tokens_input, n.tokens_output, n.created_at, n.content_tokens
+                FROM ancestors a
+                JOIN conversation_nodes n ON n.id = a.id
+                JOIN node_content b ON b.id = n.content_id
+                WHERE :budget IS NULL OR a.total_tokens <= :budget
+                ORDER BY a.depth DESC
+            ''', {'node_id': node_id, 'conversation_id': conversation_id, 'max_depth': max_depth,
+                  'budget': token_budget})
 
             rows = cursor.fetchall()
             return [
                 ConversationNode(
                     id=row[0], parent_id=row[1], conversation_id=row[2],
                     node_type=row[3], content=row[4], tokens_input=row[5],
-                    tokens_output=row[6], created_at=row[7]
+                    tokens_output=row[6], created_at=row[7], content_tokens=row[8]
                 )
                 for row in rows
             ]
 
+    @timed('db_write')
     def delete_conversation(self, conversation_id: str) -> bool:
         """删除对话"""
-        print(f"开始删除对话: {conversation_id}")
-        with sqlite3.connect(self.db_path) as conn:
+        self._sync(conversation_id)
+        with self._connection() as conn:
             cursor = conn.cursor()
 
             # 先检查对话是否存在
             cursor.execute('SELECT id FROM conversations WHERE id = ?', (conversation_id,))
             conversation_exists = cursor.fetchone()
             if not conversation_exists:
-                print(f"对话 {conversation_id} 不存在")
+                logger.info("对话 %s 不存在", conversation_id)
                 return {'success': False, 'nodes_deleted': 0, 'conversation_deleted': False}
 
-            # 检查有多少个节点
-            cursor.execute('SELECT COUNT(*) FROM conversation_nodes WHERE conversation_id = ?', (conversation_id,))
-            nodes_count = cursor.fetchone()[0]
-            print(f"对话 {conversation_id} 有 {nodes_count} 个节点")
-
             # 手动删除相关的节点（更可靠的方式）
             cursor.execute('DELETE FROM conversation_nodes WHERE conversation_id = ?', (conversation_id,))
             nodes_deleted = cursor.rowcount
-            print(f"删除了 {nodes_deleted} 个节点")
 
             # 删除对话
             cursor.execute('DELETE FROM conversations WHERE id = ?', (conversation_id,))
             conversation_deleted = cursor.rowcount > 0
-            print(f"删除对话结果: {conversation_deleted}")
+            logger.debug("删除对话 %s: %s，删除了 %d 个节点", conversation_id, conversation_deleted, nodes_deleted)
 
             conn.commit()
+            if self.tree_cache is not None:
+                self.tree_cache.invalidate(conversation_id)
             return {
                 'success': conversation_deleted,
                 'nodes_deleted': nodes_deleted,
                 'conversation_deleted': conversation_deleted
             }
 
+    @timed('db_write')
     def update_conversation_title(self, conversation_id: str, title: str) -> bool:
         """更新对话标题"""
-        with sqlite3.connect(self.db_path) as conn:
+        self._sync(conversation_id)
+        with self._connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE conversations
                 SET title = ?, updated_at = ?
                 WHERE id = ?
-            ''', (title, datetime.now().isoformat(), conversation_id))
+            ''', (title, now_ms(), conversation_id))
             conn.commit()
+            if self.tree_cache is not None:
+                self.tree_cache.invalidate(conversation_id)
+            return cursor.rowcount > 0
+
+    @timed('db_write')
+    def set_response_cache(self, conversation_id: str, enabled: bool) -> bool:
+        """开启或关闭对话的响应缓存"""
+        self._sync(conversation_id)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE conversations SET response_cache = ? WHERE id = ?
+            ''', (int(enabled), conversation_id))
             return cursor.rowcount > 0
 
-    def get_conversation_tree(self, conversation_id: str) -> Optional[Dict]:
-        """获取对话的树形结构"""
-        nodes = self.get_conversation_nodes(conversation_id)
-        if not nodes:
+    @staticmethod
+    def _node_data(node: ConversationNode) -> Dict:
+        """节点转为接口返回的字典"""
+        node_data = {
+            'id': node.id,
+            'type': node.node_type,
+            'content': node.content,
+            'children': []
+        }
+        if node.tokens_input is not None and node.tokens_output is not None:
+            node_data['tokens'] = {
+                'input': node.tokens_input,
+                'output': node.tokens_output
+            }
+            if node.tokens_cached:
+                node_data['tokens']['cached'] = True
+        return node_data
+
+    def get_conversation_tree(self, conversation_id: str, revision: Optional[int] = None) -> Optional[Dict]:
+        """获取对话的树形结构
+
+        revision 为调用方已读到的对话修订号，缓存中有该版本时直接返回，不查询数据库。
+        """
+        self._sync(conversation_id)
+        if self.tree_cache is not None and revision is not None:
+            entry = self.tree_cache.get(conversation_id, revision)
+            if entry is not None:
+                return self.tree_cache.to_dict(entry)
+        entry = self._build_tree(conversation_id)
+        if entry is None:
+            return None
+        if self.tree_cache is not None:
+            return self.tree_cache.to_dict(entry)
+        return entry.tree()
+
+    def get_conversation_tree_json(self, conversation_id: str, revision: Optional[int] = None) -> Optional[bytes]:
+        """获取对话树序列化后的 JSON（UTF-8），缓存命中时不查库也不重新序列化"""
+        snapshot = self.get_conversation_tree_snapshot(conversation_id, revision)
+        return snapshot[1] if snapshot is not None else None
+
+    def get_conversation_tree_snapshot(self, conversation_id: str,
+                                       revision: Optional[int] = None) -> Optional[Tuple[int, bytes]]:
+        """获取对话树的 (修订号, JSON)，修订号与树来自同一次读取
+
+        调用方读到的 revision 在此期间可能已被新的写入超过，需要按树的实际版本生成 ETag 等。
+        """
+        self._sync(conversation_id)
+        if self.tree_cache is not None and revision is not None:
+            data = self.tree_cache.get_json(conversation_id, revision)
+            if data is not None:
+                return revision, data
+        entry = self._build_tree(conversation_id)
+        if entry is None:
             return None
+        if self.tree_cache is not None:
+            return self.tree_cache.serialize(conversation_id, entry)
+        return entry.revision, entry.to_json()
+
+    @timed('tree_build')
+    def _build_tree(self, conversation_id: str) -> Optional[CachedTree]:
+        """从数据库构建对话树并放入缓存，对话不存在时返回 None"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            # 修订号与节点在同一个读事务中读取，保证缓存的版本与内容一致
+            cursor.execute('BEGIN')
+            cursor.execute('SELECT revision FROM conversations WHERE id = ?', (conversation_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            revision = row[0]
+            # rowid 作为同一时间戳节点的次序，保证兄弟节点顺序稳定
+            cursor.execute(f'''
+                SELECT {TREE_COLUMNS}
+                FROM conversation_nodes n
+                JOIN node_content b ON b.id = n.content_id
+                WHERE n.conversation_id = ?
+                ORDER BY n.created_at, n.rowid
+            ''', (conversation_id,))
+            tree = build_tree(cursor)
+
+        if tree.orphans:
+            logger.warning("对话 %s 有 %d 个孤立节点: %s", conversation_id, len(tree.orphans),
+                           ', '.join(node.id for node in tree.orphans[:10]))
+        if self.tree_cache is not None:
+            return self.tree_cache.put(conversation_id, revision, tree)
+        return CachedTree(revision, tree)
+
+    @timed('db_read')
+    def get_node(self, conversation_id: str, node_id: str) -> Optional[ConversationNode]:
+        """获取单个节点（含完整内容）"""
+        self._sync(conversation_id)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT {NODE_COLUMNS}
+                FROM conversation_nodes n
+                JOIN node_content b ON b.id = n.content_id
+                WHERE n.id = ? AND n.conversation_id = ?
+            ''', (node_id, conversation_id))
+            row = cursor.fetchone()
+            return ConversationNode(*row) if row else None
+
+    @timed('db_read')
+    def has_node(self, conversation_id: str, node_id: str) -> bool:
+        """节点是否存在且属于该对话（不读取内容）"""
+        self._sync(conversation_id)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM conversation_nodes WHERE id = ? AND conversation_id = ?',
+                           (node_id, conversation_id))
+            return cursor.fetchone() is not None
+
+    @timed('db_read')
+    def get_subtree(self, conversation_id: str, node_id: str, max_depth: Optional[int] = None) -> Optional[Dict]:
+        """获取以 node_id 为根的子树，max_depth 限制向下展开的层数
+
+        沿 parent_id 索引逐层向下查找；停在深度上限且还有子节点的节点标记 'truncated': True。
+        """
+        self._sync(conversation_id)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                WITH RECURSIVE subtree (id, depth) AS (
+                    SELECT id, 0 FROM conversation_nodes WHERE id = :node_id AND conversation_id = :conversation_id
+                    UNION ALL
+                    SELECT n.id, s.depth + 1
+                    FROM conversation_nodes n
+                    JOIN subtree s ON n.parent_id = s.id
+                    WHERE :max_depth IS NULL OR s.depth < :max_depth
+                )
+                SELECT n.id, n.parent_id, n.conversation_id, n.node_type, decode_content(b.data), n.tokens_input,
+                       n.tokens_output, n.created_at, n.tokens_cached,
+                       s.depth = :max_depth AND EXISTS (
+                           SELECT 1 FROM conversation_nodes c WHERE c.parent_id = n.id
+                       )
+                FROM subtree s
+                JOIN conversation_nodes n ON n.id = s.id
+                JOIN node_content b ON b.id = n.content_id
+                ORDER BY n.created_at, n.rowid
+            ''', {'node_id': node_id, 'conversation_id': conversation_id, 'max_depth': max_depth})
+
+            rows = cursor.fetchall()
 
-        # 构建节点字典
         node_dict = {}
-        for node in nodes:
+        for row in rows:
+            node = ConversationNode(
+                id=row[0], parent_id=row[1], conversation_id=row[2],
+                node_type=row[3], content=row[4], tokens_input=row[5],
+                tokens_output=row[6], created_at=row[7], tokens_cached=bool(row[8])
+            )
+            node_data = self._node_data(node)
+            if row[9]:
+                node_data['truncated'] = True
+            node_dict[node.id] = (node.parent_id, node_data)
+
+        for parent_id, node_data in node_dict.values():
+            if node_data['id'] != node_id and parent_id in node_dict:
+                node_dict[parent_id][1]['children'].append(node_data)
+
+        root = node_dict.get(node_id)
+        return root[1] if root else None
+
+    @timed('db_read')
+    def get_nodes_since(self, conversation_id: str, revision: int) -> Optional[Dict]:
+        """获取修订号大于 revision 的节点（扁平列表，带 parent_id），以及对话当前修订号"""
+        self._sync(conversation_id)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT revision FROM conversations WHERE id = ?', (conversation_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+
+            cursor.execute('''
+                SELECT n.id, n.parent_id, n.conversation_id, n.node_type, decode_content(b.data), n.tokens_input,
+                       n.tokens_output, n.created_at, n.tokens_cached
+                FROM conversation_nodes n
+                JOIN node_content b ON b.id = n.content_id
+                WHERE n.conversation_id = ? AND n.revision > ?
+                ORDER BY n.created_at, n.rowid
+            ''', (conversation_id, revision))
+
+            nodes = []
+            for node_row in cursor.fetchall():
+                node = ConversationNode(
+                    id=node_row[0], parent_id=node_row[1], conversation_id=node_row[2],
+                    node_type=node_row[3], content=node_row[4], tokens_input=node_row[5],
+                    tokens_output=node_row[6], created_at=node_row[7], tokens_cached=bool(node_row[8])
+                )
+                node_data = self._node_data(node)
+                del node_data['children']
+                node_data['parent_id'] = node.parent_id
+                nodes.append(node_data)
+            return {'revision': row[0], 'nodes': nodes}
+
+    @timed('db_read')
+    def get_tree_skeleton(self, conversation_id: str, preview_chars: int = 80) -> Optional[Dict]:
+        """获取树的骨架：只含 id、类型、截断的预览和 token 信息，完整内容通过 get_node 按需加载
+
+        preview_chars 不超过 PREVIEW_CHARS 时预览取自节点表的 preview 列，不读取 node_content。
+        """
+        self._sync(conversation_id)
+        if preview_chars <= PREVIEW_CHARS:
+            preview, join = 'n.preview', ''
+        else:
+            preview, join = 'decode_content(b.data)', 'JOIN node_content b ON b.id = n.content_id'
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT n.id, n.parent_id, n.node_type, substr({preview}, 1, ?), n.content_length > ?,
+                       n.tokens_input, n.tokens_output, n.tokens_cached
+                FROM conversation_nodes n
+                {join}
+                WHERE n.conversation_id = ?
+                ORDER BY n.created_at, n.rowid
+            ''', (preview_chars, preview_chars, conversation_id))
+            rows = cursor.fetchall()
+
+        if not rows:
+            return None
+
+        node_dict = {}
+        root_nodes = []
+        for row in rows:
             node_data = {
-                'id': node.id,
-                'type': node.node_type,
-                'content': node.content,
+                'id': row[0],
+                'type': row[2],
+                'preview': row[3],
+                'truncated': bool(row[4]),
                 'children': []
             }
-            if node.tokens_input is not None and node.tokens_output is not None:
-                node_data['tokens'] = {
-                    'input': node.tokens_input,
-                    'output': node.tokens_output
-                }
-            node_dict[node.id] = node_data
-
-        # 构建树形结构
-        root_nodes = []
-        for node in nodes:
-            node_data = node_dict[node.id]
-            if node.parent_id is None:
+            if row[5] is not None and row[6] is not None:
+                node_data['tokens'] = {'input': row[5], 'output': row[6]}
+                if row[7]:
+                    node_data['tokens']['cached'] = True
+            node_dict[row[0]] = node_data
+            if row[1] is None:
                 root_nodes.append(node_data)
-            else:
-                if node.parent_id in node_dict:
-                    node_dict[node.parent_id]['children'].append(node_data)
+            elif row[1] in node_dict:
+                node_dict[row[1]]['children'].append(node_data)
 
-        # 如果只有一个根节点，直接返回；否则返回根节点列表
         return root_nodes[0] if len(root_nodes) == 1 else root_nodes
 
+    @timed('db_read')
     def search_conversations(self, query: str, limit: int = 20) -> List[tuple]:
-        """搜索对话"""
-        with sqlite3.connect(self.db_path) as conn:
+        """搜索对话（标题或节点内容），按 bm25 相关度排序
+
+        返回 (id, title, system_msg, model_id, created_at, updated_at, snippet)，
+        snippet 为命中片段，匹配部分用 <mark> 标出。
+        """
+        self._sync()
+        # trigram 分词至少需要 3 个字符，更短的查询退回 LIKE 扫描
+        if not self.fts_enabled or len(query) < 3:
+            return self._search_conversations_like(query, limit)
+
+        phrase = '"' + query.replace('"', '""') + '"'
+        with self._connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT DISTINCT c.id, c.title, c.system_msg, c.model_id, c.created_at, c.updated_at
+                WITH node_hits AS (
+                    SELECT conversation_id, bm25(node_fts) AS score,
+                           snippet(node_fts, 0, '<mark>', '</mark>', '…', 24) AS snippet
+                    FROM node_fts
+                    WHERE node_fts MATCH :phrase
+                    ORDER BY rank
+                    LIMIT :hit_limit
+                ),
+                title_hits AS (
+                    SELECT c.id AS conversation_id, bm25(title_fts) * 2 AS score,
+                           highlight(title_fts, 0, '<mark>', '</mark>') AS snippet
+                    FROM title_fts
+                    JOIN conversations c ON c.rowid = title_fts.rowid
+                    WHERE title_fts MATCH :phrase
+                    ORDER BY rank
+                    LIMIT :hit_limit
+                ),
+                best AS (
+                    SELECT conversation_id, MIN(score) AS score, snippet
+                    FROM (SELECT * FROM node_hits UNION ALL SELECT * FROM title_hits)
+                    GROUP BY conversation_id
+                )
+                SELECT c.id, c.title, c.system_msg, c.model_id, c.created_at, c.updated_at, best.snippet
+                FROM best
+                JOIN conversations c ON c.id = best.conversation_id
+                ORDER BY best.score
+                LIMIT :limit
+            ''', {'phrase': phrase, 'hit_limit': limit * 50, 'limit': limit})
+
+            return cursor.fetchall()
+
+    def _search_conversations_like(self, query: str, limit: int) -> List[tuple]:
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            # 全文索引中保存着明文，有索引时扫描它，不必逐个解压节点内容
+            if self.fts_enabled:
+                matches = 'SELECT conversation_id FROM node_fts WHERE content LIKE :pattern'
+            else:
+                matches = '''
+                    SELECT n.conversation_id FROM conversation_nodes n
+                    JOIN node_content b ON b.id = n.content_id
+                    WHERE decode_content(b.data) LIKE :pattern
+                '''
+            cursor.execute(f'''
+                SELECT c.id, c.title, c.system_msg, c.model_id, c.created_at, c.updated_at, NULL
                 FROM conversations c
-                LEFT JOIN conversation_nodes n ON c.id = n.conversation_id
-                WHERE c.title LIKE ? OR n.content LIKE ?
+                WHERE c.title LIKE :pattern OR c.id IN ({matches})
                 ORDER BY c.updated_at DESC
-                LIMIT ?
-            ''', (f'%{query}%', f'%{query}%', limit))
+                LIMIT :limit
+            ''', {'pattern': f'%{query}%', 'limit': limit})
 
             return cursor.fetchall()
 
-# 全局数据库实例
-db = DatabaseManager()
\ No newline at end of file
+# 全局数据库实例，DATABASE_PATH 可指定数据库文件
+db = DatabaseManager(os.environ['DATABASE_PATH']) if os.environ.get('DATABASE_PATH') else DatabaseManager()
+atexit.register(db.close)
@@ -0,0 +1,679 @@
+"""
+数据库结构迁移
+
+结构版本保存在 PRAGMA user_version 中。每个迁移步骤有一个递增的版本号，启动时只执行
+版本号大于当前版本的步骤；结构已是最新时只读取一次 user_version，不执行任何 DDL。
+
+大表的回填按 rowid 分段执行，每段单独提交，不会长时间锁住数据库。所有步骤都可以重复执行
+（列/表/索引存在时跳过，回填只处理尚未处理的行），中途中断后重新运行会从断点继续。
+
+    python -m database.migrations              # 执行待处理的迁移
+    python -m database.migrations --dry-run    # 只列出待处理的迁移
+"""
+import argparse
+import os
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from monitoring.log import get_logger
+
+from .content import register_functions
+from .tokens import estimate_tokens
+
+logger = get_logger(__name__)
+
+# last_preview 保存的最长字符数
+PREVIEW_CHARS = 100
+
+
+class SchemaError(Exception):
+    """数据库结构版本与代码不匹配"""
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    apply: Callable[['MigrationRunner', sqlite3.Connection], None]
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, description: str):
+    """注册一个迁移步骤，版本号必须按顺序递增"""
+    def register(apply):
+        if MIGRATIONS and MIGRATIONS[-1].version >= version:
+            raise ValueError(f"migration {version} registered out of order")
+        MIGRATIONS.append(Migration(version, description, apply))
+        return apply
+    return register
+
+
+def iso_to_ms(value) -> int:
+    """把旧版本保存的 ISO 8601 本地时间字符串转为纪元毫秒，无法解析时返回 0"""
+    if isinstance(value, int):
+        return value
+    try:
+        return int(datetime.fromisoformat(value).timestamp() * 1000)
+    except (TypeError, ValueError):
+        return 0
+
+
+class MigrationRunner:
+    """按顺序执行 MIGRATIONS 中尚未应用的步骤
+
+    使用独立连接并关闭外键约束（重建表时需要），不影响连接池中的连接。
+    多个进程同时启动时，由 {db_path}-migrate 锁文件保证只有一个进程执行迁移，
+    其余进程等它完成后重新读取 user_version，不会重复执行同一步骤。
+    """
+
+    def __init__(self, db_path: str, chunk_size: int = 5000, migrations: Optional[List[Migration]] = None,
+                 lock_timeout: float = 600):
+        self.db_path = db_path
+        self.chunk_size = chunk_size
+        self.migrations = MIGRATIONS if migrations is None else migrations
+        self.lock_timeout = lock_timeout
+
+    @property
+    def latest(self) -> int:
+        return self.migrations[-1].version if self.migrations else 0
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=30)
+        conn.execute('PRAGMA foreign_keys = OFF')
+        conn.create_function('estimate_tokens', 1, estimate_tokens, deterministic=True)
+        conn.create_function('iso_to_ms', 1, iso_to_ms, deterministic=True)
+        register_functions(conn)
+        return conn
+
+    @staticmethod
+    def current_version(conn: sqlite3.Connection) -> int:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def pending(self, conn: Optional[sqlite3.Connection] = None) -> List[Migration]:
+        """返回尚未应用的迁移；数据库版本比代码新时抛出 SchemaError"""
+        if conn is None:
+            with closing(self.connect()) as conn:
+                return self.pending(conn)
+        version = self.current_version(conn)
+        if version > self.latest:
+            raise SchemaError(f"database schema version {version} is newer than supported version {self.latest}")
+        return [m for m in self.migrations if m.version > version]
+
+    def run(self, dry_run: bool = False) -> List[Migration]:
+        """执行待处理的迁移并返回实际执行的步骤；dry_run 时只返回待处理的步骤不执行"""
+        with closing(self.connect()) as conn:
+            pending = self.pending(conn)
+            if dry_run or not pending:
+                return pending
+            applied = []
+            with self.lock():
+                conn.execute('PRAGMA journal_mode = WAL')
+                # 等待锁期间其他进程可能已执行了部分步骤，每一步之前在锁内重新读取版本
+                while True:
+                    pending = self.pending(conn)
+                    if not pending:
+                        break
+                    step = pending[0]
+                    start = time.perf_counter()
+                    logger.info("数据库迁移 %d: %s", step.version, step.description)
+                    step.apply(self, conn)
+                    conn.execute(f'PRAGMA user_version = {int(step.version)}')
+                    logger.info("数据库迁移 %d 完成，用时 %.2fs", step.version, time.perf_counter() - start)
+                    applied.append(step)
+            return applied
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        """跨进程的迁移锁：在锁文件上持有 EXCLUSIVE 事务，其他进程最多等待 lock_timeout 秒
+
+        锁放在单独的文件上，迁移步骤自己的分段事务不受影响；进程退出时锁随连接释放。
+        """
+        with closing(sqlite3.connect(self.db_path + '-migrate', isolation_level=None,
+                                     timeout=self.lock_timeout)) as lock:
+            lock.execute('BEGIN EXCLUSIVE')
+            try:
+                yield
+            finally:
+                lock.execute('ROLLBACK')
+
+    @contextmanager
+    def transaction(self, conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def backfill(self, conn: sqlite3.Connection, table: str, *statements: str) -> None:
+        """按 rowid 分段依次执行 statements，每段一个事务
+
+        statement 用 :lo 和 :hi 限定 rowid 范围，并且必须只处理尚未回填的行，
+        这样中断后重新执行不会重复处理。
+        """
+        low, high = conn.execute(f'SELECT MIN(rowid), MAX(rowid) FROM {table}').fetchone()
+        if low is None:
+            return
+        for start in range(low, high + 1, self.chunk_size):
+            with self.transaction(conn):
+                for statement in statements:
+                    conn.execute(statement, {'lo': start, 'hi': start + self.chunk_size - 1})
+
+
+def ensure_column(conn: sqlite3.Connection, table: str, column: str, definition: str) -> bool:
+    """列不存在时添加，返回是否新增了该列"""
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    if column in columns:
+        return False
+    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+
+def table_exists(conn: sqlite3.Connection, name: str) -> bool:
+    return conn.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (name,)).fetchone() is not None
+
+
+@migration(1, '对话表与节点表')
+def create_tables(runner: MigrationRunner, conn: sqlite3.Connection) -> None:
+    with runner.transaction(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                system_msg TEXT NOT NULL,
+                model_id TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_nodes (
+                id TEXT PRIMARY KEY,
+                parent_id TEXT,
+                conversation_id TEXT NOT NULL,
+                node_type TEXT NOT NULL CHECK (node_type IN ('question', 'answer')),
+                content TEXT NOT NULL,
+                tokens_input INTEGER,
+                tokens_output INTEGER,
+                created_at TEXT NOT NULL,
+                FOREIGN KEY (parent_id) REFERENCES conversation_nodes (id),
+                FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_nodes_conversation ON conversation_nodes (conversation_id)')
+        create_node_indexes(conn)
+
+
+def create_node_indexes(conn: sqlite3.Connection) -> None:
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_nodes_parent ON conversation_nodes (parent_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_nodes_type ON conversation_nodes (node_type)')
+
+
+@migration(2, '节点内容 token 数与缓存标记')
+def add_node_tokens(runner: MigrationRunner, conn: sqlite3.Connection) -> None:
+    with runner.transaction(conn):
+        ensure_column(conn, 'conversation_nodes', 'content_tokens', 'INTEGER')
+        ensure_column(conn, 'conversation_nodes', 'tokens_cached', 'INTEGER NOT NULL DEFAULT 0')
+    runner.backfill(conn, 'conversation_nodes', '''
+        UPDATE conversation_nodes SET content_tokens = estimate_tokens(content)
+        WHERE rowid BETWEEN :lo AND :hi AND content_tokens IS NULL
+    ''')
+
+
+@migration(3, '修订号与增量拉取索引')
+def add_revisions(runner: MigrationRunner, conn: sqlite3.Connection) -> None:
+    with runner.transaction(conn):
+        ensure_column(conn, 'conversations', 'revision', 'INTEGER NOT NULL DEFAULT 0')
+        ensure_column(conn, 'conversation_nodes', 'revision', 'INTEGER NOT NULL DEFAULT 0')
+        # (conversation_id, created_at) 同时覆盖按对话查找和按时间排序，取代单列索引
+        conn.execute('DROP INDEX IF EXISTS idx_nodes_conversation')
+        create_revision_indexes(conn)
+
+
+def create_revision_indexes(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_nodes_conversation_created
+        ON conversation_nodes (conversation_id, created_at)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_nodes_conversation_revision
+        ON conversation_nodes (conversation_id, revision)
+    ''')
+
+
+@migration(4, '响应缓存')
+def add_response_cache(runner: MigrationRunner, conn: sqlite3.Connection) -> None:
+    with runner.transaction(conn):
+        ensure_column(conn, 'conversations', 'response_cache', 'INTEGER NOT NULL DEFAULT 1')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS response_cache (
+                key TEXT PRIMARY KEY,
+                content TEXT NOT NULL,
+                input_tokens INTEGER NOT NULL,
+                output_tokens INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_hit REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_last_hit ON response_cache (last_hit)')
+
+
+@migration(5, '全文检索索引（FTS5 trigram）')
+def add_search_index(runner: MigrationRunner, conn: sqlite3.Connection) -> None:
+    """索引表的 rowid 与源表 rowid 一致，由触发器保持同步。SQLite 不支持 FTS5/trigram 时跳过，搜索退回 LIKE"""
+    try:
+        with runner.transaction(conn):
+            conn.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS node_fts
+                USING fts5(content, conversation_id UNINDEXED, tokenize = 'trigram')
+            ''')
+            conn.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS title_fts
+                USING fts5(title, tokenize = 'trigram')
+            ''')
+            create_search_triggers(conn)
+    except sqlite3.OperationalError as e:
+        logger.warning("SQLite 不支持 FTS5 trigram，跳过全文索引: %s", e)
+        return
+
+    runner.backfill(conn, 'conversation_nodes', '''
+        INSERT INTO node_fts (rowid, content, conversation_id)
+        SELECT rowid, content, conversation_id FROM conversation_nodes
+        WHERE rowid BETWEEN :lo AND :hi
+          AND rowid NOT IN (SELECT rowid FROM node_fts WHERE rowid BETWEEN :lo AND :hi)
+    ''')
+    runner.backfill(conn, 'conversations', '''
+        INSERT INTO title_fts (rowid, title)
+        SELECT rowid, title FROM conversations
+        WHERE rowid BETWEEN :lo AND :hi
+          AND rowid NOT IN (SELECT rowid FROM title_fts WHERE rowid BETWEEN :lo AND :hi)
+    ''')
+
+
+def create_search_triggers(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS nodes_fts_insert AFTER INSERT ON conversation_nodes BEGIN
+            INSERT INTO node_fts (rowid, content, conversation_id)
+            VALUES (new.rowid, new.content, new.conversation_id);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS nodes_fts_update AFTER UPDATE OF content ON conversation_nodes BEGIN
+            UPDATE node_fts SET content = new.content WHERE rowid = new.rowid;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS nodes_fts_delete AFTER DELETE ON conversation_nodes BEGIN
+            DELETE FROM node_fts WHERE rowid = old.rowid;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_insert AFTER INSERT ON conversations BEGIN
+            INSERT INTO title_fts (rowid, title) VALUES (new.rowid, new.title);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_update AFTER UPDATE OF title ON conversations BEGIN
+            UPDATE title_fts SET title = new.title WHERE rowid = new.rowid;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_delete AFTER DELETE ON conversations BEGIN
+            DELETE FROM title_fts WHERE rowid = old.rowid;
+        END
+    ''')
+
+
+@migration(6, '对话统计字段与列表分页索引')
+def add_conversation_stats(runner: MigrationRunner, conn: sqlite3.Connection) -> None:
+    """节点数、token 总数和最后一条消息预览由节点表上的触发器增量维护"""
+    with runner.transaction(conn):
+        added = [
+            ensure_column(conn, 'conversations', column, definition)
+            for column, definition in (
+                ('node_count', 'INTEGER NOT NULL DEFAULT 0'),
+                ('total_tokens', 'INTEGER NOT NULL DEFAULT 0'),
+                ('last_preview', 'TEXT'),
+            )
+        ]
+        create_stats_triggers(conn)
+        create_conversation_indexes(conn)
+
+    # 触发器先于回填创建，回填按对话整体重新计算，与期间的写入不冲突
+    if any(added):
+        runner.backfill(conn, 'conversations', f'''
+            UPDATE conversations SET
+                node_count = (SELECT COUNT(*) FROM conversation_nodes n
+                              WHERE n.conversation_id = conversations.id),
+                total_tokens = (SELECT COALESCE(SUM(COALESCE(n.tokens_input, 0) + COALESCE(n.tokens_output, 0)), 0)
+                                FROM conversation_nodes n WHERE n.conversation_id = conversations.id),
+                last_preview = (SELECT substr(n.content, 1, {PREVIEW_CHARS}) FROM conversation_nodes n
+                                WHERE n.conversation_id = conversations.id
+                                ORDER BY n.created_at DESC LIMIT 1)
+            WHERE rowid BETWEEN :lo AND :hi
+        ''')
+
+
+def create_stats_triggers(conn: sqlite3.Connection) -> None:
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS nodes_stats_insert AFTER INSERT ON conversation_nodes BEGIN
+            UPDATE conversations SET
+                node_count = node_count + 1,
+                total_tokens = total_tokens + COALESCE(new.tokens_input, 0) + COALESCE(new.tokens_output, 0),
+                last_preview = substr(new.content, 1, {PREVIEW_CHARS})
+            WHERE id = new.conversation_id;
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS nodes_stats_update
+        AFTER UPDATE OF content, tokens_input, tokens_output ON conversation_nodes BEGIN
+            UPDATE conversations SET
+                total_tokens = total_tokens
+                    - COALESCE(old.tokens_input, 0) - COALESCE(old.tokens_output, 0)
+                    + COALESCE(new.tokens_input, 0) + COALESCE(new.tokens_output, 0),
+                last_preview = substr(new.content, 1, {PREVIEW_CHARS})
+            WHERE id = new.conversation_id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS nodes_stats_delete AFTER DELETE ON conversation_nodes BEGIN
+            UPDATE conversations SET
+                node_count = node_count - 1,
+                total_tokens = total_tokens - COALESCE(old.tokens_input, 0) - COALESCE(old.tokens_output, 0)
+            WHERE id = old.conversation_id;
+        END
+    ''')
+
+
+def create_conversation_indexes(conn: sqlite3.Connection) -> None:
+    # 对话列表按 (updated_at, id) 做游标分页
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations (updated_at, id)')
+
+
+# 迁移 7 重建表时复制的列；时间戳列需要转换
+REBUILD_CONVERSATION_COLUMNS = ('id', 'title', 'system_msg', 'model_id', 'created_at', 'updated_at',
+                                'response_cache', 'revision', 'node_count', 'total_tokens', 'last_preview')
+REBUILD_NODE_COLUMNS = ('id', 'parent_id', 'conversation_id', 'node_type', 'content', 'tokens_input',
+                        'tokens_output', 'created_at', 'content_tokens', 'tokens_cached', 'revision')
+TIMESTAMP_COLUMNS = ('created_at', 'updated_at')
+
+# iso_to_ms 的纯 SQL 版本（截断到毫秒，按本地时间解析）：触发器可能在其他进程的连接上执行，
+# 那些连接没有注册 iso_to_ms
+ISO_TO_MS_SQL = ("CASE WHEN typeof({0}) = 'integer' THEN {0} ELSE COALESCE("
+                 "strftime('%s', substr({0}, 1, 19), 'utc') * 1000"
+                 " + CAST(substr({0} || '000', 21, 3) AS INTEGER), 0) END")
+
+
+def copy_select(columns, convert: Callable[[str], str], prefix: str = '') -> str:
+    """列出复制用的表达式，时间戳列用 convert 转换"""
+    return ', '.join(convert(prefix + column) if column in TIMESTAMP_COLUMNS else prefix + column
+                     for column in columns)
+
+
+def create_mirror_triggers(conn: sqlite3.Connection, table: str, columns) -> None:
+    """迁移期间把旧表上的写入同步到 {table}_new，分段复制时已同步的行不会被覆盖"""
+    values = copy_select(columns, ISO_TO_MS_SQL.format, prefix='new.')
+    for event in ('INSERT', 'UPDATE'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_mirror_{event.lower()} AFTER {event} ON {table} BEGIN
+                INSERT OR REPLACE INTO {table}_new (rowid, {', '.join(columns)})
+                VALUES (new.rowid, {values});
+            END
+        ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_mirror_delete AFTER DELETE ON {table} BEGIN
+            DELETE FROM {table}_new WHERE rowid = old.rowid;
+        END
+    ''')
+
+
+@migration(7, '时间戳改为整数毫秒')
+def integer_timestamps(runner: MigrationRunner, conn: sqlite3.Connection) -> None:
+    """SQLite 不能修改列类型，按官方推荐的方式重建两张表：建新表、复制数据（保留 rowid，
+    全文索引仍然对应）、删除旧表、改名，再重建索引和触发器。
+
+    数据按 rowid 分段复制，每段一个事务；复制期间旧表上的写入由临时触发器同步到新表。
+    最后一个事务只删除旧表、改名、重建索引和触发器并更新 user_version。
+    """
+    row = conn.execute("SELECT type FROM pragma_table_info('conversations') WHERE name = 'created_at'").fetchone()
+    if row is not None and row[0].upper() == 'INTEGER':
+        return
+
+    with runner.transaction(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS conversations_new (
+                id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                system_msg TEXT NOT NULL,
+                model_id TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                updated_at INTEGER NOT NULL,
+                response_cache INTEGER NOT NULL DEFAULT 1,
+                revision INTEGER NOT NULL DEFAULT 0,
+                node_count INTEGER NOT NULL DEFAULT 0,
+                total_tokens INTEGER NOT NULL DEFAULT 0,
+                last_preview TEXT
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_nodes_new (
+                id TEXT PRIMARY KEY,
+                parent_id TEXT,
+                conversation_id TEXT NOT NULL,
+                node_type TEXT NOT NULL CHECK (node_type IN ('question', 'answer')),
+                content TEXT NOT NULL,
+                tokens_input INTEGER,
+                tokens_output INTEGER,
+                created_at INTEGER NOT NULL,
+                content_tokens INTEGER,
+                tokens_cached INTEGER NOT NULL DEFAULT 0,
+                revision INTEGER NOT NULL DEFAULT 0,
+                FOREIGN KEY (parent_id) REFERENCES conversation_nodes (id),
+                FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
+            )
+        ''')
+        create_mirror_triggers(conn, 'conversations', REBUILD_CONVERSATION_COLUMNS)
+        create_mirror_triggers(conn, 'conversation_nodes', REBUILD_NODE_COLUMNS)
+
+    # OR IGNORE: 已由触发器同步（或上次中断前已复制）的行保持不变
+    for table, columns in (('conversations', REBUILD_CONVERSATION_COLUMNS),
+                           ('conversation_nodes', REBUILD_NODE_COLUMNS)):
+        runner.backfill(conn, table, f'''
+            INSERT OR IGNORE INTO {table}_new (rowid, {', '.join(columns)})
+            SELECT rowid, {copy_select(columns, 'iso_to_ms({})'.format)}
+            FROM {table} WHERE rowid BETWEEN :lo AND :hi
+        ''')
+
+    with runner.transaction(conn):
+        # 删除旧表会一并删除其上的索引和触发器（包括同步触发器）
+        conn.execute('DROP TABLE conversation_nodes')
+        conn.execute('DROP TABLE conversations')
+        conn.execute('ALTER TABLE conversations_new RENAME TO conversations')
+        conn.execute('ALTER TABLE conversation_nodes_new RENAME TO conversation_nodes')
+
+        create_node_indexes(conn)
+        create_revision_indexes(conn)
+        create_conversation_indexes(conn)
+        create_stats_triggers(conn)
+        if table_exists(conn, 'node_fts'):
+            create_search_triggers(conn)
+
+        violations = conn.execute('PRAGMA foreign_key_check').fetchall()
+        if violations:
+            logger.warning("迁移后有 %d 行外键不一致（迁移前已存在）", len(violations))
+        # 与改名在同一事务中提交，其他连接不会看到新表结构配旧版本号
+        conn.execute('PRAGMA user_version = 7')
+
+
+def content_backfill(rows: str) -> Tuple[str, ...]:
+    """把 rows 选中的节点的内容写入 node_content（相同内容只存一份）、累加引用计数，再让节点指向它"""
+    return (
+        f'''
+            INSERT INTO node_content (hash, data)
+            SELECT content_hash(content), encode_content(content) FROM conversation_nodes
+            WHERE {rows}
+            GROUP BY 1
+            ON CONFLICT (hash) DO NOTHING
+        ''',
+        f'''
+            UPDATE node_content SET refs = node_content.refs + counts.nodes
+            FROM (SELECT content_hash(content) AS hash, COUNT(*) AS nodes FROM conversation_nodes
+                  WHERE {rows} GROUP BY 1) AS counts
+            WHERE node_content.hash = counts.hash
+        ''',
+        f'''
+            UPDATE conversation_nodes SET
+                content_id = (SELECT id FROM node_content WHERE hash = content_hash(conversation_nodes.content)),
+                content_length = length(content),
+                preview = substr(content, 1, {PREVIEW_CHARS})
+            WHERE {rows}
+        ''',
+    )
+
+
+# 分段回填一段 rowid 中尚未回填的节点
+CONTENT_BACKFILL = content_backfill('rowid BETWEEN :lo AND :hi AND content_id IS NULL')
+# 收尾时只补齐分段回填之后新写入或内容被修改的节点
+CONTENT_CATCH_UP = content_backfill('content_id IS NULL')
+
+
+@migration(8, '节点内容移入按哈希去重的压缩表')
+def content_store(runner: MigrationRunner, conn: sqlite3.Connection) -> None:
+    """节点表只保留结构、token 数和前 PREVIEW_CHARS 个字符的预览，完整内容按 SHA-256 去重后
+    压缩保存在 node_content 中（编码见 database/content.py），由节点表上的触发器维护引用计数。
+
+    先分段回填（引用计数随每段一起累加）；回填期间其他连接修改内容或删除节点时，临时触发器
+    扣减原内容的引用并把节点标记为未回填。最后一个事务只补齐这些节点、删除 content 列并重建触发器。
+    删除列后空间留在空闲页中供后续写入复用，运行 python -m database.migrations --vacuum 可收缩文件。
+    """
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(conversation_nodes)')}
+    if 'content' not in columns:
+        return
+
+    with runner.transaction(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS node_content (
+                id INTEGER PRIMARY KEY,
+                hash BLOB NOT NULL UNIQUE,
+                data BLOB NOT NULL,
+                refs INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        ensure_column(conn, 'conversation_nodes', 'content_id', 'INTEGER')
+        ensure_column(conn, 'conversation_nodes', 'content_length', 'INTEGER NOT NULL DEFAULT 0')
+        ensure_column(conn, 'conversation_nodes', 'preview', "TEXT NOT NULL DEFAULT ''")
+        create_pending_content_triggers(conn)
+    runner.backfill(conn, 'conversation_nodes', *CONTENT_BACKFILL)
+
+    with runner.transaction(conn):
+        for statement in CONTENT_CATCH_UP:
+            conn.execute(statement)
+
+        # 引用 content 列的触发器需要先删除；全文索引改由写入节点时直接维护
+        for trigger in ('nodes_content_pending_update', 'nodes_content_pending_delete',
+                        'nodes_fts_insert', 'nodes_fts_update', 'nodes_stats_insert', 'nodes_stats_update'):
+            conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        conn.execute('ALTER TABLE conversation_nodes DROP COLUMN content')
+        create_content_triggers(conn)
+
+
+def create_pending_content_triggers(conn: sqlite3.Connection) -> None:
+    """迁移 8 回填期间使用：已回填的节点被修改内容或删除时，扣减原内容的引用；
+    修改内容的节点重新标记为未回填，由收尾事务补齐"""
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS nodes_content_pending_update AFTER UPDATE OF content ON conversation_nodes
+        WHEN old.content_id IS NOT NULL AND old.content IS NOT new.content BEGIN
+            UPDATE conversation_nodes SET content_id = NULL WHERE rowid = new.rowid;
+            UPDATE node_content SET refs = refs - 1 WHERE id = old.content_id;
+            DELETE FROM node_content WHERE id = old.content_id AND refs <= 0;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS nodes_content_pending_delete AFTER DELETE ON conversation_nodes
+        WHEN old.content_id IS NOT NULL BEGIN
+            UPDATE node_content SET refs = refs - 1 WHERE id = old.content_id;
+            DELETE FROM node_content WHERE id = old.content_id AND refs <= 0;
+        END
+    ''')
+
+
+def create_content_triggers(conn: sqlite3.Connection) -> None:
+    """node_content 的引用计数与对话统计；内容不再在节点表中，预览取自 preview 列"""
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS nodes_content_insert AFTER INSERT ON conversation_nodes BEGIN
+            UPDATE node_content SET refs = refs + 1 WHERE id = new.content_id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS nodes_content_update AFTER UPDATE OF content_id ON conversation_nodes
+        WHEN old.content_id IS NOT new.content_id BEGIN
+            UPDATE node_content SET refs = refs + 1 WHERE id = new.content_id;
+            UPDATE node_content SET refs = refs - 1 WHERE id = old.content_id;
+            DELETE FROM node_content WHERE id = old.content_id AND refs <= 0;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS nodes_content_delete AFTER DELETE ON conversation_nodes BEGIN
+            UPDATE node_content SET refs = refs - 1 WHERE id = old.content_id;
+            DELETE FROM node_content WHERE id = old.content_id AND refs <= 0;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS nodes_stats_insert AFTER INSERT ON conversation_nodes BEGIN
+            UPDATE conversations SET
+                node_count = node_count + 1,
+                total_tokens = total_tokens + COALESCE(new.tokens_input, 0) + COALESCE(new.tokens_output, 0),
+                last_preview = new.preview
+            WHERE id = new.conversation_id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS nodes_stats_update
+        AFTER UPDATE OF preview, tokens_input, tokens_output ON conversation_nodes BEGIN
+            UPDATE conversations SET
+                total_tokens = total_tokens
+                    - COALESCE(old.tokens_input, 0) - COALESCE(old.tokens_output, 0)
+                    + COALESCE(new.tokens_input, 0) + COALESCE(new.tokens_output, 0),
+                last_preview = new.preview
+            WHERE id = new.conversation_id;
+        END
+    ''')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=os.path.join(os.path.dirname(__file__), 'knode.db'))
+    parser.add_argument('--dry-run', action='store_true', help='只列出待处理的迁移，不执行')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='回填时每个事务处理的行数')
+    parser.add_argument('--vacuum', action='store_true', help='迁移后执行 VACUUM，收缩数据库文件')
+    args = parser.parse_args()
+
+    runner = MigrationRunner(args.db, chunk_size=args.chunk_size)
+    with closing(runner.connect()) as conn:
+        version = runner.current_version(conn)
+    print(f"当前结构版本: {version}，最新版本: {runner.latest}")
+
+    pending = runner.run(dry_run=args.dry_run)
+    if not pending:
+        print("数据库结构已是最新")
+    elif args.dry_run:
+        for step in pending:
+            print(f"待执行 {step.version}: {step.description}")
+
+    if args.vacuum and not args.dry_run:
+        before = os.path.getsize(args.db)
+        with closing(runner.connect()) as conn:
+            conn.execute('VACUUM')
+        print(f"VACUUM: {before / 1048576:.1f} MiB -> {os.path.getsize(args.db) / 1048576:.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
+from typing import Dict, Iterator
+
+from .content import register_functions
+
+
+class PoolTimeout(Exception):
+    """连接池在超时时间内没有可用连接"""
+
+
+class PoolClosed(Exception):
+    """连接池已关闭"""
+
+
+class ConnectionPool:
+    """SQLite 连接池
+
+    连接在创建时统一配置 PRAGMA（WAL、synchronous=NORMAL、外键、缓存大小）并注册 SQL 函数，
+    之后在请求间复用，避免每次调用都重新 connect 和重复配置。
+    """
+
+    def __init__(self, db_path: str, max_size: int = 8, timeout: float = 5.0,
+                 cache_size_kib: int = 16384, busy_timeout_ms: int = 5000,
+                 health_check_interval: float = 30.0):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.db_path = db_path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.cache_size_kib = cache_size_kib
+        self.busy_timeout_ms = busy_timeout_ms
+        self.health_check_interval = health_check_interval
+
+        self._idle = LifoQueue(maxsize=max_size)
+        self._last_used: Dict[int, float] = {}
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                               timeout=self.busy_timeout_ms / 1000)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA foreign_keys = ON')
+        conn.execute(f'PRAGMA cache_size = -{int(self.cache_size_kib)}')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout_ms)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        register_functions(conn)
+        return conn
+
+    def _is_healthy(self, conn: sqlite3.Connection) -> bool:
+        last_used = self._last_used.get(id(conn), 0.0)
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn: sqlite3.Connection) -> None:
+        self._last_used.pop(id(conn), None)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def acquire(self) -> sqlite3.Connection:
+        """取出一个连接，池满时最多等待 timeout 秒"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            if self._closed:
+                raise PoolClosed("connection pool is closed")
+
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                conn = None
+
+            if conn is not None:
+                if self._is_healthy(conn):
+                    return conn
+                self._discard(conn)
+                continue
+
+            with self._lock:
+                can_create = self._created < self.max_size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise PoolTimeout(f"no connection available within {self.timeout}s")
+            try:
+                conn = self._idle.get(timeout=remaining)
+            except Empty:
+                raise PoolTimeout(f"no connection available within {self.timeout}s")
+            if self._is_healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        """归还连接；未结束的事务会被回滚"""
+        if self._closed:
+            self._discard(conn)
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        self._last_used[id(conn)] = time.monotonic()
+        self._idle.put_nowait(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """与 `with sqlite3.connect(...) as conn` 语义一致：正常退出提交，异常回滚"""
+        conn = self.acquire()
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self.release(conn)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'max_size': self.max_size,
+            'created': self._created,
+            'idle': self._idle.qsize(),
+        }
+
+    def close(self) -> None:
+        """关闭所有空闲连接；正在使用的连接在归还时关闭"""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                break
+            self._discard(conn)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
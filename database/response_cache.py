@@ -0,0 +1,99 @@
+import hashlib
+import json
+import re
+import time
+import unicodedata
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .database import DatabaseManager
+
+
+@dataclass
+class CachedResponse:
+    content: str
+    input_tokens: int
+    output_tokens: int
+
+
+class ResponseCache:
+    """模型回答缓存，保存在本地 SQLite 表 response_cache 中
+
+    键为 (模型配置, 系统消息, 打包后的上下文, 问题) 的哈希。
+    mode='exact' 按原文匹配；mode='semantic' 先对问题做归一化（全半角、大小写、
+    空白与标点），使措辞上只有细微差别的相同问题也能命中。表结构由数据库迁移创建。
+    """
+
+    MODES = ('exact', 'semantic')
+
+    def __init__(self, db: DatabaseManager, mode: str = 'exact', ttl: float = 86400,
+                 max_entries: int = 10000, evict_every: int = 100):
+        if mode not in self.MODES:
+            raise ValueError(f"unknown response cache mode: {mode}")
+        self.db = db
+        self.mode = mode
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        text = unicodedata.normalize('NFKC', text).casefold()
+        return re.sub(r'[\s\W_]+', '', text)
+
+    def make_key(self, model_key: Sequence, messages: List[Tuple[str, object]]) -> str:
+        """messages 为 (角色, 内容) 列表，最后一条是当前问题"""
+        if self.mode == 'semantic' and messages and isinstance(messages[-1][1], str):
+            messages = list(messages[:-1]) + [(messages[-1][0], self.normalize(messages[-1][1]))]
+        payload = json.dumps([self.mode, list(model_key), messages], ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        now = time.time()
+        with self.db._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT content, input_tokens, output_tokens FROM response_cache
+                WHERE key = ? AND created_at > ?
+            ''', (key, now - self.ttl))
+            row = cursor.fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            cursor.execute('''
+                UPDATE response_cache SET last_hit = ?, hits = hits + 1 WHERE key = ?
+            ''', (now, key))
+        self.hits += 1
+        return CachedResponse(content=row[0], input_tokens=row[1], output_tokens=row[2])
+
+    def put(self, key: str, content: str, input_tokens: int, output_tokens: int) -> None:
+        now = time.time()
+        with self.db._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO response_cache
+                (key, content, input_tokens, output_tokens, created_at, last_hit, hits)
+                VALUES (?, ?, ?, ?, ?, ?, 0)
+            ''', (key, content, int(input_tokens), int(output_tokens), now, now))
+        self._puts += 1
+        if self._puts % self.evict_every == 0:
+            self.evict()
+
+    def evict(self) -> int:
+        """删除过期条目，并按最近命中时间淘汰超出 max_entries 的部分"""
+        with self.db._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM response_cache WHERE created_at <= ?', (time.time() - self.ttl,))
+            removed = cursor.rowcount
+            cursor.execute('''
+                DELETE FROM response_cache WHERE key IN (
+                    SELECT key FROM response_cache ORDER BY last_hit DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_entries,))
+            return removed + cursor.rowcount
+
+    def stats(self) -> Dict:
+        return {'mode': self.mode, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,59 @@
+import json
+import os
+from typing import Any, Callable, Optional
+
+try:
+    import orjson
+except ImportError:  # 可选依赖（pip install knode[fast]），未安装时使用标准库
+    orjson = None
+
+# JSON_ENCODER: auto（已安装 orjson 时使用）/ orjson / json
+ENCODERS = ('auto', 'orjson', 'json')
+
+
+class EncodeError(TypeError):
+    """对象无法序列化，或嵌套深度超出编码器的限制"""
+
+
+def _orjson_dumps(obj: Any, default: Optional[Callable] = None) -> bytes:
+    try:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError as e:
+        raise EncodeError(str(e)) from e
+
+
+def _json_dumps(obj: Any, default: Optional[Callable] = None) -> bytes:
+    try:
+        return json.dumps(obj, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    except (TypeError, ValueError, RecursionError) as e:
+        raise EncodeError(str(e)) from e
+
+
+def resolve_encoder(name: Optional[str] = None) -> str:
+    """解析编码器名称（默认读取 JSON_ENCODER），返回实际使用的 'orjson' 或 'json'"""
+    name = (name or os.environ.get('JSON_ENCODER', 'auto')).lower()
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown JSON encoder: {name}, expected one of {', '.join(ENCODERS)}")
+    if name == 'orjson' and orjson is None:
+        raise ValueError("JSON_ENCODER=orjson but orjson is not installed")
+    if name == 'auto':
+        return 'orjson' if orjson is not None else 'json'
+    return name
+
+
+def get_encoder(name: Optional[str] = None) -> Callable[..., bytes]:
+    """返回 dumps(obj, default=None) -> bytes
+
+    两种编码器的输出都是紧凑的 UTF-8 JSON（不转义非 ASCII 字符），键按插入顺序输出。
+    """
+    return _orjson_dumps if resolve_encoder(name) == 'orjson' else _json_dumps
+
+
+ENCODER = resolve_encoder()
+dumps = get_encoder(ENCODER)
+
+
+def loads(data) -> Any:
+    if ENCODER == 'orjson':
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,12 @@
+from typing import Optional
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """估算文本的 token 数：中日韩字符按 1 个 token 计，其余字符约 4 个一个 token"""
+    if not text:
+        return 0
+    cjk = 0
+    for ch in text:
+        if '\u4e00' <= ch <= '\u9fff' or '\u3040' <= ch <= '\u30ff' or '\uac00' <= ch <= '\ud7af':
+            cjk += 1
+    return cjk + (len(text) - cjk + 3) // 4
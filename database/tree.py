@@ -0,0 +1,209 @@
+from json.encoder import encode_basestring
+from typing import Dict, Iterable, List, Optional, Union
+
+from . import serialization
+
+# 构建树所需的列，顺序与 TreeNode 的构造参数一致（节点表为 n，内容表为 b）
+TREE_COLUMNS = 'n.id, n.parent_id, n.node_type, decode_content(b.data), n.tokens_input, n.tokens_output, n.tokens_cached'
+
+
+class TreeNode:
+    """树中的一个节点，只保存接口需要的字段"""
+
+    __slots__ = ('id', 'parent_id', 'node_type', 'content',
+                 'tokens_input', 'tokens_output', 'tokens_cached', 'children')
+
+    def __init__(self, id: str, parent_id: Optional[str], node_type: str, content: str,
+                 tokens_input: Optional[int] = None, tokens_output: Optional[int] = None,
+                 tokens_cached: bool = False):
+        self.id = id
+        self.parent_id = parent_id
+        self.node_type = node_type
+        self.content = content
+        self.tokens_input = tokens_input
+        self.tokens_output = tokens_output
+        self.tokens_cached = tokens_cached
+        self.children: List['TreeNode'] = []
+
+    @classmethod
+    def from_node(cls, node) -> 'TreeNode':
+        """由 ConversationNode 创建"""
+        return cls(node.id, node.parent_id, node.node_type, node.content,
+                   node.tokens_input, node.tokens_output, bool(node.tokens_cached))
+
+    def data(self) -> Dict:
+        """节点本身（不含子节点）转为接口返回的字典"""
+        node_data = {
+            'id': self.id,
+            'type': self.node_type,
+            'content': self.content,
+            'children': []
+        }
+        if self.tokens_input is not None and self.tokens_output is not None:
+            node_data['tokens'] = {
+                'input': self.tokens_input,
+                'output': self.tokens_output
+            }
+            if self.tokens_cached:
+                node_data['tokens']['cached'] = True
+        return node_data
+
+
+class Tree:
+    """build_tree 的结果：根节点列表、id 索引，以及找不到父节点的孤立节点"""
+
+    __slots__ = ('roots', 'index', 'orphans')
+
+    def __init__(self, roots: List[TreeNode], index: Dict[str, TreeNode], orphans: List[TreeNode]):
+        self.roots = roots
+        self.index = index
+        self.orphans = orphans
+
+
+def build_tree(rows: Iterable[tuple]) -> Tree:
+    """由按 (created_at, rowid) 排序的行一次遍历构建树
+
+    同一父节点下的子节点保持行的顺序。父节点在子节点之后才出现时先暂存，等父节点到达再挂上；
+    父节点始终不存在（或 parent_id 成环）的节点作为孤立节点追加到根节点列表末尾，并在
+    Tree.orphans 中列出，不会被丢弃。
+    """
+    roots: List[TreeNode] = []
+    index: Dict[str, TreeNode] = {}
+    pending: Dict[str, List[TreeNode]] = {}
+
+    for row in rows:
+        node = TreeNode(*row)
+        node_id = node.id
+        index[node_id] = node
+        if pending and node_id in pending:
+            node.children = pending.pop(node_id)
+        parent_id = node.parent_id
+        if parent_id is None:
+            roots.append(node)
+        else:
+            parent = index.get(parent_id)
+            if parent is not None:
+                parent.children.append(node)
+            else:
+                pending.setdefault(parent_id, []).append(node)
+
+    orphans = [node for waiting in pending.values() for node in waiting]
+    roots.extend(orphans)
+
+    # parent_id 成环的节点从根节点不可达，断开环后同样作为孤立节点
+    if len(index) > _count(roots):
+        reached = set()
+        for root in roots:
+            _mark(root, reached)
+        for node in list(index.values()):
+            if node.id in reached:
+                continue
+            # 不可达节点的祖先都在索引中，沿 parent_id 向上必然回到环上
+            seen = set()
+            while node.id not in seen:
+                seen.add(node.id)
+                node = index[node.parent_id]
+            index[node.parent_id].children.remove(node)
+            roots.append(node)
+            orphans.append(node)
+            _mark(node, reached)
+
+    return Tree(roots, index, orphans)
+
+
+def _count(roots: List[TreeNode]) -> int:
+    count = 0
+    stack = list(roots)
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.children)
+    return count
+
+
+def _mark(root: TreeNode, reached: set) -> None:
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        reached.add(node.id)
+        stack.extend(node.children)
+
+
+def tree_to_dict(roots: List[TreeNode]) -> Optional[Union[Dict, List[Dict]]]:
+    """转为嵌套字典；只有一个根节点时返回该节点，否则返回根节点列表，没有节点时返回 None"""
+    if not roots:
+        return None
+    result = [root.data() for root in roots]
+    stack = list(zip(roots, result))
+    while stack:
+        node, node_data = stack.pop()
+        children = node_data['children']
+        for child in node.children:
+            child_data = child.data()
+            children.append(child_data)
+            stack.append((child, child_data))
+    return result[0] if len(result) == 1 else result
+
+
+def tree_to_json(roots: List[TreeNode]) -> bytes:
+    """树的 JSON（UTF-8），结果与 json.dumps(tree_to_dict(roots)) 等价
+
+    使用 orjson 时先构建字典再编码，比逐节点拼接快一个数量级；
+    路径超过 orjson 的嵌套深度限制时（约 127 个节点，即 60 多轮问答）改用 encode_tree_json。
+    """
+    if roots and serialization.ENCODER == 'orjson':
+        try:
+            return serialization.dumps(tree_to_dict(roots))
+        except serialization.EncodeError:
+            pass
+    return encode_tree_json(roots)
+
+
+def encode_tree_json(roots: List[TreeNode]) -> bytes:
+    """直接由节点生成 JSON，不依赖 orjson
+
+    不构建中间字典，且不使用递归，深度很大的对话链也不会超出递归限制。
+    """
+    if not roots:
+        return b'null'
+    parts: List[str] = []
+    append = parts.append
+    single = len(roots) == 1
+    if not single:
+        append('[')
+
+    stack = [(None, iter(roots))]
+    first = True
+    while stack:
+        parent, siblings = stack[-1]
+        for node in siblings:
+            if first:
+                first = False
+            else:
+                append(',')
+            # 内容可能很长，单独追加，避免在格式化时再复制一次
+            append('{"id":%s,"type":%s,"content":' % (encode_basestring(node.id), encode_basestring(node.node_type)))
+            append(encode_basestring(node.content))
+            if node.children:
+                append(',"children":[')
+                stack.append((node, iter(node.children)))
+                first = True
+                break
+            # 叶子节点不入栈
+            append(',"children":[' + _close(node))
+        else:
+            stack.pop()
+            if parent is not None:
+                append(_close(parent))
+            first = False
+
+    if not single:
+        append(']')
+    return ''.join(parts).encode('utf-8')
+
+
+def _close(node: TreeNode) -> str:
+    if node.tokens_input is None or node.tokens_output is None:
+        return ']}'
+    return ']' + ',"tokens":{"input":%d,"output":%d%s}}' % (
+        node.tokens_input, node.tokens_output, ',"cached":true' if node.tokens_cached else '')
@@ -0,0 +1,203 @@
+import sys
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from monitoring.metrics import timed
+
+from .tree import Tree, TreeNode, tree_to_dict, tree_to_json
+
+# 每个 TreeNode（含 children 列表和索引项）除内容外的大致内存占用
+NODE_OVERHEAD = 200
+
+
+class CachedTree:
+    """一棵已构建的对话树及其修订号"""
+
+    __slots__ = ('revision', 'roots', 'index', 'size', 'json')
+
+    def __init__(self, revision: int, tree: Tree):
+        self.revision = revision
+        self.roots = tree.roots
+        self.index = tree.index
+        self.size = sum(_node_size(node) for node in self.index.values())
+        self.json: Optional[bytes] = None
+
+    def tree(self) -> Optional[Union[Dict, List[Dict]]]:
+        return tree_to_dict(self.roots)
+
+    @timed('tree_serialize')
+    def to_json(self) -> bytes:
+        return tree_to_json(self.roots)
+
+
+def _node_size(node: TreeNode) -> int:
+    return NODE_OVERHEAD + sys.getsizeof(node.content)
+
+
+class TreeCache:
+    """已构建对话树的进程内缓存
+
+    以 (conversation_id, revision) 为版本，按 LRU 淘汰，总占用不超过 max_bytes。
+    写入节点后调用 apply 把新节点直接挂到缓存的树上（修订号必须正好接上，否则丢弃该条目），
+    删除对话或修改标题时调用 invalidate。序列化后的 JSON 也一并缓存，热门对话的
+    请求既不查库也不重复序列化。
+
+    条目的读取、序列化和修改都在锁内进行。
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: 'OrderedDict[str, CachedTree]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _lookup(self, conversation_id: str, revision: int) -> Optional[CachedTree]:
+        entry = self._entries.get(conversation_id)
+        if entry is None or entry.revision != revision:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(conversation_id)
+        self.hits += 1
+        return entry
+
+    def get(self, conversation_id: str, revision: int) -> Optional[CachedTree]:
+        """取出指定修订号的条目，不存在或版本不符时返回 None"""
+        with self._lock:
+            return self._lookup(conversation_id, revision)
+
+    def get_json(self, conversation_id: str, revision: int) -> Optional[bytes]:
+        """取出指定修订号的树的 JSON，首次取用时序列化并缓存"""
+        with self._lock:
+            entry = self._lookup(conversation_id, revision)
+            if entry is None:
+                return None
+            if entry.json is None:
+                entry.json = entry.to_json()
+                self._resize(entry, len(entry.json))
+            return entry.json
+
+    def to_dict(self, entry: CachedTree) -> Optional[Union[Dict, List[Dict]]]:
+        """把条目转为嵌套字典（每次返回新对象）"""
+        with self._lock:
+            return entry.tree()
+
+    def serialize(self, conversation_id: str, entry: CachedTree) -> Tuple[int, bytes]:
+        """序列化刚构建的树，返回 (修订号, JSON)；若它仍是缓存中的当前条目，一并缓存 JSON
+
+        条目可能已被 apply 更新到更新的修订号，修订号在锁内与 JSON 一起读取。
+        """
+        with self._lock:
+            if entry.json is not None:
+                return entry.revision, entry.json
+            data = entry.to_json()
+            if self._entries.get(conversation_id) is entry:
+                entry.json = data
+                self._resize(entry, len(data))
+            return entry.revision, data
+
+    def put(self, conversation_id: str, revision: int, tree: Tree) -> CachedTree:
+        """缓存一棵刚从数据库构建的树；已缓存的更新版本不会被旧版本覆盖"""
+        entry = CachedTree(revision, tree)
+        with self._lock:
+            current = self._entries.get(conversation_id)
+            if current is not None:
+                if current.revision >= revision:
+                    return entry
+                self._remove(conversation_id)
+            if entry.size > self.max_bytes:
+                return entry
+            self._entries[conversation_id] = entry
+            self._bytes += entry.size
+            self._evict()
+        return entry
+
+    def apply(self, conversation_id: str, revision: int, nodes: Iterable) -> None:
+        """写入节点后同步缓存：revision 为写入后的修订号，nodes 为本次写入的 ConversationNode"""
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None:
+                return
+            if entry.revision != revision - 1:
+                self._remove(conversation_id)
+                self.invalidations += 1
+                return
+
+            delta = 0
+            for node in nodes:
+                old = entry.index.get(node.id)
+                if old is not None and old.parent_id == node.parent_id:
+                    # 覆盖已有节点：原地更新，位置不变
+                    delta += sys.getsizeof(node.content) - sys.getsizeof(old.content)
+                    old.node_type = node.node_type
+                    old.content = node.content
+                    old.tokens_input = node.tokens_input
+                    old.tokens_output = node.tokens_output
+                    old.tokens_cached = bool(node.tokens_cached)
+                    continue
+
+                if old is None and node.parent_id is None:
+                    siblings = entry.roots
+                elif old is None and node.parent_id in entry.index:
+                    siblings = entry.index[node.parent_id].children
+                else:
+                    # 节点被移动或父节点不在缓存的树中，交给下次读取时重建
+                    self._remove(conversation_id)
+                    self.invalidations += 1
+                    return
+                tree_node = TreeNode.from_node(node)
+                siblings.append(tree_node)
+                entry.index[node.id] = tree_node
+                delta += _node_size(tree_node)
+
+            entry.revision = revision
+            if entry.json is not None:
+                delta -= len(entry.json)
+                entry.json = None
+            self._entries.move_to_end(conversation_id)
+            self._resize(entry, delta)
+
+    def invalidate(self, conversation_id: str) -> None:
+        with self._lock:
+            if self._remove(conversation_id):
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, conversation_id: str) -> bool:
+        entry = self._entries.pop(conversation_id, None)
+        if entry is None:
+            return False
+        self._bytes -= entry.size
+        return True
+
+    def _resize(self, entry: CachedTree, delta: int) -> None:
+        entry.size += delta
+        self._bytes += delta
+        self._evict()
+
+    def _evict(self) -> None:
+        # 最近使用的条目在末尾，从头部开始淘汰；至少保留刚使用的那一条
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self.evictions += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
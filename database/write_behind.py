@@ -0,0 +1,165 @@
+import queue
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from monitoring.log import get_logger
+
+logger = get_logger(__name__)
+
+
+class WriteBehindFull(Exception):
+    """写入队列已满，在超时时间内没有腾出空间"""
+
+
+class WriteBehindClosed(Exception):
+    """写入队列已关闭"""
+
+
+class WriteBehindQueue:
+    """问答写入的后台队列（write-behind）
+
+    save_turn / save_turns 只把写入放进有界队列就返回，由单个写线程批量取出，在一个事务中提交；
+    save_turns 的多轮问答作为一个整体入队，总是在同一个事务中写入。
+    队列满时提交方阻塞（背压），超过 put_timeout 抛出 WriteBehindFull。
+
+    每次提交分配递增的序号。读取某个对话（或某个节点）前调用 wait，等到该对话最近一次
+    提交的写入已经落库，保证读到自己的写入；其他对话的写入不影响等待时间。
+    close 时先写完队列中剩余的内容。进程被强制终止时，尚未提交的写入（最多 max_pending 轮）会丢失。
+    """
+
+    def __init__(self, db, max_pending: int = 1000, batch_size: int = 100, put_timeout: float = 10.0):
+        self.db = db
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+
+        self._queue: 'queue.Queue[Optional[Tuple[int, List[tuple]]]]' = queue.Queue(maxsize=max_pending)
+        self._order = threading.Lock()
+        self._cond = threading.Condition()
+        self._submitted = 0
+        self._committed = 0
+        self._conversation_seq: Dict[str, int] = {}  # 对话 -> 最近一次未落库写入的序号
+        self._node_seq: Dict[str, int] = {}  # 未落库的节点 -> 序号
+        self._closed = False
+
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+
+        self._thread = threading.Thread(target=self._run, name='knode-db-writer', daemon=True)
+        self._thread.start()
+
+    def submit_turn(self, question, answer, title: Optional[str] = None) -> int:
+        """把一轮问答放入队列，返回写入序号"""
+        return self.submit_turns([(question, answer, title)])
+
+    def submit_turns(self, turns: List[tuple]) -> int:
+        """把多轮 (question, answer, title) 作为一个整体放入队列，返回写入序号"""
+        # 分配序号和入队在 _order 下完成，保证队列中的顺序与序号一致；写线程从不获取 _order，
+        # 队列满时阻塞在 put 上也不妨碍它取出下一批。_cond 只在入队成功后短暂持有
+        with self._order:
+            if self._closed:
+                raise WriteBehindClosed("write-behind queue is closed")
+            seq = self._submitted + 1
+            try:
+                self._queue.put((seq, turns), timeout=self.put_timeout)
+            except queue.Full:
+                raise WriteBehindFull(f"write-behind queue is full ({self._queue.maxsize} pending writes)")
+            with self._cond:
+                self._submitted = seq
+                # 写线程可能已经写完这次提交，此时不再记录，避免留下永远不会删除的条目
+                if self._committed < seq:
+                    for question, answer, _ in turns:
+                        self._conversation_seq[question.conversation_id] = seq
+                        self._node_seq[question.id] = seq
+                        self._node_seq[answer.id] = seq
+        return seq
+
+    def wait(self, conversation_id: Optional[str] = None, node_id: Optional[str] = None,
+             timeout: Optional[float] = None) -> bool:
+        """等待指定对话/节点已提交的写入落库；都不指定时等待此前提交的全部写入
+
+        返回是否在超时前完成。在写线程中调用时直接返回。
+        """
+        if threading.current_thread() is self._thread:
+            return True
+        with self._cond:
+            if conversation_id is not None:
+                target = self._conversation_seq.get(conversation_id, 0)
+            elif node_id is not None:
+                target = self._node_seq.get(node_id, 0)
+            else:
+                target = self._submitted
+            return self._cond.wait_for(lambda: self._committed >= target, timeout)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        return self.wait(timeout=timeout)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """停止接收新的写入，写完队列中剩余的内容后结束写线程"""
+        # 持有 _order 时没有进行中的提交，哨兵一定排在所有已接受的写入之后
+        with self._order:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write(batch)
+
+    def _write(self, batch: List[Tuple[int, List[tuple]]]) -> None:
+        turns = [turn for _, unit in batch for turn in unit]
+        try:
+            self.db._write_turns(turns)
+            written = len(turns)
+        except Exception as e:
+            # 整批失败时逐个重试，只丢弃出错的那一次提交
+            logger.warning("Write-behind batch of %d failed, retrying one by one: %s", len(turns), e)
+            written = 0
+            for _, unit in batch:
+                try:
+                    self.db._write_turns(unit)
+                    written += len(unit)
+                except Exception as e:
+                    self.failed += len(unit)
+                    question = unit[0][0]
+                    logger.error("Write-behind dropped %d turn(s) from %s in conversation %s: %s",
+                                 len(unit), question.id, question.conversation_id, e)
+
+        with self._cond:
+            self.batches += 1
+            self.written += written
+            self._committed = batch[-1][0]
+            for seq, unit in batch:
+                for question, answer, _ in unit:
+                    if self._conversation_seq.get(question.conversation_id) == seq:
+                        del self._conversation_seq[question.conversation_id]
+                    for node in (question, answer):
+                        if self._node_seq.get(node.id) == seq:
+                            del self._node_seq[node.id]
+            self._cond.notify_all()
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                'pending': self._submitted - self._committed,
+                'max_pending': self._queue.maxsize,
+                'batches': self.batches,
+                'written': self.written,
+                'failed': self.failed,
+            }
@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
 """
 Knode 主启动程序
+
+    python main.py           # Flask 开发服务器
+    python main.py --asgi    # ASGI 服务器（uvicorn），对话接口以异步方式处理
 """
+import sys
 
 if __name__ == '__main__':
-    from backend.app import app
-    app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
+    if '--asgi' in sys.argv[1:]:
+        import uvicorn
+        uvicorn.run('backend.asgi:app', host='0.0.0.0', port=5001)
+    else:
+        from backend.app import app
+        app.run(debug=True, host='0.0.0.0', port=5001)
@@ -0,0 +1 @@
+# Monitoring package
\ No newline at end of file
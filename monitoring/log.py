@@ -0,0 +1,53 @@
+"""
+非阻塞日志：调用方只把日志记录放进内存队列，由后台线程写到 stderr
+
+    from monitoring.log import get_logger
+    logger = get_logger(__name__)
+    logger.debug("Agent response: %s", content)   # 低于 LOG_LEVEL 时参数不会被格式化
+
+级别由环境变量 LOG_LEVEL 控制（默认 INFO）。消息内容、回答内容等只在 DEBUG 级别输出。
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+ROOT = 'knode'
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+_lock = threading.Lock()
+_listener = None
+
+
+class _QueueHandler(QueueHandler):
+    """只在后台线程格式化：入队时保留原始参数，不在调用方线程拼接字符串"""
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level=None) -> None:
+    """为 knode.* 日志器安装队列处理器，重复调用无副作用"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        root = logging.getLogger(ROOT)
+        root.setLevel((level or os.environ.get('LOG_LEVEL', 'INFO')).upper())
+        root.propagate = False
+
+        log_queue = queue.SimpleQueue()
+        output = logging.StreamHandler()
+        output.setFormatter(logging.Formatter(FORMAT))
+        root.addHandler(_QueueHandler(log_queue))
+        _listener = QueueListener(log_queue, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """返回 knode 下的日志器，例如 get_logger('backend.app') -> knode.backend.app"""
+    setup_logging()
+    return logging.getLogger(f'{ROOT}.{name}')
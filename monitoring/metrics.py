@@ -0,0 +1,281 @@
+"""
+进程内指标：计数器、仪表、直方图，以及按请求汇总的耗时分段（span）
+
+指标以 Prometheus 文本格式输出（/metrics），不依赖 prometheus_client。
+已经在其他对象里计数的数据（缓存命中、调度器排队数等）通过 collector 在抓取时读取，
+不在热路径上重复计数。
+
+    with span('db_read'):
+        ...
+
+    @timed('db_write')
+    def save(...):
+        ...
+"""
+import bisect
+import contextvars
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# 秒，覆盖从 SQLite 单行查询到多分钟的模型调用
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{_labels(self.labelnames, key)} {_number(value)}' for key, value in values]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values: Dict[Tuple, List] = {}  # labels -> [每个桶的计数..., 总和, 次数]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return state[-1] if state else 0
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+        lines = []
+        for key, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {_number(state[-2])}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {state[-1]}')
+        return lines
+
+
+# collector 返回 (名称, 类型, 说明, [(标签字典, 值)]) 的列表
+Sample = Tuple[str, str, str, Iterable[Tuple[Dict, float]]]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def collector(self, fn: Callable[[], Iterable[Sample]]) -> Callable:
+        """注册在抓取时调用的函数，可作为装饰器使用"""
+        with self._lock:
+            self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines += metric.header()
+            lines += metric.render()
+        for fn in collectors:
+            try:
+                samples = list(fn())
+            except Exception as e:
+                lines.append(f'# collector {getattr(fn, "__name__", fn)} failed: {_escape(e)}')
+                continue
+            for name, kind, help, values in samples:
+                lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+                for labels, value in values:
+                    lines.append(f'{name}{_labels(list(labels), list(labels.values()))} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def gauge(name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, help, labels))
+
+
+def histogram(name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+# 耗时分段
+
+SPAN_SECONDS = histogram('knode_span_seconds', 'Time spent in instrumented sections', ('span',))
+
+# 当前请求的耗时汇总：span -> [次数, 总秒数]；不在请求中时为 None
+_trace: contextvars.ContextVar[Optional[Dict[str, List]]] = contextvars.ContextVar('knode_trace', default=None)
+
+
+def observe_span(name: str, seconds: float) -> None:
+    """记录一段耗时：计入直方图，并累加到当前请求的汇总中"""
+    SPAN_SECONDS.observe(seconds, span=name)
+    trace = _trace.get()
+    if trace is not None:
+        entry = trace.get(name)
+        if entry is None:
+            trace[name] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+
+@contextmanager
+def span(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_span(name, time.perf_counter() - start)
+
+
+def timed(name: str):
+    """装饰器：整个函数调用作为一个 span"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe_span(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def start_trace() -> contextvars.Token:
+    """开始记录当前请求的耗时汇总，返回给 end_trace 的 token"""
+    return _trace.set({})
+
+
+def end_trace(token: contextvars.Token) -> Dict[str, List]:
+    """结束当前请求，返回 span -> [次数, 总秒数]"""
+    trace = _trace.get() or {}
+    _trace.reset(token)
+    return trace
+
+
+def format_trace(trace: Dict[str, List]) -> str:
+    return ' '.join(f'{name}={seconds * 1000:.1f}ms' + (f'(x{count})' if count > 1 else '')
+                    for name, (count, seconds) in sorted(trace.items(), key=lambda item: -item[1][1]))
+
+
+def register_stats(prefix: str, fn: Callable, counters: Sequence[str] = (), label: Optional[str] = None) -> Callable:
+    """把已有对象的 stats() 在抓取时转为指标
+
+    fn 返回字典、字典列表或 None；counters 中的键输出为 {prefix}_{key}_total 计数器，
+    其余数值输出为 {prefix}_{key} 仪表。返回列表时用每个字典里 label 键的值区分。
+    """
+    def collect() -> List[Sample]:
+        stats = fn()
+        if stats is None:
+            return []
+        samples: Dict[str, Tuple[str, str, List]] = {}
+        for row in stats if isinstance(stats, list) else [stats]:
+            labels = {label: row[label]} if label else {}
+            for key, value in row.items():
+                if key == label or not isinstance(value, (int, float)):
+                    continue
+                if key in counters:
+                    name, kind = f'{prefix}_{key}_total', 'counter'
+                else:
+                    name, kind = f'{prefix}_{key}', 'gauge'
+                samples.setdefault(name, (kind, f'{prefix} {key}', []))[2].append((labels, float(value)))
+        return [(name, kind, help, values) for name, (kind, help, values) in samples.items()]
+
+    collect.__name__ = prefix
+    return REGISTRY.collector(collect)
@@ -0,0 +1,53 @@
+import json
+import os
+import tempfile
+
+import pytest
+
+# 接口测试使用本地模拟模型，不访问网络
+os.environ.update({
+    'MODEL_PROVIDER': 'simulated',
+    'SIMULATED_TTFT_MS': '0',
+    'SIMULATED_LATENCY_DISTRIBUTION': 'fixed',
+    'SIMULATED_CHUNK_MS': '0',
+    'SIMULATED_OUTPUT_TOKENS': '8',
+    'RESPONSE_CACHE_MODE': 'off',
+    # 全局数据库实例放在临时目录，测试不写入 database/knode.db
+    'DATABASE_PATH': os.path.join(tempfile.mkdtemp(prefix='knode-test-'), 'knode.db'),
+})
+
+from database.database import DatabaseManager  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    manager = DatabaseManager(str(tmp_path / 'knode.db'), tree_cache_bytes=0)
+    yield manager
+    manager.close()
+
+
+@pytest.fixture
+def app_module():
+    from backend import app
+    return app
+
+
+@pytest.fixture
+def app_db(db, app_module, monkeypatch):
+    """让 Flask 应用使用临时数据库"""
+    monkeypatch.setattr(app_module, 'db', db)
+    return db
+
+
+@pytest.fixture
+def client(app_db, app_module):
+    return app_module.app.test_client()
+
+
+def sse_events(response):
+    """把 SSE 响应解析为事件列表，每个事件的 'event' 键为事件名"""
+    events = []
+    for block in response.get_data(as_text=True).strip().split('\n\n'):
+        kind, data = block.split('\n')[:2]
+        events.append(json.loads(data[len('data: '):]) | {'event': kind[len('event: '):]})
+    return events
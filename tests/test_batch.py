@@ -0,0 +1,77 @@
+import threading
+
+from conftest import sse_events
+from database.database import ConversationNode
+
+MODELS = ['glm-4.5-air', 'glm-4', 'glm-4.6']
+
+
+def add_root(db, conversation_id, name):
+    question = ConversationNode(f'{name}-q', None, conversation_id, 'question', name)
+    answer = ConversationNode(f'{name}-a', question.id, conversation_id, 'answer', name)
+    db.save_turn(question, answer)
+    return answer.id
+
+
+def test_batch_reports_each_branch(app_db, client, app_module, monkeypatch):
+    conversation_id = app_db.create_conversation('t', 's', 'glm-4.5-air')
+    parents = [add_root(app_db, conversation_id, 'left'), add_root(app_db, conversation_id, 'right')]
+    run_branch = app_module.run_branch
+    finished = []
+    lock = threading.Condition()
+
+    def flaky_branch(branch, message):
+        # 分支按请求顺序的倒序完成；glm-4 的分支失败
+        with lock:
+            lock.wait_for(lambda: len(finished) == 5 - branch['index'], timeout=5)
+        try:
+            if branch['model_id'] == 'glm-4':
+                raise RuntimeError(f"model down for {branch['parent_id']}")
+            return run_branch(branch, message)
+        finally:
+            with lock:
+                finished.append(branch['index'])
+                lock.notify_all()
+    monkeypatch.setattr(app_module, 'run_branch', flaky_branch)
+
+    response = client.post('/api/chat/batch', json={'conversation_id': conversation_id, 'message': 'compare',
+                                                    'parent_ids': parents, 'model_ids': MODELS})
+    events = sse_events(response)
+    assert [event['event'] for event in events][0] == 'start'
+    assert events[-1] == {'event': 'done', 'saved': 4, 'failed': 2}
+
+    # start 按 parent_ids × model_ids 的顺序列出分支
+    start = events[0]['branches']
+    assert [(b['index'], b['parent_id'], b['model_id']) for b in start] == \
+        [(i, parent, model) for i, (parent, model) in enumerate((p, m) for p in parents for m in MODELS)]
+
+    # 每个分支一个事件，按完成顺序推送；失败的分支带上自己的错误
+    branches = events[1:-1]
+    assert [b['index'] for b in branches] == [5, 4, 3, 2, 1, 0]
+    errors = {b['index']: b for b in branches if b['event'] == 'branch_error'}
+    assert set(errors) == {1, 4}
+    for index, error in errors.items():
+        assert error['model_id'] == 'glm-4'
+        assert error['error'] == f"model down for {start[index]['parent_id']}"
+        assert 'answer' not in error
+
+    # 成功的分支按请求顺序保存为并列的分支，失败的分支不写入任何节点
+    saved = [b for b in start if b['index'] not in errors]
+    nodes = app_db.get_conversation_nodes(conversation_id)[4:]
+    assert [node.id for node in nodes if node.node_type == 'question'] == [b['question_id'] for b in saved]
+    answers = {node.id: node for node in nodes if node.node_type == 'answer'}
+    assert set(answers) == {b['answer_id'] for b in saved}
+    for branch in saved:
+        question = next(node for node in nodes if node.id == branch['question_id'])
+        assert question.parent_id == branch['parent_id']
+        assert answers[branch['answer_id']].parent_id == question.id
+
+
+def test_batch_rejects_unknown_parent(app_db, client):
+    conversation_id = app_db.create_conversation('t', 's', 'glm-4.5-air')
+    parent = add_root(app_db, conversation_id, 'root')
+    response = client.post('/api/chat/batch', json={'conversation_id': conversation_id, 'message': 'compare',
+                                                    'parent_ids': [parent, 'missing']})
+    assert response.status_code == 400
+    assert 'missing' in response.get_json()['error']
+    assert len(app_db.get_conversation_nodes(conversation_id)) == 2
@@ -0,0 +1,43 @@
+from database.database import ConversationNode
+
+
+def save_turn(db, conversation_id, index, parent_id=None):
+    question = ConversationNode(f'{conversation_id}-q{index}', parent_id, conversation_id, 'question', f'question {index}')
+    answer = ConversationNode(f'{conversation_id}-a{index}', question.id, conversation_id, 'answer', f'answer {index}')
+    db.save_turn(question, answer)
+    return answer.id
+
+
+def test_node_path_stays_in_conversation(db):
+    mine = db.create_conversation('mine', 's', 'm')
+    other = db.create_conversation('other', 's', 'm')
+    first = save_turn(db, mine, 0)
+    second = save_turn(db, mine, 1, first)
+
+    assert [node.id for node in db.get_node_path(second, conversation_id=mine)] == \
+        [f'{mine}-q0', first, f'{mine}-q1', second]
+    assert db.get_node_path(second, conversation_id=other) == []
+    assert db.has_node(mine, second)
+    assert not db.has_node(other, second)
+
+
+def test_chat_rejects_parent_from_other_conversation(app_db, client):
+    mine = app_db.create_conversation('mine', 's', 'glm-4.5-air')
+    other = app_db.create_conversation('other', 's', 'glm-4.5-air')
+    foreign = save_turn(app_db, other, 0)
+
+    for path in ('/api/chat', '/api/chat/stream'):
+        response = client.post(path, json={'conversation_id': mine, 'message': 'hello', 'parent_id': foreign})
+        assert response.status_code == 404
+        assert response.get_json()['success'] is False
+    assert app_db.get_conversation_nodes(mine) == []
+
+
+def test_chat_continues_from_own_parent(app_db, client):
+    conversation_id = app_db.create_conversation('mine', 's', 'glm-4.5-air')
+    parent = save_turn(app_db, conversation_id, 0)
+
+    response = client.post('/api/chat', json={'conversation_id': conversation_id, 'message': 'hello', 'parent_id': parent})
+    assert response.status_code == 200
+    assert response.get_json()['success'] is True
+    assert len(app_db.get_conversation_nodes(conversation_id)) == 4
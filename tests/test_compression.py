@@ -0,0 +1,114 @@
+import gzip
+import json
+
+import pytest
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+from backend.compression import Compressor
+from database.database import ConversationNode
+
+
+def accept(value):
+    return parse_accept_header(value)
+
+
+@pytest.fixture
+def negotiator():
+    compressor = Compressor()
+    # 只测试协商，不实际压缩，不需要安装 brotli
+    compressor.encodings = ('br', 'gzip')
+    return compressor
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('gzip, deflate, br', 'br'),
+    ('gzip, br', 'br'),
+    ('br;q=0.5, gzip', 'gzip'),
+    ('gzip;q=0.8, br;q=0.9', 'br'),
+    ('*', 'br'),
+    ('br;q=0, *;q=0.1', 'gzip'),
+    ('gzip', 'gzip'),
+    ('identity', None),
+    ('', None),
+])
+def test_negotiate_prefers_quality_then_configured_order(negotiator, header, expected):
+    assert negotiator.negotiate(accept(header)) == expected
+
+
+def test_configured_order_breaks_ties(negotiator):
+    negotiator.encodings = ('gzip', 'br')
+    assert negotiator.negotiate(accept('br, gzip')) == 'gzip'
+
+
+def test_unavailable_encodings_are_skipped():
+    compressor = Compressor(encodings=('zstd', 'gzip'))
+    assert 'zstd' not in compressor.encodings
+    assert compressor.negotiate(accept('zstd, gzip;q=0.5')) == 'gzip'
+
+
+@pytest.fixture
+def conversation(app_db):
+    conversation_id = app_db.create_conversation('t', 's', 'glm-4.5-air')
+    question = ConversationNode('q', None, conversation_id, 'question', 'tell me a long story')
+    app_db.save_turn(question, ConversationNode('a', 'q', conversation_id, 'answer', 'once upon a time ' * 200))
+    return conversation_id
+
+
+def get(client, conversation_id, **headers):
+    return client.get(f'/api/conversations/{conversation_id}', headers=Headers(headers))
+
+
+def test_gzip_response_has_vary_and_etag(client, conversation):
+    plain = get(client, conversation)
+    assert 'Content-Encoding' not in plain.headers
+    assert 'Accept-Encoding' in plain.vary
+
+    compressed = get(client, conversation, **{'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in compressed.vary
+    assert compressed.headers['ETag'] == plain.headers['ETag']
+    assert json.loads(gzip.decompress(compressed.get_data())) == plain.get_json()
+
+
+def test_small_response_is_not_compressed_but_varies(client, app_db):
+    conversation_id = app_db.create_conversation('t', 's', 'glm-4.5-air')
+    response = get(client, conversation_id, **{'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert 'Accept-Encoding' in response.vary
+
+
+def test_br_is_chosen_when_available(client, conversation, app_module, monkeypatch):
+    brotli = pytest.importorskip('brotli')
+    monkeypatch.setattr(app_module, 'compressor', Compressor())
+    response = get(client, conversation, **{'Accept-Encoding': 'gzip, br'})
+    assert response.headers['Content-Encoding'] == 'br'
+    assert json.loads(brotli.decompress(response.get_data()))['success'] is True
+
+
+def test_if_none_match_returns_304(client, app_db, conversation):
+    first = get(client, conversation, **{'Accept-Encoding': 'gzip'})
+    etag = first.headers['ETag']
+    assert etag.startswith('W/')
+
+    cached = get(client, conversation, **{'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.get_data() == b''
+    assert cached.headers['ETag'] == etag
+    assert 'Accept-Encoding' in cached.vary
+    assert 'no-cache' in cached.headers['Cache-Control']
+
+    # 写入新节点后旧的 ETag 不再匹配
+    app_db.save_nodes([ConversationNode('q2', 'a', conversation, 'question', 'and then?')])
+    changed = get(client, conversation, **{'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+
+
+def test_compressed_body_is_cached_per_etag(client, conversation, app_module, monkeypatch):
+    compressor = Compressor(encodings=('gzip',))
+    monkeypatch.setattr(app_module, 'compressor', compressor)
+    first = get(client, conversation, **{'Accept-Encoding': 'gzip'})
+    second = get(client, conversation, **{'Accept-Encoding': 'gzip'})
+    assert second.get_data() == first.get_data()
+    assert compressor.stats()['misses'] == 1 and compressor.stats()['hits'] == 1
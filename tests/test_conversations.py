@@ -0,0 +1,83 @@
+import uuid
+
+import pytest
+
+from database.database import ConversationNode, encode_cursor
+
+
+def add_turn(db, conversation_id, parent_id=None):
+    question = ConversationNode(str(uuid.uuid4()), parent_id, conversation_id, 'question', 'question')
+    answer = ConversationNode(str(uuid.uuid4()), question.id, conversation_id, 'answer', 'answer')
+    db.save_turn(question, answer)
+    return question.id, answer.id
+
+
+def test_subtree_distinguishes_missing_conversation_and_node(app_db, client):
+    conversation_id = app_db.create_conversation('t', 's', 'm')
+    question, answer = add_turn(app_db, conversation_id)
+
+    response = client.get(f'/api/conversations/{conversation_id}/subtree/{question}')
+    assert response.status_code == 200
+    assert response.get_json()['tree']['children'][0]['id'] == answer
+
+    response = client.get(f'/api/conversations/missing/subtree/{question}')
+    assert response.status_code == 404
+    assert response.get_json()['error'] == 'Conversation not found'
+
+    response = client.get(f'/api/conversations/{conversation_id}/subtree/missing')
+    assert response.status_code == 404
+    assert response.get_json()['error'] == 'Node not found'
+
+
+def all_pages(db, limit, **kwargs):
+    pages, cursor = [], None
+    while True:
+        page, cursor = db.get_conversations(limit=limit, cursor=cursor, **kwargs)
+        pages.append(page)
+        if cursor is None:
+            return pages
+
+
+def test_pages_split_ties_on_updated_at(db):
+    ids = [db.create_conversation(f'c{i}', 's', 'm') for i in range(7)]
+    with db._connection() as conn:
+        # 五个对话的 updated_at 相同，分页边界落在它们中间
+        conn.executemany('UPDATE conversations SET updated_at = ? WHERE id = ?',
+                         [(1000, i) for i in ids[:5]] + [(2000, ids[5]), (500, ids[6])])
+
+    pages = all_pages(db, limit=2)
+    listed = [c['id'] for page in pages for c in page]
+    assert listed == [ids[5]] + sorted(ids[:5], reverse=True) + [ids[6]]
+    assert [len(page) for page in pages] == [2, 2, 2, 1]
+
+
+def test_empty_page_has_no_cursor(db):
+    assert db.get_conversations() == ([], None)
+    db.create_conversation('only', 's', 'm')
+    page, cursor = db.get_conversations(limit=1)
+    assert len(page) == 1 and cursor is None
+
+
+@pytest.mark.parametrize('cursor', ['not base64!', 'e30', encode_cursor(1, 'x')[:-3], 'WyJhIiwxXQ'])
+def test_malformed_cursor_is_rejected(app_db, client, cursor):
+    with pytest.raises(ValueError):
+        app_db.get_conversations(cursor=cursor)
+    response = client.get('/api/conversations', query_string={'cursor': cursor})
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+
+
+def test_fields_allow_list(app_db, client):
+    app_db.create_conversation('t', 'secret system prompt', 'm')
+
+    (listed,), _ = app_db.get_conversations()
+    assert 'system_msg' not in listed
+    (listed,), _ = app_db.get_conversations(fields=['title', 'system_msg'])
+    assert listed == {'title': 't', 'system_msg': 'secret system prompt'}
+
+    response = client.get('/api/conversations', query_string={'fields': 'id, title'})
+    assert list(response.get_json()['conversations'][0]) == ['id', 'title']
+    for fields in ('title,password', 'title;DROP TABLE conversations', 'rowid'):
+        response = client.get('/api/conversations', query_string={'fields': fields})
+        assert response.status_code == 400
+    assert len(app_db.get_conversations()[0]) == 1
@@ -0,0 +1,291 @@
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime, timedelta
+
+import pytest
+
+from database.database import ConversationNode, DatabaseManager
+from database.content import encode_content
+from database.migrations import CONTENT_BACKFILL, MIGRATIONS, Migration, MigrationRunner, iso_to_ms
+
+BASE_TIME = datetime(2024, 3, 1, 12, 30, 15, 123456)
+
+
+def iso(offset):
+    return (BASE_TIME + timedelta(seconds=offset)).isoformat()
+
+
+# 迁移前的表结构：时间戳为 ISO 字符串，内容保存在节点表中，user_version 为 0
+BASELINE_SCHEMA = '''
+    CREATE TABLE conversations (
+        id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        system_msg TEXT NOT NULL,
+        model_id TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    );
+    CREATE TABLE conversation_nodes (
+        id TEXT PRIMARY KEY,
+        parent_id TEXT,
+        conversation_id TEXT NOT NULL,
+        node_type TEXT NOT NULL CHECK (node_type IN ('question', 'answer')),
+        content TEXT NOT NULL,
+        tokens_input INTEGER,
+        tokens_output INTEGER,
+        created_at TEXT NOT NULL,
+        FOREIGN KEY (parent_id) REFERENCES conversation_nodes (id),
+        FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
+    );
+    CREATE INDEX idx_nodes_conversation ON conversation_nodes (conversation_id);
+    CREATE INDEX idx_nodes_parent ON conversation_nodes (parent_id);
+'''
+
+CONVERSATIONS = [('c1', 'first conversation', 'sys', 'm', iso(0), iso(60)),
+                 ('c2', 'second conversation', 'sys', 'm', iso(10), iso(70))]
+# c1 和 c2 中有相同的回答内容，迁移后只存一份
+NODES = [('q1', None, 'c1', 'question', 'what is sqlite?', None, None, iso(1)),
+         ('a1', 'q1', 'c1', 'answer', 'an embedded database ' * 10, 10, 20, iso(2)),
+         ('q2', 'a1', 'c1', 'question', '再问一个问题', None, None, iso(3)),
+         ('a2', 'q2', 'c1', 'answer', 'same answer', 5, 7, iso(4)),
+         ('q3', None, 'c2', 'question', 'hello', None, None, iso(11)),
+         ('a3', 'q3', 'c2', 'answer', 'same answer', 3, 4, iso(12))]
+
+
+@pytest.fixture
+def baseline(tmp_path):
+    path = str(tmp_path / 'baseline.db')
+    with closing(sqlite3.connect(path)) as conn:
+        conn.executescript(BASELINE_SCHEMA)
+        conn.executemany('INSERT INTO conversations VALUES (?, ?, ?, ?, ?, ?)', CONVERSATIONS)
+        conn.executemany('INSERT INTO conversation_nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)', NODES)
+        conn.commit()
+    return path
+
+
+def query(path, sql, params=()):
+    with closing(sqlite3.connect(path)) as conn:
+        return conn.execute(sql, params).fetchall()
+
+
+def assert_consistent(path):
+    assert query(path, 'PRAGMA integrity_check') == [('ok',)]
+    assert query(path, 'PRAGMA foreign_key_check') == []
+
+
+def open_db(path):
+    return DatabaseManager(path, tree_cache_bytes=0, auto_migrate=False)
+
+
+def test_baseline_migrates_to_latest(baseline):
+    runner = MigrationRunner(baseline, chunk_size=2)
+    assert [m.version for m in runner.run()] == [m.version for m in MIGRATIONS]
+    assert query(baseline, 'PRAGMA user_version') == [(runner.latest,)]
+    assert_consistent(baseline)
+
+    db = open_db(baseline)
+    try:
+        for conversation in CONVERSATIONS:
+            migrated = db.get_conversation(conversation[0])
+            assert migrated.title == conversation[1]
+            assert (migrated.created_at, migrated.updated_at) == (iso_to_ms(conversation[4]),
+                                                                  iso_to_ms(conversation[5]))
+        nodes = {node.id: node for node in db.get_conversation_nodes('c1') + db.get_conversation_nodes('c2')}
+        for node_id, parent_id, conversation_id, node_type, content, _, _, created_at in NODES:
+            node = nodes[node_id]
+            assert (node.parent_id, node.conversation_id, node.content) == (parent_id, conversation_id, content)
+            assert node.created_at == iso_to_ms(created_at)
+            assert node.content_tokens is not None
+
+        (listed,), _ = db.get_conversations(limit=1)
+        assert listed['id'] == 'c2' and listed['node_count'] == 2 and listed['total_tokens'] == 7
+        if db.fts_enabled:
+            assert [row[0] for row in db.search_conversations('embedded')] == ['c1']
+    finally:
+        db.close()
+
+
+def test_migrating_again_is_a_no_op(baseline):
+    MigrationRunner(baseline, chunk_size=2).run()
+    schema = query(baseline, 'SELECT type, name, sql FROM sqlite_master ORDER BY name')
+    data = query(baseline, 'SELECT * FROM conversation_nodes ORDER BY rowid')
+
+    runner = MigrationRunner(baseline, chunk_size=2)
+    assert runner.pending() == []
+    assert runner.run() == []
+    assert query(baseline, 'SELECT type, name, sql FROM sqlite_master ORDER BY name') == schema
+    assert query(baseline, 'SELECT * FROM conversation_nodes ORDER BY rowid') == data
+    assert_consistent(baseline)
+
+
+def test_new_database_matches_migrated_baseline(baseline, tmp_path):
+    MigrationRunner(baseline).run()
+    fresh = str(tmp_path / 'fresh.db')
+    MigrationRunner(fresh).run()
+
+    def columns(path):
+        return {table: query(path, f'SELECT name, type, "notnull", dflt_value, pk FROM pragma_table_info(?)', (table,))
+                for (table,) in query(path, "SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert columns(fresh) == columns(baseline)
+    assert query(fresh, 'PRAGMA user_version') == query(baseline, 'PRAGMA user_version')
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_table_rebuild_resumes_after_interruption(baseline):
+    """迁移 7 分段复制到一半中断，重新运行后从断点继续，结果与一次完成相同"""
+    before_7 = [m for m in MIGRATIONS if m.version < 7]
+    MigrationRunner(baseline, chunk_size=2, migrations=before_7).run()
+    rowids = query(baseline, 'SELECT rowid, id FROM conversation_nodes ORDER BY rowid')
+
+    class FailingRunner(MigrationRunner):
+        chunks = 0
+
+        def backfill(self, conn, table, *statements):
+            if table == 'conversation_nodes':
+                # 复制一段后中断，期间旧表上有新的写入
+                original = self.transaction
+
+                def transaction(conn):
+                    self.chunks += 1
+                    if self.chunks > 1:
+                        raise Interrupted
+                    return original(conn)
+                self.transaction = transaction
+            super().backfill(conn, table, *statements)
+
+    upto_7 = [m for m in MIGRATIONS if m.version <= 7]
+    with pytest.raises(Interrupted):
+        FailingRunner(baseline, chunk_size=2, migrations=upto_7).run()
+    assert query(baseline, 'PRAGMA user_version') == [(6,)]
+    with closing(sqlite3.connect(baseline)) as conn:
+        conn.execute("INSERT INTO conversation_nodes (id, parent_id, conversation_id, node_type, content, created_at) "
+                     "VALUES ('late', 'a3', 'c2', 'question', 'written during the migration', ?)", (iso(20),))
+        conn.execute("UPDATE conversation_nodes SET content = 'edited' WHERE id = 'q1'")
+        conn.execute("DELETE FROM conversation_nodes WHERE id = 'a2'")
+        conn.commit()
+
+    MigrationRunner(baseline, chunk_size=2, migrations=upto_7).run()
+    assert query(baseline, 'PRAGMA user_version') == [(7,)]
+    assert_consistent(baseline)
+    assert query(baseline, "SELECT type FROM pragma_table_info('conversation_nodes') WHERE name = 'created_at'") \
+        == [('INTEGER',)]
+    # rowid 保留，全文索引仍然对应
+    rowids.remove(next(row for row in rowids if row[1] == 'a2'))
+    assert query(baseline, 'SELECT rowid, id FROM conversation_nodes ORDER BY rowid')[:len(rowids)] == rowids
+    assert query(baseline, "SELECT COUNT(*) FROM conversation_nodes WHERE id = 'a2'") == [(0,)]
+    assert query(baseline, "SELECT content, created_at FROM conversation_nodes WHERE id IN ('q1', 'late') "
+                           "ORDER BY id") == [('written during the migration', iso_to_ms(iso(20))),
+                                              ('edited', iso_to_ms(iso(1)))]
+    leftovers = query(baseline, "SELECT name FROM sqlite_master WHERE name LIKE '%\\_new' ESCAPE '\\' "
+                                "OR name LIKE '%mirror%'")
+    assert leftovers == []
+    names = {name for (name,) in query(baseline, "SELECT name FROM sqlite_master WHERE type IN ('index', 'trigger')")}
+    assert {'idx_nodes_parent', 'idx_nodes_conversation_created', 'idx_conversations_updated',
+            'nodes_stats_insert'} <= names
+
+    MigrationRunner(baseline, chunk_size=2).run()
+    assert_consistent(baseline)
+
+
+def refcounts(path):
+    counted = dict(query(path, 'SELECT content_id, COUNT(*) FROM conversation_nodes GROUP BY content_id'))
+    stored = dict(query(path, 'SELECT id, refs FROM node_content'))
+    assert counted == stored
+    return stored
+
+
+def test_content_store_refcounts_and_cleanup(baseline):
+    MigrationRunner(baseline, chunk_size=2).run()
+    assert 'content' not in {name for (name,) in query(baseline, "SELECT name FROM pragma_table_info('conversation_nodes')")}
+    # 'same answer' 被两个节点共用
+    assert sorted(refcounts(baseline).values()) == [1, 1, 1, 1, 2]
+
+    db = open_db(baseline)
+    try:
+        db.save_nodes([ConversationNode('a3', 'q3', 'c2', 'answer', 'a different answer')])
+        assert sorted(refcounts(baseline).values()) == [1, 1, 1, 1, 1, 1]
+        db.save_nodes([ConversationNode('a1', 'q1', 'c1', 'answer', 'a different answer')])
+        assert sorted(refcounts(baseline).values()) == [1, 1, 1, 1, 2]
+
+        db.delete_conversation('c1')
+        assert sorted(refcounts(baseline).values()) == [1, 1]
+        db.delete_conversation('c2')
+        assert query(baseline, 'SELECT COUNT(*) FROM node_content') == [(0,)]
+    finally:
+        db.close()
+    assert_consistent(baseline)
+
+
+def test_concurrent_runners_apply_each_step_once(baseline):
+    """两个进程同时启动：都读到待处理的迁移，只有拿到锁的一方执行，另一方在锁内重新读取版本后跳过"""
+    started = threading.Barrier(2)
+    calls = []
+
+    def slow(runner, conn):
+        calls.append(threading.current_thread().name)
+        threading.Event().wait(0.2)
+    steps = MIGRATIONS + [Migration(MIGRATIONS[-1].version + 1, 'slow', slow)]
+
+    class Runner(MigrationRunner):
+        def lock(self):
+            started.wait(5)  # 两个线程都已读过 user_version
+            return super().lock()
+
+    results = {}
+
+    def migrate(name):
+        results[name] = [m.version for m in Runner(baseline, chunk_size=2, migrations=steps).run()]
+    threads = [threading.Thread(target=migrate, args=(name,), name=name) for name in ('first', 'second')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    assert sorted(results.values()) == [[], [m.version for m in steps]]
+    assert len(calls) == 1
+    assert query(baseline, 'PRAGMA user_version') == [(steps[-1].version,)]
+    assert_consistent(baseline)
+
+
+def test_content_store_catches_up_only_changed_rows(baseline):
+    """迁移 8 分段回填之后其他连接的写入：收尾事务只处理这些节点，引用计数保持一致"""
+    MigrationRunner(baseline, migrations=[m for m in MIGRATIONS if m.version <= 7]).run()
+    encoded = []
+
+    class Runner(MigrationRunner):
+        def connect(self):
+            conn = super().connect()
+            conn.create_function('encode_content', 1, lambda text: (encoded.append(text), encode_content(text)[1])[1])
+            return conn
+
+        def backfill(self, conn, table, *statements):
+            super().backfill(conn, table, *statements)
+            if statements != CONTENT_BACKFILL:
+                return
+            encoded.clear()
+            # 旧版本进程的写入：连接上没有注册内容相关的函数
+            with closing(sqlite3.connect(baseline)) as other:
+                other.execute("UPDATE conversation_nodes SET content = 'rewritten' WHERE id = 'q1'")
+                other.execute("UPDATE conversation_nodes SET content = 'same answer' WHERE id = 'a1'")
+                other.execute("DELETE FROM conversation_nodes WHERE id = 'a3'")
+                other.execute("INSERT INTO conversation_nodes (id, parent_id, conversation_id, node_type, content, "
+                              "created_at) VALUES ('late', 'q3', 'c2', 'answer', 'written late', 0)")
+                other.commit()
+
+    Runner(baseline, chunk_size=2).run()
+    assert sorted(encoded) == ['rewritten', 'same answer', 'written late']
+    assert_consistent(baseline)
+    # 'same answer' 现在由 a1、a2 引用；a1 原来的内容和 q1 原来的内容已删除
+    assert sorted(refcounts(baseline).values()) == [1, 1, 1, 1, 2]
+
+    db = open_db(baseline)
+    try:
+        contents = {node.id: node.content for node in db.get_conversation_nodes('c1') + db.get_conversation_nodes('c2')}
+    finally:
+        db.close()
+    assert contents == {'q1': 'rewritten', 'a1': 'same answer', 'q2': '再问一个问题', 'a2': 'same answer',
+                        'q3': 'hello', 'late': 'written late'}
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+from langchain_core.messages import HumanMessage
+
+from backend.Agents.offline import ReplayChatModel, SimulatedChatModel, _PlannedChatModel
+
+
+def simulated():
+    return SimulatedChatModel(model_name='upstream', ttft=0, distribution='fixed', chunk_interval=0,
+                              output_tokens=6, seed=1)
+
+
+@pytest.fixture
+def recorded(tmp_path):
+    """记录两条回答后返回 fixture 路径"""
+    path = str(tmp_path / 'fixtures.jsonl')
+    recorder = ReplayChatModel(path=path, on_miss='record', upstream=simulated(), speed=0)
+    first = recorder.invoke([HumanMessage('first')]).content
+    second = ''.join(chunk.content for chunk in recorder.stream([HumanMessage('second')]))
+    return path, {'first': first, 'second': second}
+
+
+def test_planned_model_requires_plan():
+    with pytest.raises(TypeError):
+        _PlannedChatModel()
+
+
+def test_replay_serves_recorded_answers(recorded):
+    path, answers = recorded
+    model = ReplayChatModel(path=path, speed=0)
+    assert model.invoke([HumanMessage('first')]).content == answers['first']
+    assert ''.join(chunk.content for chunk in model.stream([HumanMessage('second')])) == answers['second']
+
+    async def consume():
+        response = await model.ainvoke([HumanMessage('second')])
+        chunks = [chunk.content async for chunk in model.astream([HumanMessage('first')])]
+        return response.content, ''.join(chunks)
+    assert asyncio.run(consume()) == (answers['second'], answers['first'])
+
+
+def test_replay_usage_comes_from_the_recording(recorded):
+    path, _ = recorded
+    response = ReplayChatModel(path=path, speed=0).invoke([HumanMessage('first')])
+    assert response.usage_metadata['output_tokens'] > 0
+
+
+def test_replay_miss(recorded):
+    path, answers = recorded
+    with pytest.raises(LookupError):
+        ReplayChatModel(path=path, speed=0).invoke([HumanMessage('unknown')])
+    cycled = ReplayChatModel(path=path, on_miss='cycle', speed=0).invoke([HumanMessage('unknown')])
+    assert cycled.content in answers.values()
+
+
+def test_record_mode_replays_once_recorded(recorded):
+    path, answers = recorded
+
+    class Failing(SimulatedChatModel):
+        def _plan(self, messages):
+            raise AssertionError('recorded prompt went to the upstream model')
+    model = ReplayChatModel(path=path, on_miss='record', upstream=Failing(), speed=0)
+    assert model.invoke([HumanMessage('first')]).content == answers['first']
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from backend.Agents.scheduler import ProviderScheduler
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+
+def broken_stream():
+    yield 'first'
+    raise RateLimited('rate limited mid-stream')
+
+
+async def broken_astream():
+    yield 'first'
+    raise RateLimited('rate limited mid-stream')
+
+
+def assert_plain_failure(scheduler):
+    assert scheduler.failures == 1
+    assert scheduler.retries == 0
+    assert scheduler.throttled == 0
+    assert scheduler.scale == 1.0
+    assert scheduler.limit == scheduler.max_in_flight
+    assert scheduler.paused_until == 0.0
+    assert scheduler.in_flight == 0
+
+
+def test_stream_failure_after_output_is_not_retried():
+    scheduler = ProviderScheduler('test', base_delay=0)
+    chunks = []
+    with pytest.raises(RateLimited):
+        for chunk in scheduler.stream(broken_stream):
+            chunks.append(chunk)
+    assert chunks == ['first']
+    assert_plain_failure(scheduler)
+
+
+def test_astream_failure_after_output_is_not_retried():
+    scheduler = ProviderScheduler('test', base_delay=0)
+
+    async def consume():
+        return [chunk async for chunk in scheduler.astream(broken_astream)]
+
+    with pytest.raises(RateLimited):
+        asyncio.run(consume())
+    assert_plain_failure(scheduler)
+
+
+def test_stream_failure_before_output_is_retried():
+    scheduler = ProviderScheduler('test', base_delay=0)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RateLimited('rate limited before the first chunk')
+        yield 'ok'
+
+    assert list(scheduler.stream(flaky)) == ['ok']
+    assert scheduler.retries == 1
+    assert scheduler.throttled == 1
+    assert scheduler.failures == 0
@@ -0,0 +1,60 @@
+import time
+import uuid
+
+from database.database import ConversationNode
+
+
+def add_turn(db, conversation_id, question, answer):
+    q = ConversationNode(str(uuid.uuid4()), None, conversation_id, 'question', question)
+    db.save_turn(q, ConversationNode(str(uuid.uuid4()), q.id, conversation_id, 'answer', answer))
+
+
+def titles(rows):
+    return [row[1] for row in rows]
+
+
+def test_bm25_ranks_denser_match_first(db):
+    assert db.fts_enabled
+    sparse = db.create_conversation('sparse', 's', 'm')
+    dense = db.create_conversation('dense', 's', 'm')
+    add_turn(db, dense, 'sqlite sqlite sqlite', 'sqlite uses sqlite pages')
+    add_turn(db, sparse, 'a long question about many things, databases among them ' * 5,
+             'mentions sqlite once in a much longer answer ' + 'filler words here ' * 20)
+    db.create_conversation('unrelated', 's', 'm')
+
+    assert titles(db.search_conversations('sqlite')) == ['dense', 'sparse']
+
+
+def test_title_match_is_found(db):
+    db.create_conversation('关于数据库索引的讨论', 's', 'm')
+    db.create_conversation('other', 's', 'm')
+    assert titles(db.search_conversations('数据库索引')) == ['关于数据库索引的讨论']
+
+
+def test_snippet_marks_the_match(db):
+    conversation_id = db.create_conversation('t', 's', 'm')
+    add_turn(db, conversation_id, 'what is a write-ahead log?', 'the write-ahead log keeps changes durable')
+    (row,) = db.search_conversations('write-ahead')
+    assert row[0] == conversation_id
+    assert '<mark>write-ahead</mark>' in row[6]
+
+
+def test_short_query_falls_back_to_like(db):
+    first = db.create_conversation('first', 's', 'm')
+    second = db.create_conversation('second', 's', 'm')
+    add_turn(db, first, 'go?', 'yes')
+    time.sleep(0.002)  # updated_at 精确到毫秒
+    add_turn(db, second, 'go!', 'no')
+    db.create_conversation('third', 's', 'm')
+
+    # trigram 无法匹配少于 3 个字符的查询，LIKE 扫描按更新时间倒序返回，没有片段
+    rows = db.search_conversations('go')
+    assert titles(rows) == ['second', 'first']
+    assert all(row[6] is None for row in rows)
+
+
+def test_query_quotes_are_literal(db):
+    conversation_id = db.create_conversation('t', 's', 'm')
+    add_turn(db, conversation_id, 'say "hello" OR bye', 'ok')
+    assert titles(db.search_conversations('"hello" OR')) == ['t']
+    assert db.search_conversations('NEAR(') == []
@@ -0,0 +1,77 @@
+import json
+import sqlite3
+import threading
+from contextlib import closing
+
+from database.database import ConversationNode
+from database.tree import build_tree, encode_tree_json, tree_to_dict
+
+
+def row(node_id, parent_id):
+    return node_id, parent_id, 'question', node_id, None, None, False
+
+
+def build(rows, timeout=5):
+    """在线程中构建树，成环时死循环会表现为超时而不是挂住测试"""
+    result = []
+    thread = threading.Thread(target=lambda: result.append(build_tree(rows)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert result, 'build_tree did not finish'
+    return result[0]
+
+
+def ids(nodes):
+    return [node.id for node in nodes]
+
+
+def reachable(roots):
+    stack, seen = list(roots), []
+    while stack:
+        node = stack.pop()
+        assert node.id not in seen, f'{node.id} reached twice'
+        seen.append(node.id)
+        stack.extend(node.children)
+    return sorted(seen)
+
+
+def test_child_before_parent_is_attached():
+    tree = build([row('b', 'a'), row('a', None), row('c', 'b')])
+    assert ids(tree.roots) == ['a']
+    assert ids(tree.roots[0].children) == ['b']
+    assert ids(tree.roots[0].children[0].children) == ['c']
+    assert tree.orphans == []
+
+
+def test_missing_parent_becomes_orphan_root():
+    tree = build([row('a', None), row('b', 'gone'), row('c', 'b')])
+    assert ids(tree.roots) == ['a', 'b']
+    assert ids(tree.orphans) == ['b']
+    assert ids(tree.roots[1].children) == ['c']
+
+
+def test_cycles_are_broken():
+    rows = [row('root', None), row('x', 'y'), row('y', 'x'), row('z', 'y'), row('self', 'self')]
+    tree = build(rows)
+    # 每个环断开一处，断开的节点作为孤立节点
+    assert len(tree.orphans) == 2 and 'self' in ids(tree.orphans)
+    # 每个节点恰好可达一次，序列化不会无限展开
+    assert reachable(tree.roots) == sorted(r[0] for r in rows)
+    assert json.loads(encode_tree_json(tree.roots)) == tree_to_dict(tree.roots)
+
+
+def test_database_tree_keeps_orphans_and_cycles(db, caplog):
+    conversation_id = db.create_conversation('t', 's', 'm')
+    db.save_nodes([ConversationNode(node_id, parent_id, conversation_id, 'question', node_id)
+                   for node_id, parent_id in [('a', None), ('b', 'a'), ('c', 'b'), ('d', 'c')]])
+    # 绕过外键约束制造损坏的数据：b 的父节点不存在，c、d 互为父节点
+    with closing(sqlite3.connect(db.db_path)) as conn:
+        conn.executemany('UPDATE conversation_nodes SET parent_id = ? WHERE id = ?',
+                         [('gone', 'b'), ('d', 'c')])
+        conn.commit()
+
+    entry = db._build_tree(conversation_id)
+    assert ids(entry.roots)[:2] == ['a', 'b']
+    assert '2 个孤立节点' in caplog.text
+    assert reachable(entry.roots) == ['a', 'b', 'c', 'd']
+    assert len(json.loads(db.get_conversation_tree_json(conversation_id))) == 3
@@ -0,0 +1,102 @@
+import json
+
+import pytest
+
+from database.database import ConversationNode, DatabaseManager
+
+
+@pytest.fixture
+def cached(tmp_path):
+    manager = DatabaseManager(str(tmp_path / 'knode.db'))
+    yield manager
+    manager.close()
+
+
+@pytest.fixture
+def fresh(cached):
+    """同一数据库文件上不带缓存的实例，每次都重新构建树"""
+    manager = DatabaseManager(cached.db_path, tree_cache_bytes=0, auto_migrate=False)
+    yield manager
+    manager.close()
+
+
+def node(conversation_id, node_id, parent_id, content, node_type='question'):
+    return ConversationNode(node_id, parent_id, conversation_id, node_type, content)
+
+
+def assert_matches_fresh(cached, fresh, conversation_id):
+    revision = cached.get_conversation(conversation_id).revision
+    data = cached.get_conversation_tree_json(conversation_id, revision)
+    assert json.loads(data) == fresh.get_conversation_tree(conversation_id)
+    assert cached.get_conversation_tree(conversation_id, revision) == fresh.get_conversation_tree(conversation_id)
+
+
+def test_cache_follows_writes(cached, fresh):
+    conversation_id = cached.create_conversation('t', 's', 'm')
+    cached.save_turn(node(conversation_id, 'q1', None, 'first'), node(conversation_id, 'a1', 'q1', 'one', 'answer'))
+    assert_matches_fresh(cached, fresh, conversation_id)
+    assert cached.tree_cache.stats()['entries'] == 1
+
+    # 新增节点直接挂到缓存的树上
+    cached.save_turn(node(conversation_id, 'q2', 'a1', 'second'), node(conversation_id, 'a2', 'q2', 'two', 'answer'))
+    cached.save_nodes([node(conversation_id, 'q3', 'a1', 'branch')])
+    assert_matches_fresh(cached, fresh, conversation_id)
+
+    # 覆盖已有节点原地更新
+    cached.save_nodes([node(conversation_id, 'a2', 'q2', 'two, rewritten', 'answer')])
+    assert_matches_fresh(cached, fresh, conversation_id)
+    assert cached.tree_cache.stats()['invalidations'] == 0
+
+    # 移动节点使缓存失效，下次读取时重建
+    cached.save_nodes([node(conversation_id, 'q3', 'a2', 'branch')])
+    assert cached.tree_cache.stats()['invalidations'] == 1
+    assert_matches_fresh(cached, fresh, conversation_id)
+
+
+def test_writes_from_other_instance_are_not_served_stale(cached, fresh):
+    conversation_id = cached.create_conversation('t', 's', 'm')
+    cached.save_nodes([node(conversation_id, 'q1', None, 'first')])
+    assert_matches_fresh(cached, fresh, conversation_id)
+
+    fresh.save_nodes([node(conversation_id, 'q1', None, 'changed elsewhere')])
+    assert_matches_fresh(cached, fresh, conversation_id)
+
+
+def test_delete_invalidates(cached, fresh):
+    conversation_id = cached.create_conversation('t', 's', 'm')
+    cached.save_nodes([node(conversation_id, 'q1', None, 'first')])
+    assert_matches_fresh(cached, fresh, conversation_id)
+
+    cached.delete_conversation(conversation_id)
+    assert cached.tree_cache.stats()['entries'] == 0
+    assert cached.get_conversation_tree(conversation_id) is None
+    assert cached.get_conversation_tree_json(conversation_id) is None
+
+
+def test_snapshot_revision_matches_tree(cached):
+    conversation_id = cached.create_conversation('t', 's', 'm')
+    cached.save_nodes([node(conversation_id, 'q1', None, 'first')])
+    stale = cached.get_conversation(conversation_id).revision
+    cached.get_conversation_tree_json(conversation_id, stale)
+    cached.save_nodes([node(conversation_id, 'q2', 'q1', 'second')])
+
+    # 调用方读到的修订号已过期时，返回的是树实际对应的修订号
+    for manager in (cached, DatabaseManager(cached.db_path, tree_cache_bytes=0, auto_migrate=False)):
+        revision, data = manager.get_conversation_tree_snapshot(conversation_id, stale)
+        assert revision == stale + 1
+        assert json.loads(data)['children'][0]['id'] == 'q2'
+
+
+def test_etag_comes_from_the_returned_tree(app_db, client, monkeypatch):
+    conversation_id = app_db.create_conversation('t', 's', 'm')
+    app_db.save_nodes([node(conversation_id, 'q1', None, 'first')])
+    stale = app_db.get_conversation(conversation_id)
+    app_db.save_nodes([node(conversation_id, 'q2', 'q1', 'second')])
+
+    # 读取对话之后、构建树之前有新的写入
+    monkeypatch.setattr(app_db, 'get_conversation', lambda _: stale)
+    response = client.get(f'/api/conversations/{conversation_id}')
+    body = response.get_json()
+    assert body['conversation']['revision'] == stale.revision + 1
+    assert body['conversation']['tree']['children'][0]['id'] == 'q2'
+    assert f'.{stale.revision + 1}.' in response.headers['ETag']
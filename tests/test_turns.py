@@ -0,0 +1,97 @@
+import threading
+
+import pytest
+
+from conftest import sse_events
+
+
+def test_wait_turn_is_bounded(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'TURN_WAIT_TIMEOUT', 0.1)
+    coordinator = app_module.TurnCoordinator()
+    first = coordinator.begin('c', None, 'first')
+    second = coordinator.begin('c', None, 'second')
+    with pytest.raises(TimeoutError):
+        second.wait_turn()
+    first.finish('done')
+    second.wait_turn()
+
+
+def test_failed_partial_save_still_finishes_turn(app_db, client, app_module, monkeypatch):
+    db = app_db
+    conversation_id = db.create_conversation('t', 's', 'glm-4.5-air')
+    save_turn = db.save_turn
+
+    def failing_save(*args, **kwargs):
+        raise RuntimeError('disk full')
+    monkeypatch.setattr(db, 'save_turn', failing_save)
+
+    response = client.post('/api/chat/stream', json={'conversation_id': conversation_id, 'message': 'hello'})
+    assert sse_events(response)[-1]['event'] == 'error'
+    assert app_module.turn_coordinator.stats()['conversations'] == 0
+
+    # 下一轮不会卡在等待上一轮上
+    monkeypatch.setattr(db, 'save_turn', save_turn)
+    finished = threading.Event()
+
+    def second_turn():
+        response = client.post('/api/chat/stream', json={'conversation_id': conversation_id, 'message': 'again'})
+        assert sse_events(response)[-1]['event'] == 'done'
+        finished.set()
+    thread = threading.Thread(target=second_turn, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert finished.is_set()
+    assert len(db.get_conversation_nodes(conversation_id)) == 2
+
+
+def test_timed_out_turn_does_not_release_successors(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'TURN_WAIT_TIMEOUT', 0.1)
+    coordinator = app_module.TurnCoordinator()
+    first = coordinator.begin('c', None, 'first')
+    second = coordinator.begin('c', None, 'second')
+    with pytest.raises(TimeoutError) as timeout:
+        second.wait_turn()
+    second.finish(error=timeout.value)
+
+    # 第一轮仍在执行，第三轮不能因为第二轮超时结束就开始
+    third = coordinator.begin('c', None, 'third')
+    with pytest.raises(TimeoutError):
+        third.wait_turn()
+    assert coordinator.stats()['conversations'] == 1
+    first.finish('done')
+    third.wait_turn()
+    third.finish('done')
+    assert coordinator.stats()['conversations'] == 0
+
+
+def test_predecessor_outliving_timeout_never_overlaps(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'TURN_WAIT_TIMEOUT', 0.2)
+    coordinator = app_module.TurnCoordinator()
+    release = threading.Event()
+    log = []
+
+    def turn(name, block=False):
+        def fn():
+            log.append(f'{name} start')
+            if block:
+                release.wait(10)
+            log.append(f'{name} end')
+            return name
+        return lambda: coordinator.run('c', None, name, fn)
+
+    slow = threading.Thread(target=turn('slow', block=True))
+    slow.start()
+    while not log:
+        threading.Event().wait(0.01)
+    with pytest.raises(TimeoutError):
+        turn('impatient')()
+
+    monkeypatch.setattr(app_module, 'TURN_WAIT_TIMEOUT', 10)
+    late = threading.Thread(target=turn('late'))
+    late.start()
+    late.join(0.5)
+    assert log == ['slow start']
+    release.set()
+    slow.join(5)
+    late.join(5)
+    assert log == ['slow start', 'slow end', 'late start', 'late end']
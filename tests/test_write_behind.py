@@ -0,0 +1,156 @@
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+
+from database.database import ConversationNode, DatabaseManager
+from database.write_behind import WriteBehindFull
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_turn(conversation_id, index, parent_id=None):
+    question = ConversationNode(f'q{index}', parent_id, conversation_id, 'question', f'question {index}')
+    answer = ConversationNode(f'a{index}', question.id, conversation_id, 'answer', f'answer {index}')
+    return question, answer
+
+
+def slow_writes(db, delay, gate=None):
+    """让写线程每批写入前等待 delay 秒（gate 不为 None 时先等 gate 被设置）"""
+    write_turns = db._write_turns
+
+    def write(turns):
+        if gate is not None:
+            gate.wait()
+        time.sleep(delay)
+        write_turns(turns)
+    db._write_turns = write
+
+
+def test_close_flushes_pending_writes(tmp_path, db):
+    conversation_id = db.create_conversation('t', 's', 'm')
+    db.enable_write_behind(batch_size=2)
+    slow_writes(db, 0.02)
+    for index in range(10):
+        db.save_turn(*make_turn(conversation_id, index))
+    assert db.write_behind.stats()['pending'] > 0
+
+    db.close()
+    reopened = DatabaseManager(db.db_path, tree_cache_bytes=0)
+    try:
+        assert len(reopened.get_conversation_nodes(conversation_id)) == 20
+    finally:
+        reopened.close()
+
+
+def test_read_waits_for_pending_write(db):
+    conversation_id = db.create_conversation('t', 's', 'm')
+    db.enable_write_behind()
+    slow_writes(db, 0.3)
+    question, answer = make_turn(conversation_id, 0)
+    db.save_turn(question, answer, title='new title')
+
+    # 写线程还在等待，读取同一对话时先等写入落库
+    assert {node.id for node in db.get_conversation_nodes(conversation_id)} == {question.id, answer.id}
+    assert db.get_node(conversation_id, answer.id).content == answer.content
+    assert db.get_conversation(conversation_id).title == 'new title'
+
+
+def test_read_of_other_conversation_does_not_wait(db):
+    busy = db.create_conversation('busy', 's', 'm')
+    idle = db.create_conversation('idle', 's', 'm')
+    db.enable_write_behind()
+    gate = threading.Event()
+    slow_writes(db, 0, gate)
+    db.save_turn(*make_turn(busy, 0))
+
+    start = time.perf_counter()
+    assert db.get_conversation_nodes(idle) == []
+    assert time.perf_counter() - start < 1
+    gate.set()
+    assert db.write_behind.flush(timeout=5)
+
+
+def test_backpressure_does_not_stall_writer(db):
+    conversation_id = db.create_conversation('t', 's', 'm')
+    db.enable_write_behind(max_pending=2, batch_size=1, put_timeout=3)
+    slow_writes(db, 0.3)
+
+    start = time.perf_counter()
+    for index in range(6):
+        db.save_turn(*make_turn(conversation_id, index))
+    elapsed = time.perf_counter() - start
+    # 队列满时提交方等待写线程腾出空间，而不是等到 put_timeout 超时
+    assert 0.3 <= elapsed < 3
+    assert db.write_behind.flush(timeout=5)
+    assert len(db.get_conversation_nodes(conversation_id)) == 12
+    assert db.write_behind.stats()['failed'] == 0
+
+
+def test_full_queue_raises_after_timeout(db):
+    conversation_id = db.create_conversation('t', 's', 'm')
+    db.enable_write_behind(max_pending=1, batch_size=1, put_timeout=0.2)
+    gate = threading.Event()
+    slow_writes(db, 0, gate)
+
+    db.save_turn(*make_turn(conversation_id, 0))  # 写线程取出后阻塞在 gate 上
+    deadline = time.monotonic() + 5
+    while db.write_behind._queue.qsize() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    db.save_turn(*make_turn(conversation_id, 1))  # 占满队列
+    with pytest.raises(WriteBehindFull):
+        db.save_turn(*make_turn(conversation_id, 2))
+
+    gate.set()
+    assert db.write_behind.flush(timeout=5)
+    assert {node.id for node in db.get_conversation_nodes(conversation_id)} == {'q0', 'a0', 'q1', 'a1'}
+
+
+CRASH_SCRIPT = textwrap.dedent('''
+    import sys, threading, time
+    from database.database import ConversationNode, DatabaseManager
+
+    db = DatabaseManager(sys.argv[1], tree_cache_bytes=0)
+    conversation_id = db.create_conversation('t', 's', 'm')
+    db.enable_write_behind()
+
+    def turn(index):
+        question = ConversationNode(f'q{index}', None, conversation_id, 'question', f'question {index}')
+        return question, ConversationNode(f'a{index}', question.id, conversation_id, 'answer', f'answer {index}')
+
+    db.save_turn(*turn(0))
+    db.write_behind.flush()
+    gate = threading.Event()
+    write_turns = db._write_turns
+    db._write_turns = lambda turns: (gate.wait(), write_turns(turns))
+    db.save_turn(*turn(1))
+    print(conversation_id, flush=True)
+    time.sleep(60)
+''')
+
+
+def test_kill_before_flush_loses_only_pending_writes(tmp_path):
+    path = str(tmp_path / 'knode.db')
+    child = subprocess.Popen([sys.executable, '-c', CRASH_SCRIPT, path], cwd=ROOT,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        conversation_id = child.stdout.readline().strip()
+        assert conversation_id, "child process exited before submitting"
+    finally:
+        child.send_signal(signal.SIGKILL)
+        child.wait()
+        child.stdout.close()
+
+    db = DatabaseManager(path, tree_cache_bytes=0)
+    try:
+        # 已落库的问答保留，队列中尚未提交的问答丢失，数据库保持一致
+        assert {node.id for node in db.get_conversation_nodes(conversation_id)} == {'q0', 'a0'}
+        with db._connection() as conn:
+            assert conn.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+    finally:
+        db.close()